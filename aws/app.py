@@ -103,6 +103,11 @@ class CracklingStack(Stack):
                     "Accept"
                 ],
                 max_age=3000
+            )],
+            # multi-FASTA files of batch jobs are only needed until the job is created
+            lifecycle_rules=[s3_.LifecycleRule(
+                prefix="_batches/",
+                expiration=Duration.days(1)
             )]
         )
 
@@ -157,6 +162,15 @@ class CracklingStack(Stack):
             stream=ddb_.StreamViewType.NEW_AND_OLD_IMAGES
         )
 
+        ### Recent job submissions, keyed by the client's idempotency key or by the hash of the genome and sequence.
+        # A submission repeated within JOB_DEDUP_WINDOW_SECONDS returns the job of the first one. Entries expire.
+        ddbSubmissions = ddb_.Table(self, "ddbSubmissions",
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=ddb_.BillingMode.PAY_PER_REQUEST,
+            partition_key=ddb_.Attribute(name="SubmissionKey", type=ddb_.AttributeType.STRING),
+            time_to_live_attribute="Expires"
+        )
+
         ### Stores information on the number of tasks completed by each job
         ddbTaskTracking = ddb_.Table(self, "ddbTaskTracking",
             removal_policy=RemovalPolicy.DESTROY,
@@ -175,7 +189,8 @@ class CracklingStack(Stack):
             stream=ddb_.StreamViewType.NEW_AND_OLD_IMAGES
         )
 
-        ### Genomes are downloaded from NCBI in portions. This table stores metadata about those portions.
+        ### Genomes are downloaded from NCBI in portions. This table stores metadata about those portions: the ETag of
+        # each part of an upload, and the set of parts uploaded so far (sort key 0).
         ddbGenomeParts = ddb_.Table(self, "ddbGenomeParts",
             removal_policy=RemovalPolicy.DESTROY,
             billing_mode=ddb_.BillingMode.PAY_PER_REQUEST,
@@ -184,6 +199,37 @@ class CracklingStack(Stack):
             stream=ddb_.StreamViewType.NEW_IMAGE
         )
 
+        ### Large genomes are indexed by many tasks (a map/reduce build). This table stores the progress of each build
+        # (task 0) and the result of each of its extraction tasks.
+        ddbIsslBuilds = ddb_.Table(self, "ddbIsslBuilds",
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=ddb_.BillingMode.PAY_PER_REQUEST,
+            partition_key=ddb_.Attribute(name="BuildID", type=ddb_.AttributeType.STRING),
+            sort_key=ddb_.Attribute(name="Task", type=ddb_.AttributeType.NUMBER)
+        )
+
+        ### Only one job downloads and indexes a genome. This table holds the lock of each genome being prepared
+        # (sort key "#LOCK") along with the jobs waiting for it to be ready, the manifest of the files in S3
+        # for each genome (sort key "#MANIFEST"), and the listing of its files on the NCBI server, which expires
+        # (sort key "#NCBI").
+        ddbGenomes = ddb_.Table(self, "ddbGenomes",
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=ddb_.BillingMode.PAY_PER_REQUEST,
+            partition_key=ddb_.Attribute(name="Genome", type=ddb_.AttributeType.STRING),
+            sort_key=ddb_.Attribute(name="Item", type=ddb_.AttributeType.STRING),
+            time_to_live_attribute="Expires"
+        )
+
+        ### The scores of each guide in each genome, kept so that jobs repeating the guides of earlier jobs are not
+        # scored again (key "<genome>#<guide>"). ISSL scores are only reused while the genome's index is the
+        # version they were computed with. Entries expire when not refreshed.
+        ddbScoreCache = ddb_.Table(self, "ddbScoreCache",
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=ddb_.BillingMode.PAY_PER_REQUEST,
+            partition_key=ddb_.Attribute(name="GenomeGuide", type=ddb_.AttributeType.STRING),
+            time_to_live_attribute="Expires"
+        )
+
         ### Lambda is an event-driven compute service.
         # Some lambda functions may need additional resources - these are provided via layers.
         # This layer provides the ISSL scoring binary.
@@ -233,12 +279,24 @@ class CracklingStack(Stack):
             removal_policy=RemovalPolicy.DESTROY
         )
 
-        ### Layer containing ncbi.datasets module and dependencies
+        ### Layer containing ncbi.datasets module and dependencies, and requests for ncbi_client. requests is
+        # installed here rather than taken from the requests layer, whose urllib3 2 ncbi.datasets does not support.
         lambdaLayerNcbi = lambda_.LayerVersion(self, "ncbi",
             code=lambda_.Code.from_asset("../layers/ncbi"),
             removal_policy=RemovalPolicy.DESTROY
         )
 
+        ### Layer containing NumPy, which the off-target extraction of isslCreation uses to find, pack, sort and merge
+        # off-targets (the binary format and numpy scanner are much slower without it)
+        lambdaLayerNumpy = lambda_.LayerVersion(self, "numpy",
+            code=lambda_.Code.from_asset("../layers/numpy"),
+            removal_policy=RemovalPolicy.DESTROY,
+            compatible_architectures=[lambda_.Architecture.X86_64],
+            compatible_runtimes=[
+                lambda_.Runtime.PYTHON_3_10
+            ]
+        )
+
         ### Layer containing the python script and binary required for building issl indices
         lambdaLayerIsslCreation = lambda_.LayerVersion(self, "isslCreationLayer",
             code=lambda_.Code.from_asset("../layers/isslCreation"),
@@ -309,6 +367,9 @@ class CracklingStack(Stack):
         ### Lambda function that acts as the entry point to the application.
         # This function creates a record in the DynamoDB jobs table.
         # MAX_SEQ_LENGTH defines the maximum length that the input genetic sequence can be.
+        # JOB_DEDUP_WINDOW_SECONDS defines how long a repeated submission returns the existing job (0 to disable).
+        # MAX_BATCH_REGIONS and MAX_BATCH_LENGTH limit the regions of a batch job (a multi-FASTA submission), which
+        # can be sent in the request or uploaded to the genome bucket first (see the CustomDataUpload function).
         # Read/write permissions on the jobs table needs to be granted to this function.
         lambdaCreateJob = lambda_.Function(self, "createJob", 
             runtime=lambda_.Runtime.PYTHON_3_10,
@@ -319,12 +380,20 @@ class CracklingStack(Stack):
             environment={
                 'JOBS_TABLE' : ddbJobs.table_name,
                 'MAX_SEQ_LENGTH' : '20000',
-                'TASK_TRACKING_TABLE' : ddbTaskTracking.table_name
+                'TASK_TRACKING_TABLE' : ddbTaskTracking.table_name,
+                'SUBMISSIONS_TABLE' : ddbSubmissions.table_name,
+                'JOB_DEDUP_WINDOW_SECONDS' : '3600',
+                'BUCKET' : s3GenomeAccess.attr_arn,
+                'MAX_BATCH_REGIONS' : '1000',
+                'MAX_BATCH_LENGTH' : '1000000'
             }
         )
 
         ddbJobs.grant_read_write_data(lambdaCreateJob)
         ddbTaskTracking.grant_read_write_data(lambdaCreateJob)
+        ddbSubmissions.grant_read_write_data(lambdaCreateJob)
+        s3Genome.grant_read(lambdaCreateJob)
+        lambdaCreateJob.add_to_role_policy(lambdaS3AccessPointIAM)
 
         ### Lambda function that return presigned URL to allow users to upload custom dataset to s3 genome storage
         lambdaCustomDataUpload = lambda_.Function(self, "CustomDataUpload", 
@@ -359,6 +428,11 @@ class CracklingStack(Stack):
                 'ISSL_QUEUE' : sqsIsslCreation.queue_url,
                 'TARGET_SCAN_QUEUE' : sqsTargetScan.queue_url,
                 'FILE_PARTS_QUEUE' : sqsGenomeParts.queue_url,
+                'GENOMES_TABLE' : ddbGenomes.table_name,
+                'JOBS_TABLE' : ddbJobs.table_name,
+                'TASK_TRACKING_TABLE' : ddbTaskTracking.table_name,
+                'FILE_PART_MB' : '32',
+                'FILE_PART_PARALLELISM' : '16',
                 'LD_LIBRARY_PATH' : ld_library_path,
                 'PATH' : path
             }
@@ -369,12 +443,22 @@ class CracklingStack(Stack):
         sqsIsslCreation.grant_send_messages(lambdaGenomeDownloadScheduler)
         sqsTargetScan.grant_send_messages(lambdaGenomeDownloadScheduler)
         sqsGenomeParts.grant_send_messages(lambdaGenomeDownloadScheduler)
+        ddbGenomes.grant_read_write_data(lambdaGenomeDownloadScheduler)
+        # jobs are marked as failed if their genome cannot be prepared
+        ddbJobs.grant_read_data(lambdaGenomeDownloadScheduler)
+        ddbTaskTracking.grant_read_write_data(lambdaGenomeDownloadScheduler)
 
+        # The child jobs of a batch job are prepared and scanned along with their parent, so they are not sent
+        # to the downloader.
         lambdaGenomeDownloadScheduler.add_event_source_mapping(
             "mapLdaDownloaderDdbJobs",
             event_source_arn=ddbJobs.table_stream_arn,
             retry_attempts=0,
-            starting_position=lambda_.StartingPosition.LATEST
+            starting_position=lambda_.StartingPosition.LATEST,
+            filters=[lambda_.FilterCriteria.filter({
+                # attributes of the image are typed, so the filter is on the string value of ParentJobID
+                "dynamodb" : {"NewImage" : {"ParentJobID" : {"S" : lambda_.FilterRule.not_exists()}}}
+            })]
         )
         s3Genome.grant_read_write(lambdaGenomeDownloadScheduler)   
         lambdaGenomeDownloadScheduler.add_to_role_policy(lambdaS3AccessPointIAM)
@@ -392,6 +476,10 @@ class CracklingStack(Stack):
             ephemeral_storage_size = cdk.Size.gibibytes(10), 
             environment={
                 'FILES_TABLE' : ddbGenomeParts.table_name,
+                'GENOMES_TABLE' : ddbGenomes.table_name,
+                'JOBS_TABLE' : ddbJobs.table_name,
+                'TASK_TRACKING_TABLE' : ddbTaskTracking.table_name,
+                'FILE_PART_WORKERS' : '8',
                 'BUCKET' : s3GenomeAccess.attr_arn,
                 'ISSL_QUEUE' : sqsIsslCreation.queue_url
             }
@@ -400,6 +488,9 @@ class CracklingStack(Stack):
         sqsGenomeParts.grant_consume_messages(lambdaGenomePartsDownloader)
         sqsIsslCreation.grant_send_messages(lambdaGenomePartsDownloader)
         ddbGenomeParts.grant_read_write_data(lambdaGenomePartsDownloader)
+        ddbGenomes.grant_read_write_data(lambdaGenomePartsDownloader)
+        ddbJobs.grant_read_data(lambdaGenomePartsDownloader)
+        ddbTaskTracking.grant_read_write_data(lambdaGenomePartsDownloader)
         s3Genome.grant_read_write(lambdaGenomePartsDownloader)
         lambdaGenomePartsDownloader.add_to_role_policy(lambdaS3AccessPointIAM)
 
@@ -415,22 +506,42 @@ class CracklingStack(Stack):
             runtime=lambda_.Runtime.PYTHON_3_10,
             handler="lambda_function.lambda_handler",
             code=lambda_.Code.from_asset("../modules/isslCreation"),
-            layers=[lambdaLayerIsslCreation, lambdaLayerCommonFuncs, lambdaLayerLib],
+            layers=[lambdaLayerIsslCreation, lambdaLayerCommonFuncs, lambdaLayerLib, lambdaLayerNumpy],
             vpc=cracklingVpc,
             timeout= duration,
             memory_size= 10240,
             ephemeral_storage_size = cdk.Size.gibibytes(10),
             environment={
                 'QUEUE' : sqsTargetScan.queue_url,
+                'ISSL_QUEUE' : sqsIsslCreation.queue_url,
+                'ISSL_BUILDS_TABLE' : ddbIsslBuilds.table_name,
+                'GENOMES_TABLE' : ddbGenomes.table_name,
+                'JOBS_TABLE' : ddbJobs.table_name,
+                'TASK_TRACKING_TABLE' : ddbTaskTracking.table_name,
                 'BUCKET' : s3GenomeAccess.attr_arn,
                 'LD_LIBRARY_PATH' : ld_library_path,
-                'PATH' : path
+                'PATH' : path,
+                'ISSL_MAP_REDUCE_FASTA_MB' : '256',
+                'ISSL_MAP_PIECE_MB' : '64',
+                'ISSL_STAGE_MARGIN_SECONDS' : '30',
+                'ISSL_SHARD_FASTA_MB' : '600',
+                'OFFTARGET_FORMAT' : 'binary',
+                'OFFTARGET_SCANNER' : 'numpy',
+                'SORT_MEMORY_MB' : '2048'
             }
         )
 
         s3Genome.grant_read_write(lambdaIsslCreation)
         sqsIsslCreation.grant_consume_messages(lambdaIsslCreation)
+        # the tasks of the map/reduce build of large genomes are started through the function's own queue
+        sqsIsslCreation.grant_send_messages(lambdaIsslCreation)
+        ddbIsslBuilds.grant_read_write_data(lambdaIsslCreation)
+        # jobs waiting for the genome are sent to targetScan once it is indexed
+        ddbGenomes.grant_read_write_data(lambdaIsslCreation)
         sqsTargetScan.grant_send_messages(lambdaIsslCreation)
+        # jobs are marked as failed if their genome cannot be indexed
+        ddbJobs.grant_read_data(lambdaIsslCreation)
+        ddbTaskTracking.grant_read_write_data(lambdaIsslCreation)
         lambdaIsslCreation.add_event_source_mapping(
             "mapppIsslCreation",
             event_source_arn=sqsIsslCreation.queue_arn,
@@ -459,15 +570,24 @@ class CracklingStack(Stack):
                 'ISSL_QUEUE' : sqsIssl.queue_url,
                 'LD_LIBRARY_PATH' : ld_library_path,
                 'JOBS_TABLE' : ddbJobs.table_name,
-                'PATH' : path
+                'PATH' : path,
+                'TARGETS_PER_MESSAGE' : '500',
+                'CONSENSUS_TARGETS_PER_MESSAGE' : '100',
+                'GENOMES_TABLE' : ddbGenomes.table_name,
+                'SCORE_CACHE_TABLE' : ddbScoreCache.table_name,
+                'BUCKET' : s3GenomeAccess.attr_arn
             }
         )
         sqsTargetScan.grant_consume_messages(lambdaTargetScan)
+        s3Genome.grant_read(lambdaTargetScan)
+        lambdaTargetScan.add_to_role_policy(lambdaS3AccessPointIAM)
         ddbTargets.grant_read_write_data(lambdaTargetScan)
         ddbTaskTracking.grant_read_write_data(lambdaTargetScan)
         ddbJobs.grant_read_write_data(lambdaTargetScan)
         sqsConsensus.grant_send_messages(lambdaTargetScan)
         sqsIssl.grant_send_messages(lambdaTargetScan)
+        ddbGenomes.grant_read_data(lambdaTargetScan)
+        ddbScoreCache.grant_read_data(lambdaTargetScan)
         lambdaTargetScan.add_event_source_mapping(
             "mapSqsTargetScan",
             event_source_arn=sqsTargetScan.queue_arn,
@@ -476,6 +596,8 @@ class CracklingStack(Stack):
 
         ### Lambda function to assess guide efficiency
         # This function consumes messages in the SQS consensus queue.
+        # Each message is an envelope of up to CONSENSUS_TARGETS_PER_MESSAGE guides, which is as many guides as
+        # an invocation scored when each message held one guide, so messages are not batched.
         # The results are written to the DynamoDB consensus table.
         lambdaConsensus = lambda_.Function(self, "consensus", 
             runtime=lambda_.Runtime.PYTHON_3_10,
@@ -491,7 +613,8 @@ class CracklingStack(Stack):
                 'TASK_TRACKING_TABLE' : ddbTaskTracking.table_name,
                 'JOBS_TABLE' : ddbJobs.table_name,
                 'CONSENSUS_QUEUE' : sqsConsensus.queue_url, 
-                'BUCKET' : s3GenomeAccess.attr_arn
+                'BUCKET' : s3GenomeAccess.attr_arn,
+                'SCORE_CACHE_TABLE' : ddbScoreCache.table_name
             }
         )
 
@@ -503,16 +626,18 @@ class CracklingStack(Stack):
         lambdaConsensus.add_event_source_mapping(
             "mapLdaConsesusSqsConsensus",
             event_source_arn=sqsConsensus.queue_arn,
-            batch_size=100,
-            max_batching_window=Duration.seconds(10)
+            batch_size=1
         )
         ddbTargets.grant_read_write_data(lambdaConsensus)
         ddbTaskTracking.grant_read_write_data(lambdaConsensus)
         ddbJobs.grant_read_write_data(lambdaConsensus)
+        ddbScoreCache.grant_read_write_data(lambdaConsensus)
 
 
         ### Lambda function that assesses guide specificity using ISSL.
         # This function consumes messages in the SQS Issl queue.
+        # Each message is an envelope of up to TARGETS_PER_MESSAGE guides, so a batch of 10 messages
+        # is scored with a single call to the ISSL binary.
         # The results are written to the DynamoDB consensus table.
         lambdaIssl = lambda_.Function(self, "issl", 
             runtime=lambda_.Runtime.PYTHON_3_10,
@@ -529,6 +654,8 @@ class CracklingStack(Stack):
                 'TARGETS_TABLE' : ddbTargets.table_name,
                 'JOBS_TABLE' : ddbJobs.table_name,
                 'ISSL_QUEUE' : sqsIssl.queue_url,
+                'GENOMES_TABLE' : ddbGenomes.table_name,
+                'SCORE_CACHE_TABLE' : ddbScoreCache.table_name,
                 'LD_LIBRARY_PATH' : ld_library_path,
                 'PATH' : path
             }
@@ -544,6 +671,8 @@ class CracklingStack(Stack):
         ddbJobs.grant_read_write_data(lambdaIssl)
         ddbTaskTracking.grant_read_write_data(lambdaIssl)
         ddbTargets.grant_read_write_data(lambdaIssl)
+        ddbGenomes.grant_read_data(lambdaIssl)
+        ddbScoreCache.grant_read_write_data(lambdaIssl)
         s3Genome.grant_read_write(lambdaIssl)
         lambdaIssl.add_to_role_policy(lambdaS3AccessPointIAM)
 
@@ -735,7 +864,8 @@ class CracklingStack(Stack):
                                     '       "NumGuides": $task.NumGuides.N,'
                                     '       "NumScoredOntarget": $task.NumScoredOntarget.N,'
                                     '       "NumScoredOfftarget": $task.NumScoredOfftarget.N,'
-                                    '       "Version": $task.Version.N'
+                                    '       "Version": $task.Version.N,'
+                                    '       "Error": "$util.escapeJavaScript($!task.Error.S)"'
                                     '   }#if($foreach.hasNext),#end'
                                     '   #end'
                                     ']'
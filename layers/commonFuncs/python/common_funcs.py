@@ -1,18 +1,107 @@
 from genericpath import isfile
-import os, re, shutil, tempfile, boto3, json, sys
+import os, re, shutil, tempfile, boto3, json, sys, random, zlib, hashlib
 from unicodedata import name
 
 from time import time, time_ns, sleep
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event
+from queue import Queue, Full
+from boto3.s3.transfer import TransferConfig
+from boto3.dynamodb.types import TypeSerializer
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 # Time variable for faux-context
 starttime = time_ns()
 timeout = 10800
 
+# SQS accepts at most 10 entries and 256 KiB of payload per SendMessageBatch request
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_BATCH_BYTES = 262144
+# Number of SendMessageBatch requests in flight at once
+SQS_SEND_WORKERS = 16
+# Number of times to resend the entries of a batch that SQS reports as failed
+SQS_SEND_RETRIES = 5
+
+# Number of times a throttled DynamoDB request is retried before giving up
+DYNAMODB_RETRIES = 8
+# DynamoDB errors that succeed when the request is retried later
+DYNAMODB_RETRYABLE_ERRORS = [
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'InternalServerError',
+    'TransactionConflictException'
+]
+# Number of UpdateItem requests in flight when writing a batch of results
+DYNAMODB_WRITE_WORKERS = 16
+
+# Version of the multi-guide envelope sent to the ISSL and consensus queues
+TARGET_ENVELOPE_VERSION = 2
+# Maximum number of guides packed into a single envelope
+TARGET_ENVELOPE_MAX_TARGETS = 500
+# SQS rejects messages larger than 256 KiB, keep some headroom
+TARGET_ENVELOPE_MAX_BYTES = 240000
+
+# Genomes with more FASTA than this (MB) are indexed as several ISSL shards, each built by its own invocation
+ISSL_SHARD_FASTA_MB = int(os.getenv('ISSL_SHARD_FASTA_MB', 600))
+
+# A job that claimed the download and indexing of a genome holds it for this long (seconds) after its last
+# progress, after which another job may take over
+GENOME_LOCK_LEASE_SECONDS = int(os.getenv('GENOME_LOCK_LEASE_SECONDS', 1800))
+# Sort keys of the items holding a genome's lock, its manifest and its NCBI listing (see ncbi_client.py). The
+# genome's other items, whose sort keys never start with '#', are the jobs waiting for it.
+GENOME_LOCK_ITEM = '#LOCK'
+GENOME_MANIFEST_ITEM = '#MANIFEST'
+GENOME_NCBI_ITEM = '#NCBI'
+
+# Scores of guides against genomes are cached for this long (seconds)
+SCORE_CACHE_TTL_SECONDS = int(os.getenv('SCORE_CACHE_TTL_SECONDS', 7776000))
+# BatchGetItem reads at most 100 items per request
+DYNAMODB_BATCH_GET_KEYS = 100
+
+# Multi-FASTA files of batch jobs are uploaded to the genome bucket under this prefix (see customData and createJob)
+BATCH_UPLOAD_PREFIX = '_batches/'
+
+# CloudWatch namespace for metrics published by the lambda functions
+METRICS_NAMESPACE = 'Crackling'
+
+# Size of each byte-range GET when downloading a large object from S3
+S3_DOWNLOAD_PART_SIZE = int(os.getenv('S3_DOWNLOAD_PART_SIZE_MB', 64)) * 1048576
+# Number of byte-range GETs in flight for a single object
+S3_DOWNLOAD_CONCURRENCY = int(os.getenv('S3_DOWNLOAD_CONCURRENCY', 16))
+# Number of objects downloaded at the same time
+S3_DOWNLOAD_FILE_WORKERS = int(os.getenv('S3_DOWNLOAD_FILE_WORKERS', 4))
+# Size of the chunks read from a streamed S3 object, and how many are read ahead of the consumer
+S3_STREAM_CHUNK_SIZE = 8 * 1048576
+S3_STREAM_PREFETCH = 4
+# Largest chunk of decompressed data produced at once when streaming a gzip file
+GUNZIP_CHUNK_SIZE = 4 * 1048576
+
 def get_tmp_dir():
     return tempfile.mkdtemp()
 
+# Publish metrics by logging them in the CloudWatch embedded metric format (no API calls required)
+def emit_metrics(component, metrics, units = None):
+    units = units or {}
+    print(json.dumps({
+        '_aws' : {
+            'Timestamp' : int(time() * 1000),
+            'CloudWatchMetrics' : [{
+                'Namespace' : METRICS_NAMESPACE,
+                'Dimensions' : [['Component']],
+                'Metrics' : [
+                    {'Name' : name, 'Unit' : units.get(name, 'Count')}
+                    for name in metrics
+                ]
+            }]
+        },
+        'Component' : component,
+        **metrics
+    }))
+
 ##########################################################
 def s3_fna_dir_size(s3_client,s3_bucket,path):
     filesize = 0
@@ -38,6 +127,110 @@ def s3_get_file_size(s3_client, s3_bucket, path):
     filesize = response['ContentLength']
     return filesize
 
+# S3 client with enough pooled connections for every concurrent byte-range GET
+def s3_transfer_client():
+    return boto3.client('s3', config=Config(
+        max_pool_connections=S3_DOWNLOAD_FILE_WORKERS * S3_DOWNLOAD_CONCURRENCY
+    ))
+
+# Download an object from S3, fetching large objects as parallel byte-range GETs.
+# Returns the achieved throughput.
+def s3_download_file(s3_client, s3_bucket, key, fp, part_size=S3_DOWNLOAD_PART_SIZE, concurrency=S3_DOWNLOAD_CONCURRENCY):
+    config = TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=concurrency,
+        use_threads=True
+    )
+
+    start = time()
+    s3_client.download_file(s3_bucket, key, fp, Config=config)
+    seconds = max(time() - start, 1e-6)
+    size = os.path.getsize(fp)
+
+    print(f"Downloaded {key} ({size / 1048576:,.1f} MB) in {seconds:.1f}s: {size / 1048576 / seconds:,.1f} MB/s")
+    emit_metrics('S3Download', {
+        'DownloadBytes' : size,
+        'DownloadThroughput' : size / seconds
+    }, units = {'DownloadBytes' : 'Bytes', 'DownloadThroughput' : 'Bytes/Second'})
+
+    return {'Key' : key, 'Path' : fp, 'Bytes' : size, 'Seconds' : seconds}
+
+# Yield the body of an S3 object in chunks, without writing it to disk. A background thread downloads up to
+# `prefetch` chunks ahead, so the download overlaps with whatever the caller does with each chunk.
+def s3_stream_chunks(s3_client, s3_bucket, key, chunk_size=S3_STREAM_CHUNK_SIZE, prefetch=S3_STREAM_PREFETCH):
+    chunks = Queue(maxsize=prefetch)
+    stop = Event()
+
+    def reader():
+        try:
+            body = s3_client.get_object(Bucket=s3_bucket, Key=key)['Body']
+            for chunk in body.iter_chunks(chunk_size):
+                # give up if the consumer has stopped reading
+                while not stop.is_set():
+                    try:
+                        chunks.put(chunk, timeout=1)
+                        break
+                    except Full:
+                        continue
+                if stop.is_set():
+                    body.close()
+                    return
+            chunks.put(None)
+        except Exception as e:
+            chunks.put(e)
+
+    Thread(target=reader, daemon=True).start()
+
+    start = time()
+    size = 0
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            size += len(chunk)
+            yield chunk
+    finally:
+        stop.set()
+
+    seconds = max(time() - start, 1e-6)
+    print(f"Streamed {key} ({size / 1048576:,.1f} MB) in {seconds:.1f}s: {size / 1048576 / seconds:,.1f} MB/s")
+    emit_metrics('S3Stream', {
+        'StreamBytes' : size,
+        'StreamThroughput' : size / seconds
+    }, units = {'StreamBytes' : 'Bytes', 'StreamThroughput' : 'Bytes/Second'})
+
+# Decompress a stream of gzip data given as chunks, yielding chunks of at most `chunk_size` bytes.
+# Files made of several gzip members (e.g. concatenated or bgzip files) are decompressed member by member.
+def gunzip_chunks(chunks, chunk_size=GUNZIP_CHUNK_SIZE):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for data in chunks:
+        while data:
+            out = decompressor.decompress(data, chunk_size)
+            if out:
+                yield out
+            if decompressor.eof:
+                # the start of the next member, if there is one (unused_data holds all of the remaining input)
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = decompressor.unconsumed_tail
+    yield decompressor.flush()
+
+# Download many objects concurrently. `downloads` is a list of (key, local file path) pairs.
+def s3_download_files(s3_client, s3_bucket, downloads, max_workers=S3_DOWNLOAD_FILE_WORKERS, part_size=S3_DOWNLOAD_PART_SIZE, concurrency=S3_DOWNLOAD_CONCURRENCY):
+    if not downloads:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(downloads))) as executor:
+        return list(executor.map(
+            lambda download: s3_download_file(s3_client, s3_bucket, download[0], download[1], part_size, concurrency),
+            downloads
+        ))
+
 # Upload directory of files to S3 bucket
 def upload_dir_to_s3(s3_client,s3_bucket,path,s3_folder):
     #upload files individually to s3
@@ -52,7 +245,16 @@ def upload_dir_to_s3(s3_client,s3_bucket,path,s3_folder):
     # close temp directory
     print("Cleaning Up...")
     shutil.rmtree(path)
-     
+
+# Delete every object under a prefix, e.g. the intermediate files of a finished build
+def s3_delete_prefix(s3_client, s3_bucket, prefix):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=s3_bucket, Prefix=prefix):
+        keys = [{'Key' : obj['Key']} for obj in page.get('Contents', [])]
+        if keys:
+            # a page holds at most 1000 keys, as many as one request can delete
+            s3_client.delete_objects(Bucket=s3_bucket, Delete={'Objects' : keys, 'Quiet' : True})
+
 def s3_object_exists(s3_client, s3_bucket, key):
     try:
         s3_client.head_object(Bucket=s3_bucket, Key=key)
@@ -75,6 +277,49 @@ def issl_files_exist_s3(s3_client, s3_bucket, accession_list):
             return False
     return True
 
+# Name of one shard of a genome's ISSL index. Its index file is `{accession}/issl/{name}.issl`.
+def issl_shard_name(accession, shard, num_shards):
+    return f"{accession}.shard{shard + 1}of{num_shards}"
+
+# Key of the manifest listing the shards of a genome's ISSL index. It is written once every shard is built.
+def issl_shards_key(accession):
+    return f"{accession}/issl/{accession}.shards.json"
+
+# Names of the ISSL index files of an accession (`{accession}/issl/{name}.issl`): the accession itself for a
+# single index, or every shard listed in the shard manifest. Returns None if the index has not been built.
+def issl_index_names(s3_client, s3_bucket, accession):
+    if s3_object_exists(s3_client, s3_bucket, f"{accession}/issl/{accession}.issl"):
+        return [accession]
+
+    try:
+        manifest = json.loads(s3_client.get_object(Bucket=s3_bucket, Key=issl_shards_key(accession))['Body'].read())
+    except ClientError:
+        return None
+    return manifest['Shards']
+
+# Write the shard manifest of a genome's ISSL index, once every shard is built. Any manifest of an earlier build
+# is replaced, and writing it again (e.g. when the last task is redelivered) is harmless.
+def issl_write_shards(s3_client, s3_bucket, accession, num_shards):
+    names = [issl_shard_name(accession, shard, num_shards) for shard in range(num_shards)]
+    s3_client.put_object(
+        Bucket=s3_bucket,
+        Key=issl_shards_key(accession),
+        Body=json.dumps({'Accession' : accession, 'NumShards' : num_shards, 'Shards' : names})
+    )
+    return names
+
+# Combine the ISSL scores of a guide against each shard of an index into its score against the whole index.
+# The scorer reports 10000 / (100 + T), where T is a sum over the off-targets found, so the sums of the shards
+# (which hold disjoint off-targets) add up. A guide that was not scored by every shard has no score.
+def combine_issl_scores(scores):
+    if any(score is None for score in scores):
+        return None
+    if len(scores) == 1:
+        return scores[0]
+    if any(score <= 0 for score in scores):
+        return 0.0
+    return 10000.0 / (100.0 + sum(10000.0 / score - 100.0 for score in scores))
+
 # Provide list of files to check if they exist in a directory
 def files_exist_s3_dir(s3_client, s3_bucket, s3_path, files_to_expect):
     # expected files exist
@@ -93,6 +338,105 @@ def sqs_send_message(sqsURL, msg):
         MessageBody=msg
     )
 
+# Group message bodies into chunks that fit in one SendMessageBatch request
+def sqs_batch_messages(msgs):
+    batch = []
+    batchBytes = 0
+    for msg in msgs:
+        msgBytes = len(msg.encode('utf-8'))
+        if batch and (len(batch) == SQS_MAX_BATCH_ENTRIES or batchBytes + msgBytes > SQS_MAX_BATCH_BYTES):
+            yield batch
+            batch = []
+            batchBytes = 0
+        batch.append(msg)
+        batchBytes += msgBytes
+    if batch:
+        yield batch
+
+# Send one batch of messages, resending only the entries that failed.
+# Returns the entries that could not be delivered.
+def sqs_send_batch(sqs_client, sqsURL, msgs, retries=SQS_SEND_RETRIES):
+    pending = {str(i) : msg for i, msg in enumerate(msgs)}
+    undelivered = []
+
+    for attempt in range(retries + 1):
+        response = sqs_client.send_message_batch(
+            QueueUrl=sqsURL,
+            Entries=[
+                {'Id' : entryId, 'MessageBody' : msg}
+                for entryId, msg in pending.items()
+            ]
+        )
+
+        retry = {}
+        for failure in response.get('Failed', []):
+            # sender faults (e.g., malformed message) will fail again if resent
+            if failure.get('SenderFault', False):
+                print(f"Message rejected by SQS: {failure}")
+                undelivered.append(pending[failure['Id']])
+            else:
+                retry[failure['Id']] = pending[failure['Id']]
+
+        pending = retry
+        if not pending:
+            break
+        # exponential backoff before resending the failed entries
+        sleep(min(0.1 * 2 ** attempt, 5))
+
+    return undelivered + list(pending.values())
+
+# Send many messages to a queue using batched requests through a bounded thread pool
+def sqs_send_messages(sqs_client, sqsURL, msgs, max_workers=SQS_SEND_WORKERS):
+    batches = list(sqs_batch_messages(msgs))
+    undelivered = []
+
+    if not batches:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+        for failed in executor.map(lambda batch: sqs_send_batch(sqs_client, sqsURL, batch), batches):
+            undelivered.extend(failed)
+
+    if undelivered:
+        raise RuntimeError(f"Failed to send {len(undelivered)} of {len(msgs)} messages to {sqsURL}")
+
+    return len(msgs)
+
+# Pack the guides of one job into versioned envelopes, each small enough for a single SQS message
+def pack_target_envelopes(jobID, genome, targetEntries, max_targets=TARGET_ENVELOPE_MAX_TARGETS, max_bytes=TARGET_ENVELOPE_MAX_BYTES):
+    header = {
+        'Version' : TARGET_ENVELOPE_VERSION,
+        'JobID' : jobID,
+        'Genome' : genome
+    }
+    headerBytes = len(json.dumps(header).encode('utf-8')) + len(', "Targets": []')
+
+    chunk = []
+    chunkBytes = headerBytes
+    for entry in targetEntries:
+        # the job is recorded once in the envelope header rather than in every guide
+        entry = {k : v for k, v in entry.items() if k != 'JobID'}
+        entryBytes = len(json.dumps(entry).encode('utf-8')) + 2
+        if chunk and (len(chunk) == max_targets or chunkBytes + entryBytes > max_bytes):
+            yield json.dumps({**header, 'Targets' : chunk})
+            chunk = []
+            chunkBytes = headerBytes
+        chunk.append(entry)
+        chunkBytes += entryBytes
+    if chunk:
+        yield json.dumps({**header, 'Targets' : chunk})
+
+# Decode a message from the ISSL or consensus queue into its genome and list of guides.
+# Accepts both the versioned envelope and the legacy single-guide message.
+def unpack_target_envelope(msg):
+    if 'Version' in msg:
+        if msg['Version'] != TARGET_ENVELOPE_VERSION:
+            raise ValueError(f"Unsupported target envelope version: {msg['Version']}")
+        return msg['Genome'], [{**target, 'JobID' : msg['JobID']} for target in msg['Targets']]
+
+    # legacy format: {'default': json.dumps(targetEntry), 'genome': json.dumps(genome)}
+    return json.loads(msg['genome']), [json.loads(msg['default'])]
+
 # Convert event to python dictionary
 def recv(event):
     for record in event['Records']:
@@ -125,56 +469,411 @@ def local_lambda_invocation(genome,sequence,jobid):
 
     return event, context
 
-# perform an action on a job object from dydb, then perform a set on dydb in a threadsafe manner
-def set_job_table(dynamoDbClient, tableName, action, jobID):
-    # keep trying to add data too db until 
-    from boto3.dynamodb.conditions import Attr
-    table = dynamoDbClient.Table(tableName)
+# Call a DynamoDB API, retrying throttled requests with exponential backoff and jitter.
+# Returns the response and the number of retries that were needed.
+def dynamodb_call_with_backoff(fn, retries=DYNAMODB_RETRIES, **kwargs):
+    for attempt in range(retries + 1):
+        try:
+            return fn(**kwargs), attempt
+        except ClientError as err:
+            if err.response["Error"]["Code"] not in DYNAMODB_RETRYABLE_ERRORS or attempt == retries:
+                raise err
+            sleep(random.uniform(0, min(0.05 * 2 ** attempt, 5)))
+
+# Apply many UpdateItem requests concurrently through a bounded thread pool, retrying throttled requests.
+# Each update is a dict of UpdateItem arguments (Key, UpdateExpression, ExpressionAttributeValues, ...) using
+# plain python values. The low-level client is used as it is safe to share between threads.
+def dynamodb_update_items(dynamodb_client, tableName, updates, max_workers=DYNAMODB_WRITE_WORKERS):
+    serializer = TypeSerializer()
 
-    while True:    
-        #get current job
-        job = table.get_item(Key={"JobID" : str(jobID)})['Item']
+    def update(item):
+        request = dict(item)
+        for field in ['Key', 'ExpressionAttributeValues']:
+            if field in request:
+                request[field] = {k : serializer.serialize(v) for k, v in request[field].items()}
+        try:
+            _, retries = dynamodb_call_with_backoff(dynamodb_client.update_item, TableName=tableName, **request)
+            return retries, None
+        except ClientError as err:
+            print(f"Failed to update {item['Key']}: {err}")
+            return DYNAMODB_RETRIES, item
 
-        # get current version, then increment to next version
-        currentVersion = job["Version"]
-        job["Version"] += 1
+    if not updates:
+        return 0
 
-        # perform some action on the job object
-        job = action(job)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(updates))) as executor:
+        results = list(executor.map(update, updates))
 
-        try:
-            # Attempt to update the DB, if job has been overwritten since it was
-            # retrieved, this statement will error, and we can get data again and 
-            # start from beginning
-            table.put_item(
-                Item=job,
-                ConditionExpression=Attr("Version").eq(currentVersion)
-            )
+    failed = [item for _, item in results if item is not None]
+    emit_metrics('ResultWrites', {
+        'ResultWrites' : len(updates) - len(failed),
+        'ResultWriteRetries' : sum(retries for retries, _ in results),
+        'ResultWriteFailures' : len(failed)
+    })
 
-            return job # return the up to date job
+    if failed:
+        raise RuntimeError(f"Failed to write {len(failed)} of {len(updates)} results to {tableName}")
 
-        except ClientError as err:
-            #data has been access since fetched, keep looping
-            if err.response["Error"]["Code"] != 'ConditionalCheckFailedException':
-                # if the error isn't a result of concurrent access, raise it
-                    raise err
+    return len(updates)
+
+# Read many items of a table with BatchGetItem, 100 keys per request. Returns the items found, in no particular order.
+def dynamodb_batch_get(dynamoDbClient, tableName, keys):
+    found = []
+    for i in range(0, len(keys), DYNAMODB_BATCH_GET_KEYS):
+        request = {tableName : {'Keys' : keys[i:i + DYNAMODB_BATCH_GET_KEYS]}}
+        attempt = 0
+        while request:
+            response, _ = dynamodb_call_with_backoff(dynamoDbClient.batch_get_item, RequestItems=request)
+            found += response['Responses'].get(tableName, [])
+
+            # keys that were not read (e.g. throttled) are requested again
+            request = response.get('UnprocessedKeys')
+            if request:
+                sleep(random.uniform(0, min(0.05 * 2 ** attempt, 5)))
+                attempt += 1
+    return found
+
+# Atomically add to one or more counters of a job using a single UpdateItem.
+# `increments` maps counter names to the amount to add, so callers can aggregate a whole batch into one write.
+def increment_job_counters(dynamoDbClient, tableName, jobID, increments):
+    table = dynamoDbClient.Table(tableName)
+    fields = list(increments)
+
+    response, retries = dynamodb_call_with_backoff(
+        table.update_item,
+        Key={"JobID" : str(jobID)},
+        UpdateExpression="ADD " + ", ".join([f"#f{i} :v{i}" for i in range(len(fields))] + ["Version :one"]),
+        ExpressionAttributeNames={f"#f{i}" : field for i, field in enumerate(fields)},
+        ExpressionAttributeValues={
+            **{f":v{i}" : increments[field] for i, field in enumerate(fields)},
+            ":one" : 1
+        },
+        ReturnValues="ALL_NEW"
+    )
 
+    emit_metrics('JobCounters', {'CounterWrites' : 1, 'CounterRetries' : retries})
+
+    return response['Attributes'] # return the up to date job
 
 # Thread safe function to set the total number of tasks (to be completed) in jobs table
 def set_task_total(dynamoDbClient, tableName, jobID, taskCount):
+    table = dynamoDbClient.Table(tableName)
 
-    def setNumGuides(job):
-        job["NumGuides"] = taskCount
-        return job
-    
-    return set_job_table(dynamoDbClient, tableName, setNumGuides, jobID)
+    response, retries = dynamodb_call_with_backoff(
+        table.update_item,
+        Key={"JobID" : str(jobID)},
+        UpdateExpression="SET NumGuides = :n ADD Version :one",
+        ExpressionAttributeValues={":n" : taskCount, ":one" : 1},
+        ReturnValues="ALL_NEW"
+    )
+
+    emit_metrics('JobCounters', {'CounterWrites' : 1, 'CounterRetries' : retries})
+
+    return response['Attributes']
 
 
+# Credit a job with the targets found in the score cache (`hits` maps counters, e.g. NumScoredOfftarget, to the
+# number of targets found). The numbers credited are recorded on the job's task tracking item, and a job that is
+# scanned again (e.g. a retried message) is only credited the difference, so cached targets are counted once.
+def credit_cached_scores(dynamoDbClient, tableName, jobID, hits):
+    table = dynamoDbClient.Table(tableName)
+    while True:
+        item = table.get_item(Key={"JobID" : str(jobID)}, ConsistentRead=True).get('Item', {})
+        credited = item.get('CachedScores')
+        increments = {field : count - int((credited or {}).get(field, 0)) for field, count in hits.items()}
+        if not any(increments.values()):
+            return
+
+        fields = list(increments)
+        try:
+            table.update_item(
+                Key={"JobID" : str(jobID)},
+                UpdateExpression="SET CachedScores = :hits ADD " + ", ".join([f"#f{i} :v{i}" for i in range(len(fields))] + ["Version :one"]),
+                # the item is only updated if no other scan credited the job since it was read
+                ConditionExpression="attribute_not_exists(CachedScores)" if credited is None else "CachedScores = :credited",
+                ExpressionAttributeNames={f"#f{i}" : field for i, field in enumerate(fields)},
+                ExpressionAttributeValues={
+                    **{f":v{i}" : increments[field] for i, field in enumerate(fields)},
+                    ":hits" : hits,
+                    ":one" : 1,
+                    **({":credited" : credited} if credited is not None else {})
+                }
+            )
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
 # Thread safe function to update the task counter in jobs table
 def update_task_counter(dynamoDbClient, tableName, jobID, field, taskCount):
-    
-    def updateCompletedTasks(job):    
-        job[field] += taskCount
-        return job
-    
-    return set_job_table(dynamoDbClient, tableName, updateCompletedTasks, jobID)
+    return increment_job_counters(dynamoDbClient, tableName, jobID, {field : taskCount})
+
+
+# Per-genome build lock. The first job that needs a genome downloaded or indexed claims it (DOWNLOADING, then
+# INDEXING, then READY), and jobs that need it in the meantime wait for it rather than repeating the work.
+# Returns True if the lock was claimed. It can also be claimed once its lease has expired (its owner stopped
+# making progress), if it is READY while the index is missing, or again by its owner (e.g. a retried job).
+def genome_lock_claim(dynamoDbClient, tableName, accession, jobID, status):
+    now = int(time())
+    try:
+        dynamoDbClient.Table(tableName).put_item(
+            Item={
+                'Genome' : accession,
+                'Item' : GENOME_LOCK_ITEM,
+                'Owner' : str(jobID),
+                'Status' : status,
+                'Claimed' : now,
+                'LeaseExpires' : now + GENOME_LOCK_LEASE_SECONDS
+            },
+            ConditionExpression="attribute_not_exists(Genome) OR LeaseExpires < :now OR #status = :ready OR #owner = :owner",
+            ExpressionAttributeNames={'#status' : 'Status', '#owner' : 'Owner'},
+            ExpressionAttributeValues={':now' : now, ':ready' : 'READY', ':owner' : str(jobID)}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+# Extend the lease of a genome lock held by a job, optionally moving it to a new status.
+# Returns False if the job no longer holds the lock.
+def genome_lock_renew(dynamoDbClient, tableName, accession, jobID, status=None):
+    try:
+        dynamoDbClient.Table(tableName).update_item(
+            Key={'Genome' : accession, 'Item' : GENOME_LOCK_ITEM},
+            UpdateExpression="SET LeaseExpires = :lease" + (", #status = :status" if status else ""),
+            ConditionExpression="#owner = :owner AND #status <> :failed",
+            ExpressionAttributeNames={'#owner' : 'Owner', '#status' : 'Status'},
+            ExpressionAttributeValues={
+                ':lease' : int(time()) + GENOME_LOCK_LEASE_SECONDS,
+                ':owner' : str(jobID),
+                ':failed' : 'FAILED',
+                **({':status' : status} if status else {})
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print(f"Job {jobID} no longer holds the lock of {accession}")
+            return False
+        raise
+    return True
+
+# Register a job to be sent to `sqsURL` (with message `msg`) once the genome is READY. Returns False if the
+# preparation of the genome failed before the job was registered, in which case the job is not registered and
+# should claim the lock again.
+def genome_lock_wait(dynamoDbClient, tableName, accession, jobID, msg, sqsURL):
+    table = dynamoDbClient.Table(tableName)
+    table.put_item(Item={'Genome' : accession, 'Item' : str(jobID), 'Body' : msg, 'Registered' : int(time())})
+
+    # the genome may have become READY (or failed) before the job was registered, in which case nobody else will
+    # release it
+    lock = table.get_item(Key={'Genome' : accession, 'Item' : GENOME_LOCK_ITEM}, ConsistentRead=True).get('Item')
+    if lock is not None and lock['Status'] == 'READY':
+        genome_lock_release(dynamoDbClient, tableName, accession, sqsURL)
+    elif lock is not None and lock['Status'] == 'FAILED':
+        response = table.delete_item(Key={'Genome' : accession, 'Item' : str(jobID)}, ReturnValues='ALL_OLD')
+        # the job was already taken by whoever failed the genome if it is gone
+        return 'Attributes' not in response
+    return True
+
+# Mark a genome READY and release the jobs waiting for it
+def genome_lock_ready(dynamoDbClient, tableName, accession, sqsURL):
+    dynamoDbClient.Table(tableName).update_item(
+        Key={'Genome' : accession, 'Item' : GENOME_LOCK_ITEM},
+        UpdateExpression="SET #status = :ready, Ready = :now",
+        ExpressionAttributeNames={'#status' : 'Status'},
+        ExpressionAttributeValues={':ready' : 'READY', ':now' : int(time())}
+    )
+    return genome_lock_release(dynamoDbClient, tableName, accession, sqsURL)
+
+# Send every job waiting for a genome to `sqsURL`
+def genome_lock_release(dynamoDbClient, tableName, accession, sqsURL):
+    msgs = genome_lock_take_waiters(dynamoDbClient, tableName, accession)
+    if msgs:
+        print(f"Releasing {len(msgs)} job(s) waiting for {accession}")
+        sqs_send_messages(boto3.client('sqs'), sqsURL, msgs)
+    return len(msgs)
+
+# Mark the preparation of a genome by job `jobID` as failed. The lock can then be claimed by the next job for the
+# genome, and the jobs waiting for it are taken. Returns the IDs of the failed jobs: the job itself, and the
+# waiters if it still held the lock (see `fail_jobs`).
+def genome_lock_fail(dynamoDbClient, tableName, accession, jobID):
+    try:
+        dynamoDbClient.Table(tableName).update_item(
+            Key={'Genome' : accession, 'Item' : GENOME_LOCK_ITEM},
+            UpdateExpression="SET #status = :failed, LeaseExpires = :expired",
+            ConditionExpression="#owner = :owner",
+            ExpressionAttributeNames={'#owner' : 'Owner', '#status' : 'Status'},
+            ExpressionAttributeValues={':failed' : 'FAILED', ':expired' : 0, ':owner' : str(jobID)}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print(f"Job {jobID} no longer holds the lock of {accession}")
+            return [str(jobID)]
+        raise
+
+    msgs = genome_lock_take_waiters(dynamoDbClient, tableName, accession)
+    return [str(jobID)] + [json.loads(msg)['JobID'] for msg in msgs]
+
+# Take the jobs waiting for a genome, returning their messages. Each waiter is deleted before it is returned and
+# only returned to whoever deleted it, so a job is taken once even when several callers release the same genome.
+def genome_lock_take_waiters(dynamoDbClient, tableName, accession):
+    table = dynamoDbClient.Table(tableName)
+    waiters = []
+    # a strongly consistent read, so that a job that registered just before the genome became READY (and so
+    # relies on being released here, see genome_lock_wait) is always found
+    kwargs = {'KeyConditionExpression' : Key('Genome').eq(accession), 'ConsistentRead' : True}
+    while True:
+        response = table.query(**kwargs)
+        waiters.extend(item for item in response['Items'] if not item['Item'].startswith('#'))
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    msgs = []
+    for waiter in waiters:
+        response = table.delete_item(Key={'Genome' : accession, 'Item' : waiter['Item']}, ReturnValues='ALL_OLD')
+        if 'Attributes' in response:
+            msgs.append(response['Attributes']['Body'])
+    return msgs
+
+# Mark jobs as failed with the reason `error`, which is shown with their progress (the Error attribute of their task
+# tracking items). The child jobs of batch jobs are failed with them. Jobs without a task tracking item (batch jobs
+# themselves) are skipped, rather than given an item with only an Error.
+def fail_jobs(dynamoDbClient, jobsTableName, taskTableName, jobIDs, error):
+    jobIDs = set(jobIDs)
+    for job in dynamodb_batch_get(dynamoDbClient, jobsTableName, [{'JobID' : jobID} for jobID in jobIDs]):
+        jobIDs.update(region['JobID'] for region in job.get('Regions', []))
+
+    table = dynamoDbClient.Table(taskTableName)
+    for jobID in jobIDs:
+        try:
+            table.update_item(
+                Key={'JobID' : jobID},
+                UpdateExpression="SET #error = :error",
+                ConditionExpression="attribute_exists(JobID)",
+                ExpressionAttributeNames={'#error' : 'Error'},
+                ExpressionAttributeValues={':error' : error}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    print(f"Failed job(s) {sorted(jobIDs)}: {error}")
+
+
+# The manifest of a genome records what is in S3 for it: each FASTA file (key, size and ETag) as its upload
+# completes, and the ISSL index files once they are built. Reading it replaces listing and probing the genome's
+# folders in S3. Returns None for genomes without one (e.g. uploaded as custom data), whose files can only be
+# found in S3.
+def genome_manifest(dynamoDbClient, tableName, accession):
+    return dynamoDbClient.Table(tableName).get_item(
+        Key={'Genome' : accession, 'Item' : GENOME_MANIFEST_ITEM},
+        ConsistentRead=True
+    ).get('Item')
+
+# Start the manifest of a genome that is being downloaded as the FASTA files `file_names`. Any ISSL index
+# already recorded is kept, along with its version, until the genome is indexed again.
+def genome_manifest_start(dynamoDbClient, tableName, accession, file_names):
+    dynamoDbClient.Table(tableName).update_item(
+        Key={'Genome' : accession, 'Item' : GENOME_MANIFEST_ITEM},
+        UpdateExpression="SET NumFastaFiles = :n, Fasta = :fasta, Created = :now REMOVE FastaFiles, IndexQueued",
+        ExpressionAttributeValues={':n' : len(file_names), ':fasta' : {}, ':now' : int(time())}
+    )
+
+# Record a FASTA file whose upload is complete. Returns True if all of the genome's files are recorded. The names
+# of the files are added to a set, so recording a file again (e.g. a retried message) is harmless.
+def genome_manifest_add_fasta(dynamoDbClient, tableName, accession, key, size, etag):
+    name = os.path.basename(key)
+    response = dynamoDbClient.Table(tableName).update_item(
+        Key={'Genome' : accession, 'Item' : GENOME_MANIFEST_ITEM},
+        UpdateExpression="SET Fasta.#name = :file ADD FastaFiles :names",
+        ExpressionAttributeNames={'#name' : name},
+        ExpressionAttributeValues={':file' : {'Key' : key, 'Size' : size, 'ETag' : etag}, ':names' : {name}},
+        ReturnValues="ALL_NEW"
+    )
+    return len(response['Attributes']['FastaFiles']) == response['Attributes']['NumFastaFiles']
+
+# Claim the indexing of a genome whose FASTA files are all recorded, so that it is sent to isslCreation once.
+# Returns True to exactly one caller, until the claim is given up (see `genome_manifest_unclaim_index`).
+def genome_manifest_claim_index(dynamoDbClient, tableName, accession):
+    try:
+        dynamoDbClient.Table(tableName).update_item(
+            Key={'Genome' : accession, 'Item' : GENOME_MANIFEST_ITEM},
+            UpdateExpression="SET IndexQueued = :now",
+            ConditionExpression="attribute_not_exists(IndexQueued)",
+            ExpressionAttributeValues={':now' : int(time())}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+# Give up the claim on the indexing of a genome that could not be sent to isslCreation, so that a retry sends it
+def genome_manifest_unclaim_index(dynamoDbClient, tableName, accession):
+    dynamoDbClient.Table(tableName).update_item(
+        Key={'Genome' : accession, 'Item' : GENOME_MANIFEST_ITEM},
+        UpdateExpression="REMOVE IndexQueued"
+    )
+
+# Record the ISSL index of a genome. `files` maps each index name to the ETag and size of its .issl file.
+def genome_manifest_set_issl(dynamoDbClient, tableName, accession, names, files):
+    dynamoDbClient.Table(tableName).update_item(
+        Key={'Genome' : accession, 'Item' : GENOME_MANIFEST_ITEM},
+        UpdateExpression="SET Issl = :issl",
+        ExpressionAttributeValues={
+            ':issl' : {'Names' : names, 'Files' : files, 'Built' : int(time())}
+        }
+    )
+
+# The FASTA files of a genome (key and size) if the manifest records every one of them, otherwise None
+def manifest_fasta(manifest):
+    if manifest is None or 'NumFastaFiles' not in manifest:
+        return None
+    if len(manifest.get('FastaFiles', [])) < manifest['NumFastaFiles']:
+        return None
+    return {file['Key'] : int(file['Size']) for file in manifest['Fasta'].values()}
+
+# The ETag of each of a genome's .issl files if the manifest records them, otherwise None
+def manifest_issl_etags(manifest):
+    if manifest is None or 'Issl' not in manifest:
+        return None
+    files = manifest['Issl'].get('Files', {})
+    if any(name not in files for name in manifest['Issl']['Names']):
+        return None
+    return {name : files[name]['ETag'] for name in manifest['Issl']['Names']}
+
+# Version of a genome's ISSL index, from the ETag of each of its .issl files (`etags` maps index names to ETags).
+# The ETags change whenever the index is rebuilt, and are the same wherever they are read (the manifest, S3 or the
+# issl Lambda's cache), so scores computed with a stale copy of an index are never taken for current ones.
+def issl_index_version(etags):
+    return hashlib.sha1(json.dumps(sorted(etags.items())).encode('utf-8')).hexdigest()
+
+
+# The scores of a guide against a genome are the same in every job, so they are cached in the score cache table
+# under `genome#guide`, and jobs that find a guide there don't score it again (see targetScan). ISSL scores are
+# cached with the version of the index they were computed with, and only reused with that version.
+def score_cache_key(genome, guide):
+    return f"{genome}#{guide}"
+
+# Read the cached scores of many guides against a genome. Returns the cached item of each guide found in the cache.
+def score_cache_get(dynamoDbClient, tableName, genome, guides):
+    keys = [{'GenomeGuide' : score_cache_key(genome, guide)} for guide in set(guides)]
+    return {
+        item['GenomeGuide'].split('#', 1)[1] : item
+        for item in dynamodb_batch_get(dynamoDbClient, tableName, keys)
+    }
+
+# An update setting cached scores of a guide against a genome, for dynamodb_update_items. `scores` maps the
+# fields to set (e.g. IsslScore and IsslVersion) to their values.
+def score_cache_update(genome, guide, scores):
+    fields = list(scores)
+    return {
+        'Key' : {'GenomeGuide' : score_cache_key(genome, guide)},
+        'UpdateExpression' : "SET " + ", ".join([f"#f{i} = :v{i}" for i in range(len(fields))] + ["Expires = :expires"]),
+        'ExpressionAttributeNames' : {f"#f{i}" : field for i, field in enumerate(fields)},
+        'ExpressionAttributeValues' : {
+            **{f":v{i}" : scores[field] for i, field in enumerate(fields)},
+            ':expires' : int(time()) + SCORE_CACHE_TTL_SECONDS
+        }
+    }
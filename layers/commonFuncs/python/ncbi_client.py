@@ -0,0 +1,139 @@
+import os, re, random, requests
+from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from common_funcs import GENOME_NCBI_ITEM
+
+# Genomes are downloaded from the NCBI FTP site, over HTTPS
+NCBI_HTTPS_URL = 'https://ftp.ncbi.nlm.nih.gov'
+# Connections to the NCBI server kept open by each container, enough for the parts of a file downloaded at once
+NCBI_POOL_SIZE = int(os.getenv('NCBI_POOL_SIZE', 16))
+# Seconds the listing of an accession's FASTA files is cached for
+NCBI_LISTING_TTL_SECONDS = int(os.getenv('NCBI_LISTING_TTL_SECONDS', 604800))
+# Entries of the directory pages of the NCBI server (not the parent directory or sorting links)
+NCBI_HREF_PATTERN = re.compile(r'<a href="([^"?/][^"]*)"')
+# HTTP statuses of the NCBI server that succeed when the request is retried later. Files are sometimes briefly
+# missing (404) from one of the servers behind the site.
+NCBI_RETRYABLE_STATUS = [404, 429, 500, 502, 503, 504]
+# Errors of a transfer that fails part way, which is then resumed
+NCBI_RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+# Number of times a failed transfer is retried, waiting up to NCBI_BACKOFF_SECONDS * 2^attempt before each
+NCBI_RETRIES = int(os.getenv('NCBI_RETRIES', 6))
+NCBI_BACKOFF_SECONDS = 1
+NCBI_CHUNK_SIZE = 65536
+
+session = None
+
+# The HTTP session used for every request to NCBI from this container, so that connections are reused across
+# requests, threads and warm invocations
+def ncbi_session():
+    global session
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=NCBI_POOL_SIZE, pool_maxsize=NCBI_POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+    return session
+
+# Names of the files and directories in a directory of the NCBI server
+def ncbi_list_dir(url):
+    response = ncbi_session().get(url, timeout=30)
+    response.raise_for_status()
+    return [name.rstrip('/') for name in NCBI_HREF_PATTERN.findall(response.text)]
+
+# Size (bytes) of a file on the NCBI server
+def ncbi_file_size(url):
+    response = ncbi_session().head(url, allow_redirects=True, timeout=30)
+    response.raise_for_status()
+    return int(response.headers['Content-Length'])
+
+# MD5 checksums of the files in an assembly's directory, as published by NCBI in its md5checksums.txt
+def ncbi_md5_checksums(http_url):
+    response = ncbi_session().get(f"{http_url}/md5checksums.txt", timeout=30)
+    response.raise_for_status()
+    checksums = {}
+    for line in response.text.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            checksums[os.path.basename(fields[1])] = fields[0].lower()
+    return checksums
+
+# Find the directory of an assembly on the NCBI server and its .fna files. Returns the URL of the directory and
+# the name, size (bytes) and MD5 checksum of each file, which are looked up at the same time.
+def ncbi_fasta_listing(accession):
+    path = f"/genomes/all/{accession[0:3]}/{accession[4:7]}/{accession[7:10]}/{accession[10:13]}"
+    directory = next(name for name in ncbi_list_dir(f"{NCBI_HTTPS_URL}{path}/") if name.startswith(accession))
+    http_url = f"{NCBI_HTTPS_URL}{path}/{directory}"
+
+    names = [name for name in ncbi_list_dir(f"{http_url}/") if "genomic.fna" in name and "from_genomic" not in name]
+    with ThreadPoolExecutor(max_workers=max(1, min(NCBI_POOL_SIZE, len(names) + 1))) as executor:
+        checksums = executor.submit(ncbi_md5_checksums, http_url)
+        sizes = list(executor.map(lambda name: ncbi_file_size(f"{http_url}/{name}"), names))
+        checksums = checksums.result()
+
+    return http_url, [
+        {"file_name": name, "file_size": size, "md5": checksums.get(name)}
+        for name, size in zip(names, sizes)
+    ]
+
+# Sleep before retrying a request for the `attempt`th time: exponential backoff with full jitter, so that the
+# many partloaders retrying at once don't all come back at the same time
+def ncbi_backoff(attempt):
+    sleep(random.uniform(0, NCBI_BACKOFF_SECONDS * 2 ** attempt))
+
+# Download bytes start_byte to end_byte (inclusive) of a file on the NCBI server, writing them to the file object
+# `out` as they arrive, so that only one chunk is held in memory. A transfer that fails part way is resumed from
+# the last byte received rather than started again, and failed requests are retried with backoff (counting only
+# the attempts in a row that received nothing). The bytes are also added to `digest` (e.g. a hashlib.md5) as they
+# arrive, if one is given. Returns the number of bytes written.
+def ncbi_download_range(url, start_byte, end_byte, out, digest=None):
+    written = 0
+    size = end_byte - start_byte + 1
+    attempt = 0
+    while True:
+        received = written
+        try:
+            headers = {'Range' : f'bytes={start_byte + written}-{end_byte}'}
+            with ncbi_session().get(url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 206:
+                    for chunk in response.iter_content(NCBI_CHUNK_SIZE):
+                        out.write(chunk)
+                        written += len(chunk)
+                        if digest is not None:
+                            digest.update(chunk)
+                elif response.status_code in NCBI_RETRYABLE_STATUS:
+                    print(f"HTTP {response.status_code} for {url}")
+                else:
+                    raise Exception(f"HTTP {response.status_code} for {url}")
+        except NCBI_RETRYABLE_ERRORS as e:
+            print(f"Error downloading {url} after {written} of {size} bytes: {e}")
+
+        if written >= size:
+            return written
+
+        attempt = 1 if written > received else attempt + 1
+        if attempt > NCBI_RETRIES:
+            raise Exception(f"Failed to download bytes {start_byte}-{end_byte} of {url}")
+        ncbi_backoff(attempt)
+
+# The listing of an accession cached in the genomes table, or None if it is not cached. DynamoDB deletes expired
+# listings some time after they expire (TTL), so the expiry is checked here as well.
+def ncbi_cached_listing(dynamoDbClient, tableName, accession):
+    item = dynamoDbClient.Table(tableName).get_item(Key={'Genome' : accession, 'Item' : GENOME_NCBI_ITEM}).get('Item')
+    if item is None or item['Expires'] < time():
+        return None
+    return item['Url'], [
+        {"file_name": file['file_name'], "file_size": int(file['file_size']), "md5": file.get('md5')}
+        for file in item['Files']
+    ]
+
+# Cache the listing of an accession for NCBI_LISTING_TTL_SECONDS
+def ncbi_cache_listing(dynamoDbClient, tableName, accession, http_url, fna_file_details):
+    dynamoDbClient.Table(tableName).put_item(Item={
+        'Genome' : accession,
+        'Item' : GENOME_NCBI_ITEM,
+        'Url' : http_url,
+        'Files' : fna_file_details,
+        'Expires' : int(time()) + NCBI_LISTING_TTL_SECONDS
+    })
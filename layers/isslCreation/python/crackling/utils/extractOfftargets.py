@@ -14,11 +14,83 @@ Output:     one file with all the sites
 To use:     python3.7 ExtractOfftargets.py output-file  (input-files... | input-dir>)
 
 ''' 
-import glob, os, re, shutil, sys, tempfile, heapq, argparse
+import glob, os, re, shutil, sys, tempfile, heapq, argparse, multiprocessing, traceback, resource, time
+from multiprocessing.connection import wait
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
+
+try:
+    import numpy
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    numpy = None
 
 # Defining the patterns used to detect sequences
 pattern_forward_offsite = r"(?=([ACG][ACGT]{19}[ACGT][AG]G))"
 pattern_reverse_offsite = r"(?=(C[CT][ACGT][ACGT]{19}[TGC]))"
+pattern_forward_offsite_compiled = re.compile(pattern_forward_offsite)
+pattern_reverse_offsite_compiled = re.compile(pattern_reverse_offsite)
+
+# Number of bases held in memory at once by the streaming scanner
+SCAN_WINDOW_SIZE = 1 << 22
+# A site spans 23 bases, so consecutive windows of a sequence overlap by 22 bases
+SITE_LENGTH = 23
+SCAN_WINDOW_OVERLAP = SITE_LENGTH - 1
+
+# Sites can be found with the regexes above, or with equivalent vectorised comparisons (needs NumPy)
+OFFTARGET_SCANNERS = ['regex', 'numpy']
+
+# Characters removed from sequence lines
+whitespace = str.maketrans('', '', ' \t\r\n')
+
+# Off-targets can be held as text (one 21-byte line each) or packed into 64-bit integers, 2 bits per base.
+# A < C < G < T, so sorting the packed values gives the same order as sorting the text.
+OFFTARGET_FORMATS = ['text', 'binary']
+OFFTARGET_LENGTH = 20
+
+# Memory (MB) shared by the sorting processes for holding runs of off-targets. Each file is sorted as one or
+# more runs that fit in its share, however large the chromosome, and the runs are then merged.
+SORT_MEMORY_MB = 512
+# Approximate memory needed per off-target in a run: a str object plus a list slot as text, 8 bytes packed
+# into a NumPy array, or an int object plus a list slot packed without NumPy
+SORT_BYTES_PER_OFFTARGET = {'text' : 80, 'binary' : 8 if numpy is not None else 48}
+# Read buffer of each run while merging, and the memory allowed per merged run (buffer, merged block and output)
+MERGE_BUFFER_BYTES = 1 << 20
+MERGE_BYTES_PER_RUN = 4 * MERGE_BUFFER_BYTES
+# Number of packed off-targets read from each sorted run at a time while merging
+MERGE_BLOCK_SIZE = MERGE_BUFFER_BYTES // 8
+# File descriptors left for everything else when deciding how many runs to merge at once
+RESERVED_FILE_DESCRIPTORS = 64
+
+# Large genomes can be indexed in shards. Shard i of n keeps the off-targets whose packed value is in the i-th of
+# n equal ranges, i.e. those with a given range of prefixes, so the shards hold disjoint off-targets.
+def shardRange(shard, numShards):
+    numValues = 4 ** OFFTARGET_LENGTH
+    return (shard * numValues // numShards, (shard + 1) * numValues // numShards)
+
+# 20 bases pack into exactly 5 bytes, so off-targets are converted a byte (4 bases) at a time
+basesToByte = {}
+byteToBases = []
+for value in range(256):
+    bases = ''.join('ACGT'[(value >> shift) & 3] for shift in (6, 4, 2, 0))
+    basesToByte[bases] = value
+    byteToBases.append(bases)
+
+if numpy is not None:
+    baseToCode = numpy.zeros(256, dtype = numpy.uint64)
+    baseToCode[numpy.frombuffer(b'ACGT', dtype = numpy.uint8)] = numpy.arange(4, dtype = numpy.uint64)
+    codeToBase = numpy.frombuffer(b'ACGT', dtype = numpy.uint8)
+    baseShifts = numpy.arange(2 * (OFFTARGET_LENGTH - 1), -1, -2, dtype = numpy.uint64)
+    isBase = numpy.zeros(256, dtype = numpy.bool_)
+    isBase[numpy.frombuffer(b'ACGT', dtype = numpy.uint8)] = True
+    baseComplement = numpy.arange(256, dtype = numpy.uint8)
+    baseComplement[numpy.frombuffer(b'ACGT', dtype = numpy.uint8)] = numpy.frombuffer(b'TGCA', dtype = numpy.uint8)
+
+# Wall-clock time and peak memory of each stage of the most recent extraction
+stageReport = []
 
 # Function that returns the reverse-complement of a given sequence
 def rc(dna):
@@ -26,6 +98,87 @@ def rc(dna):
     rcseq = dna.translate(complements)[::-1]
     return rcseq
     
+# Peak resident memory (MB) of this process and of the largest of its (finished) worker processes
+def peakRssMB():
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    )
+
+# Record the wall-clock time and peak memory of a stage of the extraction
+@contextmanager
+def timedStage(name):
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    rssSelf, rssChildren = peakRssMB()
+    stageReport.append({'stage' : name, 'seconds' : seconds, 'peakRssMB' : rssSelf, 'peakWorkerRssMB' : rssChildren})
+    print(f'Stage "{name}" took {seconds:,.2f}s (peak RSS {rssSelf:,.0f} MB, workers {rssChildren:,.0f} MB)')
+
+def printStageReport():
+    print(f'{"stage":<10}{"seconds":>12}{"peak RSS (MB)":>16}{"worker RSS (MB)":>18}')
+    for stage in stageReport:
+        print(f'{stage["stage"]:<10}{stage["seconds"]:>12,.2f}{stage["peakRssMB"]:>16,.0f}{stage["peakWorkerRssMB"]:>18,.0f}')
+
+# Worker process of `parallelMap`. Sends the results (or the error) of its share of the work back through a pipe.
+def parallelWorker(func, items, conn):
+    try:
+        conn.send((True, [(idx, func(arg)) for idx, arg in items]))
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+    finally:
+        conn.close()
+
+# Apply `func` to each of `args` using up to `numProcesses` processes.
+# Lambda does not provide /dev/shm, so multiprocessing.Pool (and ProcessPoolExecutor, which needs semaphores
+# for its queues) cannot be used there. Instead, each worker is a plain Process that is given its share of the
+# work up front and returns the results through a Pipe, both of which work on Lambda.
+def parallelMap(func, args, numProcesses, weights = None):
+    args = list(args)
+    weights = weights or [1] * len(args)
+    numProcesses = max(1, min(numProcesses, len(args)))
+
+    if numProcesses == 1:
+        return [func(arg) for arg in args]
+
+    # Balance the load by giving the next largest item to the least loaded worker
+    shares = [[] for _ in range(numProcesses)]
+    loads = [0] * numProcesses
+    for idx in sorted(range(len(args)), key = lambda x: weights[x], reverse = True):
+        worker = loads.index(min(loads))
+        shares[worker].append((idx, args[idx]))
+        loads[worker] += weights[idx]
+
+    ctx = multiprocessing.get_context('fork')
+    workers = []
+    for share in shares:
+        connRecv, connSend = ctx.Pipe(duplex = False)
+        process = ctx.Process(target = parallelWorker, args = (func, share, connSend))
+        process.start()
+        connSend.close()
+        workers.append((process, connRecv))
+
+    results = [None] * len(args)
+    errors = []
+    for process, connRecv in workers:
+        try:
+            ok, payload = connRecv.recv()
+        except EOFError:
+            ok, payload = False, 'Worker process exited without returning results'
+        connRecv.close()
+        process.join()
+
+        if ok:
+            for idx, result in payload:
+                results[idx] = result
+        else:
+            errors.append(payload)
+
+    if errors:
+        raise RuntimeError('\n'.join(errors))
+
+    return results
+
 def explodeMultiFastaFile(fpInput, fpOutputTempDir):
     newFilesPaths = []
 
@@ -64,7 +217,295 @@ def explodeMultiFastaFile(fpInput, fpOutputTempDir):
             
     return newFilesPaths
 
-def processingNode(fpInput, fpOutputTempDir = None):
+# Yield the sequence of each record of FASTA text, given as chunks (str, or ASCII bytes) of any size, as a series of
+# windows without ever holding a whole record (chromosome) in memory. Consecutive windows of the same record overlap
+# by SCAN_WINDOW_OVERLAP bases so that every site is contained in exactly one window. Text before the first header
+# is treated as a record.
+def iterFastaWindows(chunks, windowSize = SCAN_WINDOW_SIZE):
+    window = ''
+    inHeader = False
+
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode('latin-1')
+
+        # '>' only appears at the start of a header
+        for idx, piece in enumerate(chunk.split('>')):
+            if idx > 0:
+                # a new record begins, finish the previous one
+                if len(window) > SCAN_WINDOW_OVERLAP:
+                    yield window
+                window = ''
+                inHeader = True
+
+            if inHeader:
+                newline = piece.find('\n')
+                if newline == -1:
+                    # the header continues into the next chunk
+                    continue
+                piece = piece[newline + 1:]
+                inHeader = False
+
+            window += piece.translate(whitespace).upper()
+
+            while len(window) >= windowSize:
+                yield window[:windowSize]
+                window = window[windowSize - SCAN_WINDOW_OVERLAP:]
+
+    if len(window) > SCAN_WINDOW_OVERLAP:
+        yield window
+
+# Split FASTA text, given as chunks of bytes of any size, into pieces of whole records (chromosomes) of at least
+# `pieceBytes` each (except the last), so that each piece can be scanned on its own. Records are never split: a
+# piece ends at the first header after it reaches `pieceBytes`, so a large record makes up a piece by itself.
+def iterFastaPieces(chunks, pieceBytes):
+    piece = bytearray()
+    searched = 0
+    for chunk in chunks:
+        piece += chunk
+        while len(piece) >= pieceBytes:
+            cut = piece.find(b'\n>', max(searched, pieceBytes - 1))
+            if cut == -1:
+                # the next header may start in the next chunk
+                searched = len(piece) - 1
+                break
+            yield bytes(piece[:cut + 1])
+            del piece[:cut + 1]
+            searched = 0
+
+    if piece:
+        yield bytes(piece)
+
+# Pack a list of off-targets (20-mers of ACGT) into 64-bit integers
+def encodeOfftargets(offTargets):
+    if numpy is not None:
+        if not offTargets:
+            return numpy.empty(0, dtype = numpy.uint64)
+        return packBases(numpy.frombuffer(''.join(offTargets).encode('ascii'), dtype = numpy.uint8).reshape(-1, OFFTARGET_LENGTH))
+
+    return array('Q', (
+        int.from_bytes(bytes(basesToByte[offTarget[i:i + 4]] for i in range(0, OFFTARGET_LENGTH, 4)), 'big')
+        for offTarget in offTargets
+    ))
+
+# Pack off-targets given as rows of bases (a uint8 array with OFFTARGET_LENGTH columns) into 64-bit integers
+def packBases(bases):
+    # One base (column) at a time, so that only one value per off-target is held
+    packed = numpy.zeros(len(bases), dtype = numpy.uint64)
+    for i in range(OFFTARGET_LENGTH):
+        packed = (packed << numpy.uint64(2)) | baseToCode[bases[:, i]]
+    return packed
+
+# Unpack 64-bit integers into off-target lines, as bytes ready to be written to the output
+def decodeOfftargets(packed):
+    if numpy is not None:
+        packed = numpy.asarray(packed, dtype = numpy.uint64)
+        lines = numpy.empty((len(packed), OFFTARGET_LENGTH + 1), dtype = numpy.uint8)
+        for i in range(OFFTARGET_LENGTH):
+            lines[:, i] = codeToBase[(packed >> baseShifts[i]) & numpy.uint64(3)]
+        lines[:, OFFTARGET_LENGTH] = ord('\n')
+        return lines.tobytes()
+
+    return ''.join(
+        ''.join(byteToBases[b] for b in value.to_bytes(5, 'big')) + '\n'
+        for value in packed
+    ).encode('ascii')
+
+# Read up to `count` packed off-targets from an open file, into a writable array so it can be sorted in place
+def readPackedOfftargets(inFile, count):
+    data = bytearray(count * 8)
+    numBytes = inFile.readinto(data)
+    if numpy is not None:
+        return numpy.frombuffer(data, dtype = numpy.uint64, count = numBytes // 8)
+
+    del data[numBytes:]
+    return array('Q', data)
+
+# Yield the packed off-targets of an open file, a block at a time
+def iterPackedBlocks(inFile, blockSize = MERGE_BLOCK_SIZE):
+    while True:
+        data = inFile.read(blockSize * 8)
+        if not data:
+            break
+        if numpy is not None:
+            yield numpy.frombuffer(data, dtype = numpy.uint64)
+        else:
+            yield array('Q', data)
+
+# Yield the packed off-targets of a stream of chunks of bytes of any size (e.g. streamed from S3), a chunk at a time
+def iterPackedChunks(chunks):
+    rest = b''
+    for chunk in chunks:
+        data = rest + chunk if rest else chunk
+        usable = len(data) - len(data) % 8
+        rest = data[usable:]
+        if usable == 0:
+            continue
+        if numpy is not None:
+            yield numpy.frombuffer(data, dtype = numpy.uint64, count = usable // 8)
+        else:
+            yield array('Q', data[:usable])
+
+    if rest:
+        raise ValueError(f'Packed off-targets stream ends with {len(rest)} stray bytes')
+
+# Index of the first off-target of at least `value` in an open file of sorted packed off-targets.
+# A binary search that reads one off-target per step, so the file is never loaded.
+def searchPackedFile(inFile, value):
+    lo, hi = 0, os.fstat(inFile.fileno()).st_size // 8
+    while lo < hi:
+        mid = (lo + hi) // 2
+        inFile.seek(mid * 8)
+        if int.from_bytes(inFile.read(8), sys.byteorder) < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+# Count the off-targets of a sorted block, continuing from the previous block of the same merge.
+# `stats` holds the number of off-targets, distinct off-targets, the most occurrences of one off-target, and
+# the last off-target seen along with its occurrences so far (a run of one off-target can span several blocks).
+def countSortedBlock(block, stats):
+    if len(block) == 0:
+        return
+
+    if numpy is not None and isinstance(block, numpy.ndarray):
+        runStarts = numpy.concatenate(([0], numpy.flatnonzero(block[1:] != block[:-1]) + 1))
+        runLengths = numpy.diff(numpy.append(runStarts, len(block)))
+        if stats['last'] is not None and block[0] == stats['last']:
+            runLengths[0] += stats['lastRepeats']
+            stats['distinct'] += len(runStarts) - 1
+        else:
+            stats['distinct'] += len(runStarts)
+        stats['maxRepeats'] = max(stats['maxRepeats'], int(runLengths.max()))
+        stats['last'] = block[-1]
+        stats['lastRepeats'] = int(runLengths[-1])
+    else:
+        for value in block:
+            if value == stats['last']:
+                stats['lastRepeats'] += 1
+            else:
+                stats['maxRepeats'] = max(stats['maxRepeats'], stats['lastRepeats'])
+                stats['distinct'] += 1
+                stats['last'] = value
+                stats['lastRepeats'] = 1
+        stats['maxRepeats'] = max(stats['maxRepeats'], stats['lastRepeats'])
+
+    stats['offtargets'] += len(block)
+
+# Merge sorted runs of packed off-targets, each given as an iterator of blocks (see `iterPackedBlocks` and
+# `iterPackedChunks`), and write them to `outFile` packed, or as text lines with `outputFormat` 'text'.
+# The off-targets are counted into `stats` when it is given (see `countSortedBlock`).
+def mergePackedRuns(runs, outFile, stats = None, outputFormat = 'binary'):
+    def writeBlock(block):
+        if stats is not None:
+            countSortedBlock(block, stats)
+        if outputFormat == 'binary':
+            outFile.write(block.tobytes())
+            return
+        for i in range(0, len(block), MERGE_BLOCK_SIZE):
+            outFile.write(decodeOfftargets(block[i:i + MERGE_BLOCK_SIZE]))
+
+    if numpy is None:
+        merged = heapq.merge(*[(value for block in run for value in block) for run in runs])
+        while True:
+            block = array('Q', islice(merged, MERGE_BLOCK_SIZE))
+            if not block:
+                break
+            writeBlock(block)
+        return
+
+    buffers = [next(run, None) for run in runs]
+    active = [(run, buffer) for run, buffer in zip(runs, buffers) if buffer is not None]
+
+    while active:
+        # Every value up to the smallest of the last loaded values is final, so a block of them can be sorted
+        # at once. The run holding that smallest last value is used up, which guarantees progress.
+        bound = min(buffer[-1] for _, buffer in active)
+        ready = []
+        remaining = []
+        for run, buffer in active:
+            cut = numpy.searchsorted(buffer, bound, side = 'right')
+            ready.append(buffer[:cut])
+            buffer = buffer[cut:]
+            if len(buffer) == 0:
+                buffer = next(run, None)
+            if buffer is not None:
+                remaining.append((run, buffer))
+        active = remaining
+
+        writeBlock(numpy.sort(numpy.concatenate(ready)))
+
+# Find the off-target sites in a window of sequence using vectorised comparisons rather than regexes.
+# Each position is tested against both patterns at once, and the off-targets are returned as rows of bases:
+# forward sites first, then reverse sites, each in the order the regexes would find them.
+def findOfftargetsNumpy(seq):
+    bases = numpy.frombuffer(seq.encode('ascii', 'replace'), dtype = numpy.uint8)
+    numSites = len(bases) - SITE_LENGTH + 1
+    if numSites <= 0:
+        return numpy.empty((0, OFFTARGET_LENGTH), dtype = numpy.uint8)
+
+    # A site may only contain A, C, G and T
+    numValid = numpy.concatenate(([0], numpy.cumsum(isBase[bases], dtype = numpy.int32)))
+    valid = (numValid[SITE_LENGTH:] - numValid[:numSites]) == SITE_LENGTH
+
+    # The base at `offset` within each site
+    def siteBase(offset):
+        return bases[offset:offset + numSites]
+
+    # [ACG][ACGT]{19}[ACGT][AG]G
+    forward = valid & (siteBase(0) != ord('T')) & ((siteBase(21) == ord('A')) | (siteBase(21) == ord('G'))) & (siteBase(22) == ord('G'))
+    # C[CT][ACGT][ACGT]{19}[TGC], which is reported as the reverse-complement of its first 20 bases
+    reverse = valid & (siteBase(0) == ord('C')) & ((siteBase(1) == ord('C')) | (siteBase(1) == ord('T'))) & (siteBase(22) != ord('A'))
+
+    # A view of the 20 bases starting at every position, without copying the sequence
+    kmers = sliding_window_view(bases, OFFTARGET_LENGTH)
+    return numpy.concatenate((
+        kmers[numpy.flatnonzero(forward)],
+        baseComplement[kmers[numpy.flatnonzero(reverse)]][:, ::-1]
+    ))
+
+# Find the off-target sites in a window of sequence and write them to `outFile`.
+# When `valueRange` (see `shardRange`) is given, only off-targets in that range are kept.
+def scanWindow(seq, outFile, offtargetFormat = 'text', scanner = 'regex', valueRange = None):
+    if scanner == 'numpy':
+        kmers = findOfftargetsNumpy(seq)
+        if valueRange is not None or offtargetFormat == 'binary':
+            packed = packBases(kmers)
+        if valueRange is not None:
+            keep = (packed >= numpy.uint64(valueRange[0])) & (packed < numpy.uint64(valueRange[1]))
+            kmers, packed = kmers[keep], packed[keep]
+        if offtargetFormat == 'binary':
+            outFile.write(packed.tobytes())
+        else:
+            lines = numpy.empty((len(kmers), OFFTARGET_LENGTH + 1), dtype = numpy.uint8)
+            lines[:, :OFFTARGET_LENGTH] = kmers
+            lines[:, OFFTARGET_LENGTH] = ord('\n')
+            outFile.write(lines.tobytes().decode('ascii'))
+        return len(kmers)
+
+    offTargets = []
+
+    for pattern, seqModifier in [
+        [pattern_forward_offsite_compiled, lambda x : x],
+        [pattern_reverse_offsite_compiled, lambda x : rc(x)]
+    ]:
+        offTargets.extend(seqModifier(match[0:20]) for match in pattern.findall(seq))
+
+    if valueRange is not None:
+        offTargets = [
+            offTarget for offTarget, value in zip(offTargets, encodeOfftargets(offTargets))
+            if valueRange[0] <= value < valueRange[1]
+        ]
+
+    if offtargetFormat == 'binary':
+        outFile.write(encodeOfftargets(offTargets).tobytes())
+    else:
+        outFile.write(''.join(f'{offTarget}\n' for offTarget in offTargets))
+
+    return len(offTargets)
+
+def processingNode(fpInput, fpOutputTempDir = None, offtargetFormat = 'text', scanner = 'regex', valueRange = None):
     # Create a temporary file
     fpTemp = tempfile.NamedTemporaryFile(
         mode = 'w+', 
@@ -72,70 +513,182 @@ def processingNode(fpInput, fpOutputTempDir = None):
         dir = fpOutputTempDir
     )
 
-    with open(fpTemp.name, 'w+') as outFile:
-        # key: FASTA header, value: sequence
-        seqsByHeader = {}
-
+    # Off-targets are written as each window is scanned, so peak memory does not depend on chromosome length
+    numOfftargets = 0
+    with open(fpTemp.name, 'wb' if offtargetFormat == 'binary' else 'w+') as outFile:
         with open(fpInput, 'r') as inFile:
-            header = fpInput
-            
-            for line in inFile:
-                if line[0] == '>':
-                    header = line[1:]
-                    seqsByHeader[header] = []
-                else:
-                    if header not in seqsByHeader:
-                        # it could be a plain text file, without a header
-                        seqsByHeader[header] = []
-                    seqsByHeader[header].append(line.rstrip().upper())
+            for window in iterFastaWindows(iter(partial(inFile.read, SCAN_WINDOW_SIZE), '')):
+                numOfftargets += scanWindow(window, outFile, offtargetFormat, scanner, valueRange)
 
-        # For each FASTA sequence
-        offtargets = [] 
-        for header in seqsByHeader:
-            seq = ''.join(seqsByHeader[header])
-            
-            for strand, pattern, seqModifier in [
-                ['positive', pattern_forward_offsite, lambda x : x],
-                ['negative', pattern_reverse_offsite, lambda x : rc(x)]
-            ]:
-                match_chr = re.findall(pattern, seq)
+    return numOfftargets
 
-                for i in range(0,len(match_chr)):
-                    offtargets.append(
-                        seqModifier(match_chr[i][0:20])
-                    )
-                
-            outFile.write(''.join(f'{offTarget}\n' for offTarget in offtargets))
-            return len(offtargets)
+# Scanner process of `streamingScan`. Asks for a window, scans it into its own off-target file, and repeats
+# until it is sent None. Then it returns the number of off-targets it found (or the error) through the pipe.
+def scanningWorker(conn, fpOutputTempDir, offtargetFormat, scanner, valueRange = None):
+    try:
+        fpTemp = tempfile.NamedTemporaryFile(
+            mode = 'w+', 
+            delete = False,
+            dir = fpOutputTempDir
+        )
 
-# Node function that sorts a file for multiprocessing pool
-def sortingNode(fileToSort, sortedTempDir):
-    # Create a temporary file
-    sortedFile = tempfile.NamedTemporaryFile(
-        mode = 'w+', 
-        delete = False,
-        dir = sortedTempDir
-    )
-    # Sort input file and store in new output dir
-    with open(fileToSort, 'r') as input:
-        # Read 'page'
-        page = input.readlines()
-        # Sort Page
-        page.sort()
-        # Write sorted page to file
-        sortedFile.writelines(page)
-        # Close sorted file
-        sortedFile.close()
-
-def paginatedSort(filesToSort, fpOutput, maxNumOpenFiles=400): 
+        numOfftargets = 0
+        with open(fpTemp.name, 'wb' if offtargetFormat == 'binary' else 'w+') as outFile:
+            while True:
+                conn.send(('ready', None))
+                window = conn.recv()
+                if window is None:
+                    break
+                numOfftargets += scanWindow(window, outFile, offtargetFormat, scanner, valueRange)
+
+        conn.send(('done', numOfftargets))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+# Scan FASTA text that arrives as streams of chunks (`fastaSources`, see `iterFastaWindows`), e.g. as it is
+# downloaded and decompressed, writing the off-targets to files in `fpOutputTempDir`. The windows are cut from the
+# streams in this process and handed to whichever of `numProcesses` scanning processes is free, so reading the
+# input overlaps with scanning it. Returns the number of off-targets found.
+def streamingScan(fastaSources, fpOutputTempDir, numProcesses, offtargetFormat = 'text', scanner = 'regex', valueRange = None):
+    if numProcesses <= 1:
+        fpTemp = tempfile.NamedTemporaryFile(mode = 'w+', delete = False, dir = fpOutputTempDir)
+        numOfftargets = 0
+        with open(fpTemp.name, 'wb' if offtargetFormat == 'binary' else 'w+') as outFile:
+            for chunks in fastaSources:
+                for window in iterFastaWindows(chunks):
+                    numOfftargets += scanWindow(window, outFile, offtargetFormat, scanner, valueRange)
+        return numOfftargets
+
+    # The workers are started before any stream is opened, so that no download threads are running when forking
+    ctx = multiprocessing.get_context('fork')
+    workers = []
+    for _ in range(numProcesses):
+        connParent, connChild = ctx.Pipe()
+        process = ctx.Process(target = scanningWorker, args = (connChild, fpOutputTempDir, offtargetFormat, scanner, valueRange))
+        process.start()
+        connChild.close()
+        workers.append((process, connParent))
+
+    def receive(conn):
+        try:
+            status, payload = conn.recv()
+        except EOFError:
+            raise RuntimeError('Scanning process exited unexpectedly')
+        if status == 'error':
+            raise RuntimeError(payload)
+        return payload
+
+    conns = [conn for _, conn in workers]
+    idle = []
+    try:
+        for chunks in fastaSources:
+            for window in iterFastaWindows(chunks):
+                while not idle:
+                    for conn in wait([conn for conn in conns if conn not in idle]):
+                        receive(conn)
+                        idle.append(conn)
+                idle.pop().send(window)
+
+        # Wait for each worker to finish its last window, then stop it
+        numOfftargets = 0
+        for conn in conns:
+            if conn not in idle:
+                receive(conn)
+            conn.send(None)
+            numOfftargets += receive(conn)
+        return numOfftargets
+    finally:
+        for process, conn in workers:
+            conn.close()
+            process.join(timeout = 1)
+            if process.is_alive():
+                process.terminate()
+
+# Node function that sorts a file for multiprocessing pool.
+# The file is read `runLength` off-targets at a time, and each of these runs is sorted into its own file,
+# so memory is bounded however large the file is. Returns the number of runs.
+def sortingNode(fileToSort, sortedTempDir, offtargetFormat = 'text', runLength = 1 << 22):
+    packed = offtargetFormat == 'binary'
+    numRuns = 0
+
+    with open(fileToSort, 'rb' if packed else 'r') as input:
+        while True:
+            # Read 'page'
+            if packed:
+                page = readPackedOfftargets(input, runLength)
+            else:
+                page = input.readlines(runLength * (OFFTARGET_LENGTH + 1))
+            if len(page) == 0:
+                break
+
+            # Sort Page
+            if packed and numpy is not None:
+                page.sort()
+            elif packed:
+                page = array('Q', sorted(page))
+            else:
+                page.sort()
+
+            # Write sorted page to a new file in the sorted dir
+            sortedFile = tempfile.NamedTemporaryFile(
+                mode = 'wb' if packed else 'w+', 
+                delete = False,
+                dir = sortedTempDir
+            )
+            if packed:
+                # written straight from the array's buffer, without a copy
+                sortedFile.write(page)
+            else:
+                sortedFile.writelines(page)
+            sortedFile.close()
+            numRuns += 1
+
+            del page
+
+    # Only the sorted runs are needed from here on, free the disk space
+    os.remove(fileToSort)
+
+    return numRuns
+
+# Number of sorted runs to merge at once, limited by the open file limit (RLIMIT_NOFILE) and by the memory
+# needed for each run's read buffer. `maxNumOpenFiles` caps it further, when given.
+def mergeFanIn(sortMemoryMB, maxNumOpenFiles = None):
+    softLimit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    fanIn = (sortMemoryMB * 1024 * 1024) // MERGE_BYTES_PER_RUN
+    if softLimit != resource.RLIM_INFINITY:
+        fanIn = min(fanIn, softLimit - RESERVED_FILE_DESCRIPTORS)
+    if maxNumOpenFiles:
+        fanIn = min(fanIn, maxNumOpenFiles)
+    return max(2, fanIn)
+
+# Sort the off-targets of all `filesToSort` into `fpOutput` (an external merge sort), using about
+# `sortMemoryMB` of memory. Returns the number of off-targets, distinct off-targets and the most
+# occurrences of any one off-target, which are counted during the final merge.
+# The output is text for ISSL, or packed with `outputFormat` 'binary' (a sorted run to be merged with others).
+def paginatedSort(filesToSort, fpOutput, maxNumOpenFiles=None, numThreads=1, offtargetFormat='text', sortMemoryMB=SORT_MEMORY_MB, outputFormat='text'): 
     # Create temp file directory
     sortedTempDir = tempfile.TemporaryDirectory()
     print(f'Created temp directory {sortedTempDir.name} for sorting')
 
-    for f in filesToSort:
-        sortingNode(f,sortedTempDir.name)
+    packed = offtargetFormat == 'binary'
+    if outputFormat == 'binary' and not packed:
+        raise ValueError('Sorted off-targets can only be written packed from the binary intermediate format')
+
+    # Each sorting process gets an equal share of the memory
+    runLength = max(1, (sortMemoryMB * 1024 * 1024) // (max(1, min(numThreads, len(filesToSort))) * SORT_BYTES_PER_OFFTARGET[offtargetFormat]))
+    print(f'Sorting runs of up to {runLength:,} off-targets')
+
+    with timedStage('sort'):
+        numRuns = parallelMap(
+            partial(sortingNode, sortedTempDir = sortedTempDir.name, offtargetFormat = offtargetFormat, runLength = runLength),
+            filesToSort,
+            numThreads,
+            weights = [os.path.getsize(f) for f in filesToSort]
+        )
     
-    print('Sorting of each file completed')
+    print(f'Sorting of each file completed, {sum(numRuns):,} sorted runs')
     
     # Collect sorted files to merge
     sortedFiles = glob.glob(
@@ -144,52 +697,99 @@ def paginatedSort(filesToSort, fpOutput, maxNumOpenFiles=400):
             '*'
         )
     )
+
+    stats = {'offtargets' : 0, 'distinct' : 0, 'maxRepeats' : 0, 'last' : None, 'lastRepeats' : 0}
     
-    # Open all the sorted files to merge
-    print(f'Beginning to merge sorted files, {maxNumOpenFiles:,} at a time')
-    while len(sortedFiles) > 1:
-        # A file to write the merged sequences to
-        mergedFile = tempfile.NamedTemporaryFile(delete = False)
-        
-        # Select the files to merge
+    with timedStage('merge'):
+        maxNumOpenFiles = mergeFanIn(sortMemoryMB, maxNumOpenFiles)
+        print(f'Beginning to merge sorted files, {maxNumOpenFiles:,} at a time')
+
+        # Runs are merged `maxNumOpenFiles` at a time until a single round remains.
+        # That final round writes the output in `outputFormat`, and counts the off-targets.
         while True:
+            # A file to write the merged sequences to
+            mergedFile = tempfile.NamedTemporaryFile(delete = False, dir = sortedTempDir.name)
+            mergedFile.close()
+        
+            # Select the files to merge
+            sortedFilesPointers = []
             try:
-                sortedFilesPointers = [open(file, 'r') for file in sortedFiles[:maxNumOpenFiles]]
-                break
+                for file in sortedFiles[:maxNumOpenFiles]:
+                    sortedFilesPointers.append(open(file, 'rb' if packed else 'r', buffering = MERGE_BUFFER_BYTES))
             except OSError as e:
+                for file in sortedFilesPointers:
+                    file.close()
                 if e.errno == 24:
-                    
-                    for file in sortedFilesPointers:
-                        try:
-                            file.close()
-                        except Exception as e:
-                            pass
-
                     print(f'Attempted to open too many files at once (OSError errno 24)')
-                    maxNumOpenFiles = max(1, int(maxNumOpenFiles / 2))
+                    maxNumOpenFiles = max(2, int(maxNumOpenFiles / 2))
                     print(f'Reducing the number of files that can be opened by half to {maxNumOpenFiles}')
                     continue
                 raise e
                     
-        print(f'Merging {len(sortedFilesPointers):,}')
+            print(f'Merging {len(sortedFilesPointers):,}')
         
-        # Merge and write
-        with open(mergedFile.name, 'w') as f:
-            f.writelines(heapq.merge(*sortedFilesPointers))
+            # Merge and write
+            finalRound = len(sortedFilesPointers) == len(sortedFiles)
+            if packed:
+                with open(mergedFile.name, 'wb', buffering = MERGE_BUFFER_BYTES) as f:
+                    mergePackedRuns(
+                        [iterPackedBlocks(file) for file in sortedFilesPointers], f,
+                        stats if finalRound else None, outputFormat if finalRound else 'binary'
+                    )
+            else:
+                with open(mergedFile.name, 'w', buffering = MERGE_BUFFER_BYTES) as f:
+                    merged = heapq.merge(*sortedFilesPointers)
+                    while True:
+                        block = list(islice(merged, MERGE_BLOCK_SIZE))
+                        if not block:
+                            break
+                        if finalRound:
+                            countSortedBlock(block, stats)
+                        f.writelines(block)
         
-        # Close all of the open files
-        for file in sortedFilesPointers:
-            file.close()
+            # Close and remove the merged files
+            for file in sortedFilesPointers:
+                file.close()
+                os.remove(file.name)
           
-        # prepare for the next set to be merged
-        sortedFiles = sortedFiles[maxNumOpenFiles:] + [mergedFile.name]
+            # prepare for the next set to be merged
+            sortedFiles = sortedFiles[maxNumOpenFiles:] + [mergedFile.name]
+            if finalRound:
+                break
     
     shutil.move(sortedFiles[0], fpOutput)
 
-def startSequentalprocessing(fpInputs, fpOutput, numThreads, maxOpenFiles):
-    print('Extracting off-targets using sequental-processing approach')
+    print(f'Sorted {stats["offtargets"]:,} off-targets, {stats["distinct"]:,} distinct (at most {stats["maxRepeats"]:,} occurrences of one)')
+    return {key : stats[key] for key in ['offtargets', 'distinct', 'maxRepeats']}
+
+# Check the intermediate format and scanner options, returning the scanner to use
+def checkOptions(offtargetFormat, scanner):
+    if offtargetFormat not in OFFTARGET_FORMATS:
+        raise ValueError(f'Unknown off-target format "{offtargetFormat}", expected one of {OFFTARGET_FORMATS}')
+    print(f'Intermediate off-target format: {offtargetFormat}')
+    if offtargetFormat == 'binary' and numpy is None:
+        print('WARNING: NumPy is not available, the binary format is packed, sorted and merged in pure Python, which is slower than the text format')
+
+    if scanner not in OFFTARGET_SCANNERS:
+        raise ValueError(f'Unknown off-target scanner "{scanner}", expected one of {OFFTARGET_SCANNERS}')
+    if scanner == 'numpy' and numpy is None:
+        print('WARNING: NumPy is not available, falling back to the regex scanner')
+        scanner = 'regex'
+    print(f'Off-target scanner: {scanner}')
+    return scanner
+
+def startSequentalprocessing(fpInputs, fpOutput, numThreads, maxOpenFiles=None, offtargetFormat='text', scanner='regex', sortMemoryMB=SORT_MEMORY_MB, shard=None, numShards=1):
+    print('Extracting off-targets using sequental-processing approach' if numThreads <= 1 else 'Extracting off-targets using parallel-processing approach')
     
     print(f'Allowed processes: {numThreads}')
+
+    valueRange = shardRange(shard, numShards) if shard is not None else None
+    if valueRange is not None:
+        print(f'Keeping shard {shard + 1} of {numShards} of the off-targets')
+
+    scanner = checkOptions(offtargetFormat, scanner)
+
+    stageReport.clear()
     
     fpTempDir = tempfile.TemporaryDirectory()
     print(f'Created a temporary directory for intermediate files: {fpTempDir.name}')
@@ -210,21 +810,24 @@ def startSequentalprocessing(fpInputs, fpOutput, numThreads, maxOpenFiles):
         print(f'Writing each file to a temporary directory: {fpExplodeTempDir.name}')
         
     
-        fpInputs = explodeMultiFastaFile(
-            fpInputs[0],
-            fpExplodeTempDir.name
-        )
+        with timedStage('explode'):
+            fpInputs = explodeMultiFastaFile(
+                fpInputs[0],
+                fpExplodeTempDir.name
+            )
         
         print(f'Exploded into {len(fpInputs)} files')
 
     print(f'Beginning to process {len(fpInputs)} files')
 
-    # Submit job to "multiprocessing pool"
-    f = lambda x: processingNode(x,fpTempDir.name)
-    numTargets = map(
-        f,#processingNode,
-        fpInputs#args
-    )
+    # Process the files (chromosomes) in parallel, largest first
+    with timedStage('scan'):
+        numTargets = parallelMap(
+            partial(processingNode, fpOutputTempDir = fpTempDir.name, offtargetFormat = offtargetFormat, scanner = scanner, valueRange = valueRange),
+            fpInputs,
+            numThreads,
+            weights = [os.path.getsize(f) for f in fpInputs]
+        )
 
     print(f'Processing completed. Found {sum(numTargets):,} targets.')
     
@@ -239,10 +842,125 @@ def startSequentalprocessing(fpInputs, fpOutput, numThreads, maxOpenFiles):
             )
         ), 
         fpOutput,
-        maxNumOpenFiles=maxOpenFiles
+        maxNumOpenFiles=maxOpenFiles,
+        numThreads=numThreads,
+        offtargetFormat=offtargetFormat,
+        sortMemoryMB=sortMemoryMB
     )
+
+    printStageReport()
     print("end reached. Goodbye")
 
+# Like `startSequentalprocessing`, but the FASTA input is given as streams of chunks rather than files (see
+# `streamingScan`), so it never has to be decompressed, exploded or otherwise written to disk.
+# Returns the counts of `paginatedSort`.
+def startStreamingProcessing(fastaSources, fpOutput, numThreads, maxOpenFiles=None, offtargetFormat='text', scanner='regex', sortMemoryMB=SORT_MEMORY_MB, shard=None, numShards=1, outputFormat='text'):
+    print(f'Extracting off-targets from streamed input using {numThreads} processes')
+
+    valueRange = shardRange(shard, numShards) if shard is not None else None
+    if valueRange is not None:
+        print(f'Keeping shard {shard + 1} of {numShards} of the off-targets')
+
+    scanner = checkOptions(offtargetFormat, scanner)
+
+    stageReport.clear()
+
+    fpTempDir = tempfile.TemporaryDirectory()
+    print(f'Created a temporary directory for intermediate files: {fpTempDir.name}')
+
+    with timedStage('scan'):
+        numTargets = streamingScan(fastaSources, fpTempDir.name, numThreads, offtargetFormat, scanner, valueRange)
+
+    print(f'Processing completed. Found {numTargets:,} targets.')
+
+    print('Preparing for ISSL by sorting all intermediate files')
+
+    stats = paginatedSort(
+        glob.glob(
+            os.path.join(
+                fpTempDir.name, 
+                '*'
+            )
+        ), 
+        fpOutput,
+        maxNumOpenFiles=maxOpenFiles,
+        numThreads=numThreads,
+        offtargetFormat=offtargetFormat,
+        sortMemoryMB=sortMemoryMB,
+        outputFormat=outputFormat
+    )
+
+    printStageReport()
+    return stats
+
+# Merge sorted runs of packed off-targets, given as streams of chunks (e.g. runs written by
+# `startStreamingProcessing` for parts of a genome, streamed back from S3), into the text off-targets file
+# for ISSL. Nothing but the output is written to disk. Returns the counts of `paginatedSort`.
+def mergeStreamedRuns(runSources, fpOutput):
+    stageReport.clear()
+    stats = {'offtargets' : 0, 'distinct' : 0, 'maxRepeats' : 0, 'last' : None, 'lastRepeats' : 0}
+
+    print(f'Merging {len(runSources):,} sorted runs')
+    if numpy is None:
+        print('WARNING: NumPy is not available, the runs are merged in pure Python, which is much slower')
+    with timedStage('merge'):
+        with open(fpOutput, 'wb', buffering = MERGE_BUFFER_BYTES) as f:
+            mergePackedRuns([iterPackedChunks(chunks) for chunks in runSources], f, stats, 'text')
+
+    print(f'Merged {stats["offtargets"]:,} off-targets, {stats["distinct"]:,} distinct (at most {stats["maxRepeats"]:,} occurrences of one)')
+    printStageReport()
+    return {key : stats[key] for key in ['offtargets', 'distinct', 'maxRepeats']}
+
+# Check an off-targets file against a plain whole-sequence scan of the FASTA inputs.
+# This holds each record in memory and is only intended for checking changes to the pipeline above
+# (e.g. on synthetic multi-FASTA files): the output must be sorted and contain exactly the expected off-targets.
+def verifyOfftargets(fpInputs, fpOutput, valueRange = None):
+    if len(fpInputs) == 1 and os.path.isdir(fpInputs[0]):
+        fpInputs = glob.glob(os.path.join(fpInputs[0], '*'))
+
+    expected = Counter()
+    for fpInput in fpInputs:
+        seqsByHeader = {}
+        with open(fpInput, 'r') as inFile:
+            header = fpInput
+            for line in inFile:
+                if line[0] == '>':
+                    header = line[1:]
+                    seqsByHeader[header] = []
+                else:
+                    seqsByHeader.setdefault(header, []).append(line.rstrip().upper())
+
+        for header in seqsByHeader:
+            seq = ''.join(seqsByHeader[header])
+            for pattern, seqModifier in [
+                [pattern_forward_offsite, lambda x : x],
+                [pattern_reverse_offsite, lambda x : rc(x)]
+            ]:
+                expected.update(seqModifier(match[0:20]) for match in re.findall(pattern, seq))
+
+    if valueRange is not None:
+        expected = Counter({
+            offTarget : count for offTarget, count in expected.items()
+            if valueRange[0] <= int(offTarget.translate(str.maketrans('ACGT', '0123')), 4) < valueRange[1]
+        })
+
+    actual = Counter()
+    isSorted = True
+    previous = ''
+    with open(fpOutput, 'r') as inFile:
+        for line in inFile:
+            offTarget = line.rstrip('\n')
+            isSorted = isSorted and previous <= offTarget
+            previous = offTarget
+            actual[offTarget] += 1
+
+    missing = expected - actual
+    unexpected = actual - expected
+    print(f'Expected {sum(expected.values()):,} off-targets, found {sum(actual.values()):,}')
+    print(f'Missing: {sum(missing.values()):,}, unexpected: {sum(unexpected.values()):,}, sorted: {isSorted}')
+
+    return isSorted and not missing and not unexpected
+
 def main():
     parser = argparse.ArgumentParser(description='Extract CRISPR target sites for Crackling.')
     
@@ -254,9 +972,15 @@ def main():
         nargs='+'
     )
     parser.add_argument('--maxOpenFiles', 
-        help='The number of files allowed to be opened by a single process. Use `ulimit -n` to find out your system setting.', 
+        help='The most sorted files to merge at once. Default is chosen from the open file limit (`ulimit -n`) and `--sortMemoryMB`.', 
         type=int,
-        default=1000, 
+        default=None, 
+        required=False
+    )
+    parser.add_argument('--sortMemoryMB', 
+        help=f'The memory (MB) used to hold off-targets while sorting and merging. Default is {SORT_MEMORY_MB}.', 
+        type=int,
+        default=SORT_MEMORY_MB, 
         required=False
     )
     parser.add_argument('--threads', 
@@ -265,20 +989,53 @@ def main():
         default=os.cpu_count(), 
         required=False
     )
+    parser.add_argument('--format', 
+        help='The format of intermediate files: `text` lines, or `binary` 20-mers packed into 64-bit integers (smaller and faster to sort, uses NumPy if available). Default is `text`.', 
+        choices=OFFTARGET_FORMATS,
+        default='text', 
+        required=False
+    )
+    parser.add_argument('--scanner', 
+        help='How to find sites: `regex`, or `numpy` (vectorised, identical results, needs NumPy). Default is `regex`.', 
+        choices=OFFTARGET_SCANNERS,
+        default='regex', 
+        required=False
+    )
+    parser.add_argument('--shard', 
+        help='Only keep one shard (0 to `--numShards` - 1) of the off-targets, split by their prefix, to build one shard of a sharded index.', 
+        type=int,
+        default=None, 
+        required=False
+    )
+    parser.add_argument('--numShards', 
+        help='The number of shards the off-targets are split into when using `--shard`. Default is 1.', 
+        type=int,
+        default=1, 
+        required=False
+    )
+    parser.add_argument('--verify', 
+        help='After extracting, check the output against a plain (in-memory) scan of the inputs.', 
+        action='store_true',
+        required=False
+    )
 
     args = parser.parse_args()
 
-    # Create multiprocessing pool
-    # https://docs.python.org/3/library/multiprocessing.html#multiprocessing.pool.Pool.starmap
-    # mpPool = multiprocessing.Pool(args.threads)
-
     startSequentalprocessing(
         args.inputs, 
         args.output, 
         args.threads, 
-        args.maxOpenFiles
+        args.maxOpenFiles,
+        args.format,
+        args.scanner,
+        args.sortMemoryMB,
+        args.shard,
+        args.numShards
     )
 
+    if args.verify and not verifyOfftargets(args.inputs, args.output, shardRange(args.shard, args.numShards) if args.shard is not None else None):
+        sys.exit('Verification failed: the off-targets do not match a plain scan of the inputs.')
+
     print('Goodbye.')
 
 if __name__ == '__main__':
@@ -158,11 +158,13 @@ high_energy_threshold = -18
 
 targets_table_name = os.getenv('TARGETS_TABLE', 'TargetsTable')
 task_tracking_table_name = os.getenv('TASK_TRACKING_TABLE')
+score_cache_table_name = os.getenv('SCORE_CACHE_TABLE')
 consensus_queue_url = os.getenv('CONSENSUS_QUEUE', 'ConsensusQueue')
 
 sqs_client = boto3.client('sqs')
 
 dynamodb = boto3.resource('dynamodb')
+dynamodb_client = boto3.client('dynamodb')
 TARGETS_TABLE = dynamodb.Table(targets_table_name)
 
 
@@ -325,29 +327,33 @@ def _CalcSgrnascorer(seq):
 def lambda_handler(event, context):
     records = {}
     recordsByJobID = {}
+    # key: JobID, value: genome, for the score cache
+    jobToGenome = {}
     
     ReceiptHandles = []
     for record in event['Records']:
         genome = ""
         try:
-            message = json.loads(record['body'])
-            genome = json.loads(message['genome'])
-            message = json.loads(message['default'])
+            # each message is an envelope of many guides (or a single guide in the legacy format)
+            genome, messages = unpack_target_envelope(json.loads(record['body']))
         except:
             continue
 
-        if not all([x in message for x in ['Sequence', 'JobID', 'TargetID']]):
-            print(f'Missing core data to perform off-target scoring: {message}')
-            continue
+        for message in messages:
+            if not all([x in message for x in ['Sequence', 'JobID', 'TargetID']]):
+                print(f'Missing core data to perform off-target scoring: {message}')
+                continue
+                
+            if message['JobID'] not in recordsByJobID:
+                recordsByJobID[message['JobID']] = {}
+            if genome:
+                jobToGenome[message['JobID']] = genome
             
-        if message['JobID'] not in recordsByJobID:
-            recordsByJobID[message['JobID']] = {}
-        
-        recordsByJobID[message['JobID']][message['Sequence']] = {
-          'JobID'         : message['JobID'],
-          'TargetID'      : message['TargetID'],
-          'Consensus'     : "",
-        }
+            recordsByJobID[message['JobID']][message['Sequence']] = {
+              'JobID'         : message['JobID'],
+              'TargetID'      : message['TargetID'],
+              'Consensus'     : "",
+            }
             
         ReceiptHandles.append(record['receiptHandle'])
 
@@ -356,15 +362,31 @@ def lambda_handler(event, context):
     # track number of tasks completed for each job by counting instances of each jobID
     job_tasks = {}
     
+    # write the results of the whole batch concurrently
+    dynamodb_update_items(dynamodb_client, targets_table_name, [
+        {
+            'Key' : {'JobID': result['JobID'], 'TargetID': result['TargetID']},
+            'UpdateExpression' : 'set Consensus = :c',
+            'ExpressionAttributeValues' : {':c': result['Consensus']}
+        }
+        for jobid in results.keys()
+        for result in results[jobid].values()
+    ])
+
+    # cache the results for later jobs with the same guides and genome. Scoring does not fail if they can't be
+    # cached.
+    if score_cache_table_name:
+        try:
+            dynamodb_update_items(dynamodb_client, score_cache_table_name, [
+                score_cache_update(jobToGenome[jobid], guide, {'Consensus' : result['Consensus']})
+                for jobid in results.keys() if jobid in jobToGenome
+                for guide, result in results[jobid].items()
+            ])
+        except Exception as e:
+            print(f"Error caching the results: {e}")
+
     for jobid in results.keys():
         for result in results[jobid].values():
-            #print(json.dumps(result['Consensus']))
-            response = TARGETS_TABLE.update_item(
-                Key={'JobID': result['JobID'], 'TargetID': result['TargetID']},
-                UpdateExpression='set Consensus = :c',
-                ExpressionAttributeValues={':c': result['Consensus']}
-            )
-        
             # increment task counter for each job
             if result['JobID'] not in job_tasks:
                 # if job doesnt have an entry, create one
@@ -388,7 +410,7 @@ def lambda_handler(event, context):
 
     # Update task counter for each job
     for jobID, task_count in job_tasks.items():
-        job = update_task_counter(dynamodb, task_tracking_table_name, jobID, "NumScoredOntarget", task_count)
+        job = increment_job_counters(dynamodb, task_tracking_table_name, jobID, {"NumScoredOntarget" : task_count})
 
     return (event)
     
\ No newline at end of file
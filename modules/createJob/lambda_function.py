@@ -1,4 +1,4 @@
-import boto3, json, uuid, os
+import boto3, json, uuid, os, hashlib
 
 from time import time
 from datetime import datetime
@@ -7,8 +7,21 @@ from common_funcs import *
 MAX_SEQ_LENGTH = os.getenv('MAX_SEQ_LENGTH', 10000)
 JOBS_TABLE = os.getenv('JOBS_TABLE', 'jobs')
 TASK_TRACKING_TABLE = os.getenv('TASK_TRACKING_TABLE')
+SUBMISSIONS_TABLE = os.getenv('SUBMISSIONS_TABLE')
+# Seconds for which a repeat of a submission returns the job of the first one instead of creating a new job.
+# 0 disables duplicate detection.
+JOB_DEDUP_WINDOW_SECONDS = int(os.getenv('JOB_DEDUP_WINDOW_SECONDS', 3600))
+# Bucket that multi-FASTA files of batch jobs are uploaded to (see customData)
+S3_BUCKET = os.getenv('BUCKET')
+# Limits of a batch job: number of regions, their total length, and size of an uploaded multi-FASTA file (bytes)
+MAX_BATCH_REGIONS = int(os.getenv('MAX_BATCH_REGIONS', 1000))
+MAX_BATCH_LENGTH = int(os.getenv('MAX_BATCH_LENGTH', 1000000))
+MAX_BATCH_FASTA_BYTES = int(os.getenv('MAX_BATCH_FASTA_BYTES', 10485760))
+# Region names (the first word of their FASTA header) are truncated to this length
+MAX_REGION_NAME_LENGTH = 100
 
 dynamodb = boto3.resource('dynamodb')
+s3_client = boto3.client('s3')
 jobTable = dynamodb.Table(JOBS_TABLE)
 taskTrackingTable = dynamodb.Table(TASK_TRACKING_TABLE)
 
@@ -24,6 +37,198 @@ def return_http_json(code, message, tags = []):
     body = json.dumps(payload)
     return {'statusCode': code, 'headers': headers, 'body': body}
 
+def return_job_json(context, jobid, **fields):
+    body = json.dumps({
+        'aws_request_id' : context.aws_request_id,
+        'JobID' : jobid,
+        **fields
+    })
+    return {'statusCode': 200, 'headers': headers, 'body': body}
+
+# Hash identifying the content of a submission: the genome and the (uppercased) sequence
+def submission_hash(genome, sequence):
+    return hashlib.sha256(f"{genome}#{sequence}".encode()).hexdigest()
+
+# Key of a submission in the submissions table: the client's idempotency key if it sent one, otherwise the hash
+# of its content, so that repeats of the same request (double clicks, scripted retries) map to the same item
+def submission_key(contentHash, idempotencyKey=None):
+    if idempotencyKey:
+        return f"Key#{idempotencyKey}"
+    return f"Sequence#{contentHash}"
+
+# Record that a submission created job `jobid` (and for a batch job, its `regions`), unless a submission with the
+# same key was recorded within the last JOB_DEDUP_WINDOW_SECONDS. Returns None if the submission was recorded,
+# otherwise the item of the earlier submission (its JobID, ContentHash and Regions).
+def claim_submission(key, contentHash, jobid, regions=None):
+    table = dynamodb.Table(SUBMISSIONS_TABLE)
+    while True:
+        now = int(time())
+        try:
+            table.put_item(
+                Item={
+                    'SubmissionKey' : key,
+                    'JobID' : jobid,
+                    'ContentHash' : contentHash,
+                    'Expires' : now + JOB_DEDUP_WINDOW_SECONDS,
+                    **({'Regions' : regions} if regions else {})
+                },
+                ConditionExpression="attribute_not_exists(SubmissionKey) OR Expires < :now",
+                ExpressionAttributeValues={':now' : now}
+            )
+            return None
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+        # the earlier submission may have been released (its job failed to be created) in the meantime
+        item = table.get_item(Key={'SubmissionKey' : key}, ConsistentRead=True).get('Item')
+        if item is not None:
+            return item
+
+# Forget a submission whose job could not be created, so that retrying it creates the job
+def release_submission(key, jobid):
+    try:
+        dynamodb.Table(SUBMISSIONS_TABLE).delete_item(
+            Key={'SubmissionKey' : key},
+            ConditionExpression="JobID = :jobid",
+            ExpressionAttributeValues={':jobid' : jobid}
+        )
+    except ClientError as e:
+        print(f"Failed to release submission {key}: {e}")
+
+# Record the submission of job `jobid` (see claim_submission), with `content` identifying what was submitted.
+# Returns the key the submission was recorded under, or None if duplicate detection is disabled, and for a repeat
+# of an earlier submission the response to return instead of creating the job.
+def record_submission(job_request, genome, content, jobid, context, regions=None):
+    if not SUBMISSIONS_TABLE or JOB_DEDUP_WINDOW_SECONDS <= 0:
+        return None, None
+
+    contentHash = submission_hash(genome, content)
+    key = submission_key(contentHash, job_request.get('idempotency_key'))
+    earlier = claim_submission(key, contentHash, jobid, regions)
+    if earlier is None:
+        return key, None
+
+    if earlier['ContentHash'] != contentHash:
+        return None, return_http_json(409, 'The idempotency key was already used for a different job.', ['idempotency_key'])
+
+    emit_metrics('CreateJob', {'DuplicateSubmissions' : 1})
+
+    # the regions of a batch job are returned again, as their JobIDs are needed to retrieve the results. They are
+    # kept with the submission, as the earlier job may not have been written yet.
+    if 'Regions' in earlier:
+        return None, return_job_json(context, earlier['JobID'], Regions=earlier['Regions'], Duplicate=True)
+    return None, return_job_json(context, earlier['JobID'], Duplicate=True)
+
+# Split a multi-FASTA into a list of (name, sequence). The name of a region is the first word of its header, and
+# regions without one are numbered. Sequences are uppercased, as TargetScan only finds uppercase sites.
+def parse_fasta(fasta):
+    regions = []
+    for line in fasta.splitlines():
+        line = line.strip()
+        if line.startswith('>'):
+            regions.append([line[1:].split(maxsplit=1)[0][:MAX_REGION_NAME_LENGTH] if line[1:].strip() else '', []])
+        elif line and not line.startswith(';'):
+            if not regions:
+                regions.append(['', []])
+            regions[-1][1].append(line.replace(' ', '').upper())
+
+    return [(name or f"region{i + 1}", ''.join(lines)) for i, (name, lines) in enumerate(regions)]
+
+# Read the multi-FASTA of a batch job: sent in the request, or uploaded to S3 beforehand with a presigned URL.
+# Returns the FASTA, or the error response to return.
+def batch_fasta(job_request):
+    if 'fasta' in job_request:
+        return job_request['fasta'], None
+
+    key = job_request['fasta_key']
+    if not key.startswith(BATCH_UPLOAD_PREFIX) or '..' in key:
+        return None, return_http_json(400, 'The FASTA file must be uploaded with a batch upload URL.', ['fasta_key'])
+    try:
+        obj = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
+    except ClientError as e:
+        print(f"Failed to read {key}: {e}")
+        return None, return_http_json(400, 'The uploaded FASTA file was not found.', ['fasta_key'])
+    if obj['ContentLength'] > MAX_BATCH_FASTA_BYTES:
+        return None, return_http_json(400, f'The uploaded FASTA file is too large (max size = {MAX_BATCH_FASTA_BYTES} bytes)', ['fasta_key'])
+    return obj['Body'].read().decode(), None
+
+# Create a batch job for many regions of one genome. Each region is a child job, with its own JobID, targets and
+# task counters, but only the parent job starts the pipeline: the genome is prepared once for all of them, and
+# the regions are scanned together by one TargetScan invocation.
+def create_batch_job(job_request, genome, context):
+    fasta, error = batch_fasta(job_request)
+    if error is not None:
+        return error
+
+    regions = parse_fasta(fasta)
+    if len(regions) == 0:
+        return return_http_json(400, 'The FASTA must contain at least one sequence.', ['fasta'])
+    elif len(regions) > MAX_BATCH_REGIONS:
+        return return_http_json(400, f'The FASTA has too many sequences (max = {MAX_BATCH_REGIONS})', ['fasta'])
+    for name, sequence in regions:
+        if len(sequence) == 0:
+            return return_http_json(400, f'The sequence of {name} is empty.', ['fasta'])
+        elif len(sequence) > int(MAX_SEQ_LENGTH):
+            return return_http_json(400, f'The sequence of {name} is too long (max length = {MAX_SEQ_LENGTH})', ['fasta'])
+    if sum(len(sequence) for _, sequence in regions) > MAX_BATCH_LENGTH:
+        return return_http_json(400, f'The sequences are too long in total (max length = {MAX_BATCH_LENGTH})', ['fasta'])
+
+    jobid = str(uuid.uuid4())
+    children = [{'JobID' : str(uuid.uuid4()), 'Name' : name} for name, _ in regions]
+
+    content = "\n".join(f">{name}\n{sequence}" for name, sequence in regions)
+    key, response = record_submission(job_request, genome, content, jobid, context, children)
+    if response is not None:
+        return response
+
+    try:
+        with taskTrackingTable.batch_writer() as batch:
+            for child in children:
+                batch.put_item(
+                    Item={
+                        'JobID' : child['JobID'],
+                        'NumGuides' : 0,
+                        'NumScoredOfftarget' : 0,
+                        'NumScoredOntarget': 0,
+                        'Version' : 0 # used to avoid race conditions. not to be facing the end-user
+                    }
+                )
+
+        # child jobs don't start the pipeline (the downloader does not receive jobs with a ParentJobID)
+        with jobTable.batch_writer() as batch:
+            for child, (name, sequence) in zip(children, regions):
+                batch.put_item(
+                    Item={
+                        'JobID' : child['JobID'],
+                        'ParentJobID' : jobid,
+                        'Name' : name,
+                        'Sequence' : sequence,
+                        'DateTime' : int(time()),
+                        'DateTimeHuman' : str(datetime.now()),
+                        'Genome' : genome
+                    }
+                )
+
+        # add the parent job to the jobs table last, as it starts the pipeline
+        jobTable.put_item(
+            Item={
+                'JobID' : jobid,
+                'Regions' : children,
+                'DateTime' : int(time()),
+                'DateTimeHuman' : str(datetime.now()),
+                'Genome' : genome
+            }
+        )
+    except Exception:
+        if key is not None:
+            release_submission(key, jobid)
+        raise
+
+    emit_metrics('CreateJob', {'BatchJobs' : 1, 'BatchRegions' : len(children)})
+
+    return return_job_json(context, jobid, Regions=children)
+
 def lambda_handler(event, context):
     if event['body']:
         try:
@@ -34,7 +239,8 @@ def lambda_handler(event, context):
         return return_http_json('No body sent with request',400)
 
     if 'sequence' in job_request:
-        sequence = job_request['sequence'].replace('\r\n', '').replace('\r', '').replace('\n', '').replace(' ', '')
+        # uppercased, as TargetScan only finds uppercase sites (and so that repeats are found whatever their case)
+        sequence = job_request['sequence'].replace('\r\n', '').replace('\r', '').replace('\n', '').replace(' ', '').upper()
         if len(sequence) == 0:
             return return_http_json(400, 'If specified, sequence must not be empty.', ['sequence'])
         elif len(sequence) > int(MAX_SEQ_LENGTH):
@@ -42,38 +248,42 @@ def lambda_handler(event, context):
 
     genome = job_request['genome']
 
+    # many regions of the genome, as a multi-FASTA
+    if 'fasta' in job_request or 'fasta_key' in job_request:
+        return create_batch_job(job_request, genome, context)
+
     jobid = str(uuid.uuid4())
 
-    # add to jobs table
-    jobTable.put_item(
-        Item={
-            'JobID' : jobid,
-            'Sequence' : sequence,
-            'DateTime' : int(time()),
-            'DateTimeHuman' : str(datetime.now()),
-            'Genome' : genome
-        }
-    )
-
-    # add to task tracking table
-    taskTrackingTable.put_item(
-        Item={
-            'JobID' : jobid,
-            'NumGuides' : 0,
-            'NumScoredOfftarget' : 0,
-            'NumScoredOntarget': 0,
-            'Version' : 0 # used to avoid race conditions. not to be facing the end-user
-        }
-    )
-    
-    body = json.dumps({
-        'aws_request_id' : context.aws_request_id,
-        'JobID' : jobid
-    })
+    # a repeat of a recent submission returns the job of the first one rather than running the pipeline again
+    key, response = record_submission(job_request, genome, sequence, jobid, context)
+    if response is not None:
+        return response
+
+    try:
+        # add to task tracking table before the job, as adding the job starts the pipeline
+        taskTrackingTable.put_item(
+            Item={
+                'JobID' : jobid,
+                'NumGuides' : 0,
+                'NumScoredOfftarget' : 0,
+                'NumScoredOntarget': 0,
+                'Version' : 0 # used to avoid race conditions. not to be facing the end-user
+            }
+        )
+
+        # add to jobs table
+        jobTable.put_item(
+            Item={
+                'JobID' : jobid,
+                'Sequence' : sequence,
+                'DateTime' : int(time()),
+                'DateTimeHuman' : str(datetime.now()),
+                'Genome' : genome
+            }
+        )
+    except Exception:
+        if key is not None:
+            release_submission(key, jobid)
+        raise
 
-    
-    return {
-        "statusCode": 200,
-        "headers": headers,
-        "body": body
-    }
\ No newline at end of file
+    return return_job_json(context, jobid)
\ No newline at end of file
@@ -2,6 +2,9 @@ import json
 import boto3
 import os
 import re
+import uuid
+
+from common_funcs import BATCH_UPLOAD_PREFIX
 
 #s3_client = boto3.client('s3', region_name='ap-southeast-2', endpoint_url='https://s3.ap-southeast-2.amazonaws.com')
 bucket_name = os.environ['BUCKET_NAME']
@@ -48,6 +51,31 @@ def lambda_handler(event, context):
                     }
                 }
             
+            # URL to upload the multi-FASTA of a batch job to, for FASTA files too large to send to /submit.
+            # The returned key is then submitted as the job's `fasta_key`.
+            elif action == 'generate_batch_upload_url':
+
+                key = f"{BATCH_UPLOAD_PREFIX}{uuid.uuid4()}.fa"
+                presigned_url = s3_client.generate_presigned_url('put_object',
+                                                            Params={'Bucket': bucket_name, 
+                                                                    'Key':   key, 
+                                                                    'ContentType': event['queryStringParameters'].get('file_type', 'text/plain')},
+                                                            ExpiresIn=3600)
+
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({
+                        'url': presigned_url,
+                        'key': key
+                    }),
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*',
+                        'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                        'Access-Control-Allow-Headers': 'Content-Type'
+                    }
+                }
+
             elif action == 'list_data':
 
 
@@ -55,7 +83,7 @@ def lambda_handler(event, context):
                 objects = [prefix['Prefix'].rstrip('/') for prefix in response.get('CommonPrefixes', [])]
                 # remove genomes from NCBI to just show custom datasets 
                 genome_accession_pattern = re.compile(r'^(GCA|GCF)_\d{9}\.\d+$')
-                filtered_objects = [obj for obj in objects if not genome_accession_pattern.match(obj) and obj != 'Test_Packages']
+                filtered_objects = [obj for obj in objects if not genome_accession_pattern.match(obj) and obj not in ['Test_Packages', BATCH_UPLOAD_PREFIX.rstrip('/')]]
                 print("Top-level custom directories:", filtered_objects)
 
                 return {
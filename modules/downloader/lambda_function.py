@@ -6,6 +6,7 @@ from time import time, time_ns
 from botocore.exceptions import ParamValidationError
 
 from common_funcs import *
+from ncbi_client import *
 
 
 try:
@@ -17,12 +18,23 @@ except ImportError:
 S3_BUCKET = os.environ['BUCKET']
 TARGET_SCAN_QUEUE = os.environ['TARGET_SCAN_QUEUE']
 ISSL_QUEUE = os.getenv('ISSL_QUEUE')
-LIST_PREFIXES = [".issl", ".offtargets"]
 FILE_PARTS_QUEUE = os.getenv('FILE_PARTS_QUEUE')
+GENOMES_TABLE = os.getenv('GENOMES_TABLE')
+JOBS_TABLE = os.getenv('JOBS_TABLE')
+TASK_TRACKING_TABLE = os.getenv('TASK_TRACKING_TABLE')
+# Files larger than this are downloaded in parts by many partloader invocations
+MIN_MULTIPART_FILE_SIZE = 50000000
+# Size of each part of a multipart upload (at least 5 MiB for S3). Larger files use larger parts, as an upload has
+# at most 10,000 parts.
+FILE_PART_MB = int(os.getenv('FILE_PART_MB', 32))
+MAX_UPLOAD_PARTS = 10000
+# Number of partloader invocations a file is split between, each downloading a run of consecutive parts
+FILE_PART_PARALLELISM = int(os.getenv('FILE_PART_PARALLELISM', 16))
 
 # Create S3 client
 s3_client = boto3.client('s3')
 s3_resource = boto3.resource('s3')
+dynamodb = boto3.resource('dynamodb')
 
 
 
@@ -70,6 +82,25 @@ def retrieve_fasta_meta_data(genome_accession):
         print(f"Error downloading file: {e}")
 
 
+# Finds the .fna files of a genome accession on the NCBI server, from the listing cached in the genomes table
+# if there is one. Otherwise they are listed over HTTPS (or FTP, if that fails) and the listing is cached.
+def fasta_meta_data(genome_accession):
+    listing = ncbi_cached_listing(dynamodb, GENOMES_TABLE, genome_accession)
+    if listing is not None:
+        print(f"Using the cached listing of {genome_accession}")
+        return listing
+
+    try:
+        listing = ncbi_fasta_listing(genome_accession)
+    except Exception as e:
+        print(f"Error listing {genome_accession} over HTTPS: {e}")
+        listing = retrieve_fasta_meta_data(genome_accession)
+
+    if listing is not None:
+        ncbi_cache_listing(dynamodb, GENOMES_TABLE, genome_accession, *listing)
+    return listing
+
+
 # Starts a multipart upload to S3 and returns the upload ID
 def start_part_upload(bucket_name, genome_accession, filename):
     object_key = f"{genome_accession}/fasta/{filename}"
@@ -91,8 +122,6 @@ def file_parts(genome_accession, http_url, fna_file_details, json_object):
     if isinstance(json_object, str):
         json_object = json.loads(json_object)
 
-    min_multipart_file_size = 50000000
-
     for file in fna_file_details:
         chosen_file_name = file["file_name"]
         chosen_file_size = file["file_size"]
@@ -100,7 +129,7 @@ def file_parts(genome_accession, http_url, fna_file_details, json_object):
         file_http_url = f"{http_url}/{chosen_file_name}"
         object_key = f"{genome_accession}/fasta/{chosen_file_name}"
 
-        if chosen_file_size <= min_multipart_file_size:
+        if chosen_file_size <= MIN_MULTIPART_FILE_SIZE:
             # single part file
             part_info = {
                 "Genome": json_object["Genome"], 
@@ -114,24 +143,24 @@ def file_parts(genome_accession, http_url, fna_file_details, json_object):
                 "start_byte": 0,
                 "end_byte": chosen_file_size - 1,
                 "upload_id": None,
-                "object_key": object_key
+                "object_key": object_key,
+                "md5": file.get("md5")
             }
             result.append(part_info)
 
         else:
 
-            part_size = 50000000 # Maximum size of each part in megabytes
-            num_file_parts = math.ceil(chosen_file_size/ part_size)
-
-
-            # num_file_parts = 7   # this detemines how many parts the file is going to split into 
-            # part_size = math.ceil(chosen_file_size / num_file_parts)  # Size of each part
+            # The file is uploaded in parts of part_size bytes, and each message covers a run of parts_per_task
+            # of them, which the partloader downloads and uploads concurrently
+            part_size = max(FILE_PART_MB * 1048576, math.ceil(chosen_file_size / MAX_UPLOAD_PARTS))
+            num_file_parts = math.ceil(chosen_file_size / part_size)
+            parts_per_task = math.ceil(num_file_parts / FILE_PART_PARALLELISM)
 
             # initialise the multipart upload
             upload_id = start_part_upload(S3_BUCKET, genome_accession, chosen_file_name)
-            for i in range(num_file_parts):
+            for i in range(0, num_file_parts, parts_per_task):
                 start_byte = i * part_size
-                end_byte = min((i + 1) * part_size - 1, chosen_file_size - 1)
+                end_byte = min((i + parts_per_task) * part_size, chosen_file_size) - 1
                 
                 part_info = {
                     "Genome": json_object["Genome"], 
@@ -143,10 +172,12 @@ def file_parts(genome_accession, http_url, fna_file_details, json_object):
                     "filename": chosen_file_name,
                     "file_url": file_http_url,
                     "part": i+1,
+                    "part_size": part_size,
                     "start_byte": start_byte,
                     "end_byte": end_byte,
                     "upload_id": upload_id,
-                    "object_key": object_key
+                    "object_key": object_key,
+                    "md5": file.get("md5")
                 }
                 
                 result.append(part_info)
@@ -154,18 +185,9 @@ def file_parts(genome_accession, http_url, fna_file_details, json_object):
     return result
 
 
+# An accession is indexed once it has an .issl file, or a manifest listing its shards (see `issl_index_names`)
 def is_issl_in_s3(accession):
-    s3_destination_path = f"{accession}/issl"
-    s3_multipart_destination_part2 =  f"{accession}/issl"
-    #issl and offtarget files based on accession
-    files_to_expect = []
-    for prefix in LIST_PREFIXES:
-        files_to_expect.append(accession + prefix)
-
-    actual = files_exist_s3_dir(s3_client, S3_BUCKET, s3_destination_path, files_to_expect)
-    test = files_exist_s3_dir(s3_client, S3_BUCKET, s3_multipart_destination_part2, files_to_expect)
-
-    return actual, test
+    return issl_index_names(s3_client, S3_BUCKET, accession) is not None
 
 
 def is_fasta_in_s3_multipart(accession):
@@ -185,14 +207,37 @@ def is_fasta_in_s3_multipart(accession):
         return False
 
 
-def lambda_handler(event, context):
-    
-    print(event)
-    
-    # DynamoDB data rec code
-    accession = event['Records'][0]["dynamodb"]["NewImage"]["Genome"]["S"]
-    jobid = event['Records'][0]["dynamodb"]["NewImage"]["JobID"]["S"]
-    sequence = event['Records'][0]['dynamodb']["NewImage"]["Sequence"]["S"]
+# Whether the FASTA files and the ISSL index of a genome are in S3. The genome's manifest records them as they are
+# uploaded and built, so one read tells whether they are all there. Genomes without one (e.g. uploaded as custom
+# data, or downloaded before manifests were kept) are looked up in S3.
+def genome_files_exist(accession):
+    manifest = genome_manifest(dynamodb, GENOMES_TABLE, accession)
+    if manifest is not None and 'NumFastaFiles' in manifest:
+        fasta_exists = manifest_fasta(manifest) is not None
+    else:
+        fasta_exists = is_fasta_in_s3_multipart(accession)
+
+    if manifest is not None:
+        issl_exists = 'Issl' in manifest
+    else:
+        issl_exists = is_issl_in_s3(accession)
+
+    return fasta_exists, issl_exists
+
+
+# Start the preparation of the genome of a new job (the new image of its record in the jobs table stream), or send
+# the job to the scoring process if the genome is ready
+def start_job(newImage):
+    # the child jobs of a batch job are scanned along with their parent, which is prepared for once. They are
+    # filtered out of the stream, but are also ignored here in case they are not.
+    if "ParentJobID" in newImage:
+        print(f"Job {newImage['JobID']['S']} is part of a batch job")
+        return
+
+    accession = newImage["Genome"]["S"]
+    jobid = newImage["JobID"]["S"]
+    # a batch job has no sequence of its own: its regions are the sequences of its child jobs
+    sequence = newImage.get("Sequence", {"S" : ""})["S"]
     body ={ 
         "Genome": accession, 
         "Sequence": sequence, 
@@ -201,15 +246,51 @@ def lambda_handler(event, context):
     json_object = json.dumps(body)
 
     if accession == 'fail':
-        sys.exit('Error: No accession found.')
-
-    actual_issl_exists, mulit_part_issl = is_issl_in_s3(accession)
-    
-    ## future me - in terms of fasta, ensure all files for accession are present
-    # so don't just check if there is one file... but also how many files
-
-    if not is_fasta_in_s3_multipart(accession):
-        http_url, fna_file_details = retrieve_fasta_meta_data(accession)
+        print('Error: No accession found.')
+        return
+
+    fasta_exists, issl_exists = genome_files_exist(accession)
+    if fasta_exists and issl_exists:
+        print ("Issl file has already been generated. Moving to scoring process")
+        sqs_send_message(TARGET_SCAN_QUEUE, json_object) 
+        return
+
+    # Only one job downloads and indexes a genome. Jobs that need it in the meantime wait for it to be READY,
+    # when they are sent to the scoring process (see genome_lock_claim).
+    # A FAILED lock can be claimed straight away, so the claim is tried again if the genome failed in the meantime.
+    while not genome_lock_claim(dynamodb, GENOMES_TABLE, accession, jobid, 'INDEXING' if fasta_exists else 'DOWNLOADING'):
+        print(f"{accession} is already being prepared for another job, waiting for it")
+        if genome_lock_wait(dynamodb, GENOMES_TABLE, accession, jobid, json_object, TARGET_SCAN_QUEUE):
+            return
+        print(f"Preparing {accession} failed, claiming it again")
+
+    # the job holds the lock from here on, so if preparing the genome fails the lock is failed (and the jobs
+    # waiting for it with it) rather than left to expire
+    try:
+        prepare_genome(accession, jobid, json_object)
+    except Exception as e:
+        jobs = genome_lock_fail(dynamodb, GENOMES_TABLE, accession, jobid)
+        fail_jobs(dynamodb, JOBS_TABLE, TASK_TRACKING_TABLE, jobs, f"Preparing {accession} failed: {e}")
+        raise
+
+
+# Download or index the genome of a job that holds its lock
+def prepare_genome(accession, jobid, json_object):
+    # a READY lock can be claimed (for genomes whose index is missing), so the genome may have become READY since
+    # it was looked up. It is then marked READY again rather than downloaded and indexed a second time.
+    fasta_exists, issl_exists = genome_files_exist(accession)
+    if fasta_exists and issl_exists:
+        print(f"{accession} became ready while claiming its lock. Moving to scoring process")
+        genome_lock_ready(dynamodb, GENOMES_TABLE, accession, TARGET_SCAN_QUEUE)
+        sqs_send_message(TARGET_SCAN_QUEUE, json_object)
+        return
+
+    if not fasta_exists:
+        listing = fasta_meta_data(accession)
+        if listing is None:
+            raise Exception(f"The FASTA files of {accession} could not be listed")
+        http_url, fna_file_details = listing
+        genome_manifest_start(dynamodb, GENOMES_TABLE, accession, [file['file_name'] for file in fna_file_details])
         file_names = file_parts(accession, http_url, fna_file_details, json_object)
         print("The fasta files have yet to be created")
         for file in file_names:
@@ -217,15 +298,31 @@ def lambda_handler(event, context):
             sqs_send_message(FILE_PARTS_QUEUE, MessageBody)
         print(file_names)
     else:
-        if  mulit_part_issl:
-            print ("Issl file has already been generated. Moving to scoring process")
-            sqs_send_message(TARGET_SCAN_QUEUE, json_object) 
-            print("All Done... Terminating Program.")
-        else:
-            print("The fasta files exist but the issl ones do not")
-            sqs_send_message(ISSL_QUEUE, json_object)
+        print("The fasta files exist but the issl ones do not")
+        sqs_send_message(ISSL_QUEUE, json_object)
+
+
+def lambda_handler(event, context):
+    
+    print(event)
+
+    # DynamoDB data rec code. The stream delivers records in batches, e.g. the parent of a batch job after its
+    # child jobs, so every record is handled, and one that fails doesn't stop the others.
+    failed = 0
+    for record in event['Records']:
+        # only new jobs are started (not updates or removals of job records)
+        if record.get("eventName", "INSERT") != "INSERT" or "NewImage" not in record["dynamodb"]:
+            continue
+        try:
+            start_job(record["dynamodb"]["NewImage"])
+        except Exception as e:
+            print(f"Error starting job {record['dynamodb']['NewImage'].get('JobID')}: {e}")
+            failed += 1
 
     print("All Done... Terminating Program.")
+    if failed:
+        raise Exception(f"Failed to start {failed} of {len(event['Records'])} jobs")
+
 
 if __name__== "__main__":
     event, context = local_lambda_invocation()
@@ -1,5 +1,5 @@
 import json, boto3, os, re, shutil, tempfile, sys
-from time import time_ns
+from time import time, time_ns
 from subprocess import call
 
 from common_funcs import *
@@ -13,6 +13,8 @@ targets_table_name = os.getenv('TARGETS_TABLE', 'TargetsTable')
 jobs_table_name = os.getenv('JOBS_TABLE', 'JobsTable')
 task_tracking_table_name = os.getenv('TASK_TRACKING_TABLE')
 issl_queue_url = os.getenv('ISSL_QUEUE', 'IsslQueue')
+genomes_table_name = os.getenv('GENOMES_TABLE')
+score_cache_table_name = os.getenv('SCORE_CACHE_TABLE')
 
 #boto3 aws clients
 dynamodb = boto3.resource('dynamodb')
@@ -22,12 +24,57 @@ sqs_client = boto3.client('sqs')
 s3_bucket = os.environ['BUCKET']
 s3_client = boto3.client('s3')
 s3_resource = boto3.resource('s3')
+s3_download_client = s3_transfer_client()
 
 #Set max size of 9500MB to allow for scoring operations
 MAX_EPHEMERAL_STORAGE_SIZE = 9500
 #byte -> megabyte magnitude
 BYTE_TO_MB_DIVIDER = 1048576
 
+# .issl indexes are kept in /tmp so that warm containers can reuse them across invocations
+ISSL_CACHE_DIR = os.getenv('ISSL_CACHE_DIR', '/tmp/issl_cache')
+# Seconds a cached index is trusted before its ETag is checked against S3 again
+ISSL_CACHE_REVALIDATE_SECONDS = int(os.getenv('ISSL_CACHE_REVALIDATE_SECONDS', 3600))
+
+# key: genome, value: dict with the names of the genome's indexes, one per shard for large genomes, and the ETag
+# and size of each when the genome's manifest records them (Names, Files, Validated)
+isslIndexes = {}
+# key: index name, value: dict describing the cached index (Genome, ETag, Size, Path, LastUsed, Validated)
+isslCache = {}
+os.makedirs(ISSL_CACHE_DIR, exist_ok=True)
+
+# Indexes cached before the function was initialised again in the same container are still in ISSL_CACHE_DIR.
+# They are added to the cache, so that they count against the ephemeral storage and can be evicted, and are checked
+# against S3 before they are used. Partial downloads, and all but the newest copy of an index, are removed.
+def loadCacheDir():
+    for name in os.listdir(ISSL_CACHE_DIR):
+        index_dir = os.path.join(ISSL_CACHE_DIR, name)
+        if not os.path.isdir(index_dir):
+            continue
+        copies = sorted(
+            (os.path.join(index_dir, f) for f in os.listdir(index_dir)),
+            key=os.path.getmtime
+        )
+        complete = [fp for fp in copies if fp.endswith('.issl')]
+        for fp in copies:
+            if not complete or fp != complete[-1]:
+                os.remove(fp)
+        if not complete:
+            continue
+
+        isslCache[name] = {
+            'Genome' : name.split('.shard')[0],
+            'ETag' : os.path.basename(complete[-1])[:-len('.issl')],
+            'Size' : os.path.getsize(complete[-1]),
+            'Path' : complete[-1],
+            'LastUsed' : os.path.getmtime(complete[-1]),
+            'Validated' : 0
+        }
+    if isslCache:
+        print(f"Found {len(isslCache)} cached index(es) in {ISSL_CACHE_DIR}")
+
+loadCacheDir()
+
 TARGETS_TABLE = dynamodb.Table(targets_table_name)
 JOBS_TABLE = dynamodb.Table(jobs_table_name)
 
@@ -35,7 +82,8 @@ def caller(*args, **kwargs):
     print(f"Calling: {args}")
     call(*args, **kwargs)
 
-def CalcIssl(targets, genome_issl_file):
+# Score guides (20-mers) against one .issl index. Returns the score of each guide, or None where there is none.
+def isslScores(guides, issl_file):
     tmpToScore = tempfile.NamedTemporaryFile('w', delete=False)
     tmpScored = tempfile.NamedTemporaryFile('w', delete=False)
 
@@ -43,14 +91,14 @@ def CalcIssl(targets, genome_issl_file):
 
     # Create a temporary file containing a list of candidate guides to score
     with open(tmpToScore.name, 'w+') as fp:
-        fp.write("\n".join([target['Seq'][0:20] for target in targets]))
+        fp.write("\n".join(guides))
         fp.write("\n")
 
     # call the scoring method
     caller(
         ["{} \"{}\" \"{}\" \"{}\" \"{}\" > \"{}\"".format(
             BIN_ISSL_SCORER,
-            genome_issl_file,
+            issl_file,
             tmpToScore.name,
             '4',
             '75',
@@ -59,12 +107,32 @@ def CalcIssl(targets, genome_issl_file):
         shell = True
     )
 
-    # Extract the score and associate it with the candidate guide
+    # Extract the score of each candidate guide
+    scores = [None] * len(guides)
     with open(tmpScored.name, 'r') as fp:
         lines = [x.split('\t') for x in fp.readlines()]
         for idx, targetScored in enumerate(lines):
             if len(targetScored) == 2:
-                targets[idx]['Score'] = float(targetScored[1].strip())
+                scores[idx] = float(targetScored[1].strip())
+
+    # /tmp is shared with the index cache, so do not leave these behind in warm containers
+    os.remove(tmpToScore.name)
+    os.remove(tmpScored.name)
+
+    return scores
+
+# Score the targets against a genome's index files. The shards of a sharded index are scored in parallel and
+# the scores of each guide are combined into its score against the whole genome.
+def CalcIssl(targets, genome_issl_files):
+    guides = [target['Seq'][0:20] for target in targets]
+
+    with ThreadPoolExecutor(max_workers=len(genome_issl_files)) as executor:
+        shardScores = list(executor.map(lambda issl_file: isslScores(guides, issl_file), genome_issl_files))
+
+    for idx, target in enumerate(targets):
+        score = combine_issl_scores([scores[idx] for scores in shardScores])
+        if score is not None:
+            target['Score'] = score
 
     return targets
     
@@ -73,16 +141,59 @@ def CalcIssl(targets, genome_issl_file):
 # HELPER FUNCS
 # ----------------------
 
-# Function to store number of targets and .issl file size by genome
-def getGenomeBatchData(genomes):
+# Returns the names of a genome's .issl indexes: the genome itself, or one per shard. They are read from the
+# genome's manifest, or found in S3 for genomes without one (see `issl_index_names`), and not looked up again
+# when they were read recently.
+def getIsslIndexNames(genome):
+    entry = isslIndexes.get(genome)
+    if entry and time() - entry['Validated'] < ISSL_CACHE_REVALIDATE_SECONDS:
+        return entry['Names']
+
+    manifest = genome_manifest(dynamodb, genomes_table_name, genome)
+    if manifest is not None and 'Issl' in manifest:
+        names, files = manifest['Issl']['Names'], manifest['Issl']['Files']
+    else:
+        names, files = issl_index_names(s3_client, s3_bucket, genome), {}
+    if names is None:
+        print(f'Failure - The required issl file is missing for {genome}')
+        raise FileNotFoundError(f"No issl index for {genome}")
+
+    isslIndexes[genome] = {'Names' : names, 'Files' : files, 'Validated' : time()}
+    return names
+
+# Returns the ETag and size (bytes) of one of a genome's .issl files, from the genome's manifest if it records
+# them. S3 is not queried when the cached copy was validated recently.
+def getIsslObjectInfo(genome, name):
+    entry = isslCache.get(name)
+    if entry and time() - entry['Validated'] < ISSL_CACHE_REVALIDATE_SECONDS:
+        return entry['ETag'], entry['Size']
+
+    info = isslIndexes.get(genome, {}).get('Files', {}).get(name)
+    if info is not None:
+        etag, size = info['ETag'], int(info['Size'])
+    else:
+        try:
+            response = s3_client.head_object(Bucket=s3_bucket, Key=f"{genome}/issl/{name}.issl")
+        except ClientError as e:
+            print(f'Failure - The required issl file is missing for {genome}')
+            raise e
+        etag, size = response['ETag'].strip('"'), response['ContentLength']
+
+    if entry and entry['ETag'] == etag:
+        entry['Validated'] = time()
+
+    return etag, size
+
+# Function to store the total .issl file size (MB) by genome
+def getGenomeBatchData(objectInfo):
     return {
-        genome : s3_get_file_size(s3_client, s3_bucket, f"{genome}/issl/{genome}.issl") / BYTE_TO_MB_DIVIDER
-        for genome in genomes
+        genome : sum(size for etag, size in indexes.values()) / BYTE_TO_MB_DIVIDER
+        for genome, indexes in objectInfo.items()
     }
 
 #Function to reduce by size of batch genome list and compare with max size
 def canLambdaStore(issl_dict):
-    return sum(issl_dict.values()) > MAX_EPHEMERAL_STORAGE_SIZE
+    return sum(issl_dict.values()) <= MAX_EPHEMERAL_STORAGE_SIZE
 
 # returns list of genomes that fit criteria and do not over exceed local storage
 def determine_genomes_to_download(issl_dict):
@@ -99,38 +210,124 @@ def determine_genomes_to_download(issl_dict):
 
     return genomesToDownload
 
-def s3_to_tmp(tmp_dir, accession):
-    fp = f"{tmp_dir}/{accession}.issl"
+# Remove an index from the cache
+def evictFromCache(name):
+    entry = isslCache.pop(name)
+    print(f"Evicting {name} ({entry['Size'] / BYTE_TO_MB_DIVIDER:.0f} MB) from the issl cache")
+    if os.path.exists(entry['Path']):
+        os.remove(entry['Path'])
 
-    s3_resource.meta.client.download_file(
-        s3_bucket, 
-        f"{accession}/issl/{accession}.issl", # file in S3
-        fp # local filesystem
+# Evict least recently used indexes (other than those in `keep`) until `requiredMB` fits in ephemeral storage
+def makeSpaceInCache(requiredMB, keep):
+    usedMB = sum(entry['Size'] for entry in isslCache.values()) / BYTE_TO_MB_DIVIDER
+    
+    for name in sorted(isslCache, key=lambda x: isslCache[x]['LastUsed']):
+        if usedMB + requiredMB < MAX_EPHEMERAL_STORAGE_SIZE:
+            break
+        if name in keep:
+            continue
+        usedMB -= isslCache[name]['Size'] / BYTE_TO_MB_DIVIDER
+        evictFromCache(name)
+
+# Local path that an index (a genome's .issl file, or one of its shards) is cached at
+def cachePath(name, etag):
+    index_dir = os.path.join(ISSL_CACHE_DIR, name)
+    os.makedirs(index_dir, exist_ok=True)
+    return os.path.join(index_dir, f"{etag}.issl")
+
+# Download many .issl files concurrently into the cache. `indexInfo` maps index names to (genome, etag, size).
+def s3_to_cache(indexInfo):
+    # download to a temporary name so a failed download is never mistaken for a cached index
+    s3_download_files(
+        s3_download_client,
+        s3_bucket,
+        [
+            (f"{genome}/issl/{name}.issl", f"{cachePath(name, etag)}.part")
+            for name, (genome, etag, size) in indexInfo.items()
+        ]
     )
+
+    paths = {}
+    for name, (genome, etag, size) in indexInfo.items():
+        fp = cachePath(name, etag)
+        os.replace(f"{fp}.part", fp)
+
+        isslCache[name] = {
+            'Genome' : genome,
+            'ETag' : etag,
+            'Size' : size,
+            'Path' : fp,
+            'LastUsed' : time(),
+            'Validated' : time()
+        }
+        paths[name] = fp
     
-    return fp
+    return paths
+
+# Returns the local paths of each genome's .issl files, downloading only those not already cached
+def cachedGenomeDownload(list_to_download, objectInfo):
+    indexInfo = {
+        name : (genome, etag, size)
+        for genome in list_to_download
+        for name, (etag, size) in objectInfo[genome].items()
+    }
+    paths = {}
+    hits, misses, bytesSaved, bytesDownloaded = 0, 0, 0, 0
+
+    # indexes that were rebuilt since they were cached are stale
+    for name in indexInfo:
+        if name in isslCache and isslCache[name]['ETag'] != indexInfo[name][1]:
+            evictFromCache(name)
+
+    toDownload = [name for name in indexInfo if name not in isslCache]
+    makeSpaceInCache(
+        sum(indexInfo[name][2] for name in toDownload) / BYTE_TO_MB_DIVIDER,
+        keep=indexInfo
+    )
+
+    for name, (genome, etag, size) in indexInfo.items():
+        if name in isslCache:
+            hits += 1
+            bytesSaved += size
+            isslCache[name]['LastUsed'] = time()
+            paths[name] = isslCache[name]['Path']
+        else:
+            misses += 1
+            bytesDownloaded += size
+
+    # all missing indexes are fetched at once
+    paths.update(s3_to_cache({name : indexInfo[name] for name in toDownload}))
+
+    print(f"issl cache: {hits} hit(s), {misses} miss(es), {bytesSaved / BYTE_TO_MB_DIVIDER:.0f} MB not downloaded")
+    emit_metrics('IsslIndexCache', {
+        'CacheHits' : hits,
+        'CacheMisses' : misses,
+        'BytesSaved' : bytesSaved,
+        'BytesDownloaded' : bytesDownloaded
+    }, units = {'BytesSaved' : 'Bytes', 'BytesDownloaded' : 'Bytes'})
 
-def sequentialGenomeDownload(tmp_dir, list_to_download):
     return {
-        genome : s3_to_tmp(tmp_dir, genome)
+        genome : [paths[name] for name in objectInfo[genome]]
         for genome in list_to_download
     }
 
-def downloadIsslFiles(genomes, tmp_dir):
+def downloadIsslFiles(genomes):
     if len(genomes) <= 0:
         print('Failure - No targets required to score')
 
-    if not issl_files_exist_s3(s3_client, s3_bucket, genomes):
-        print('Failure - The required issl files are missing')
-
-    genomes_batch_info = getGenomeBatchData(genomes)
+    # key: genome, value: dict of index name to (etag, size)
+    objectInfo = {
+        genome : {name : getIsslObjectInfo(genome, name) for name in getIsslIndexNames(genome)}
+        for genome in genomes
+    }
+    genomes_batch_info = getGenomeBatchData(objectInfo)
 
     if not canLambdaStore(genomes_batch_info):
         genomes_to_download = determine_genomes_to_download(genomes_batch_info)
-        return sequentialGenomeDownload(tmp_dir, genomes_to_download), True
+        return cachedGenomeDownload(genomes_to_download, objectInfo), True
 
     else:
-        return sequentialGenomeDownload(tmp_dir, genomes), False
+        return cachedGenomeDownload(genomes, objectInfo), False
 
 def resendGenomeToSQS(entries):
     print("Sending back to sqs")
@@ -167,6 +364,9 @@ def lambda_handler(event, context):
     
     # SQS message 
     receiptMessages = {}
+
+    # SQS receipt handles of messages for jobs that no longer exist
+    unmatchedHandles = []
     
     print(event)
 
@@ -174,55 +374,61 @@ def lambda_handler(event, context):
     # ARRANGING DATA STRUCTURE 
     #-----------------------------
     
-    # Create dictionary mapping jobid to genome for all messages in SQS batch
+    # Create dictionary mapping jobid to genome for all messages in SQS batch.
+    # Each message is an envelope of many guides for one job (or a single guide in the legacy format).
     for record in event['Records']:
         try:
             body = json.loads(record['body'])
-            message = json.loads(body['default'])
+            _, messages = unpack_target_envelope(body)
         except Exception as e:
             print(f"Exception: {e}")
             continue
 
-        if not all([x in message for x in ['Sequence', 'JobID', 'TargetID']]):
-            print(f'Missing core data to perform off-target scoring: {message}')
-            continue
-            
-        jobId = message['JobID']
-
-        if jobId not in jobToNumTargets:
-            jobToNumTargets[jobId] = 0
-
-        if jobId not in jobToGenome:
-            # Fetch the job information so it is known which genome to use
-            result = dynamodb_client.get_item(
-                TableName = jobs_table_name,
-                Key = {
-                    'JobID' : {'S' : jobId}
-                }
-            )
-
-            # Extract genome from fetched result
-            if 'Item' in result:
-                genome = result['Item']['Genome']['S']
-                jobToGenome[jobId] = genome
-                genomeToTargets[genome] = []
-                receiptMessages[genome] = []
-            
-            # Error - Empty fetched result from dynamodb
-            else:
-                print(f'No matching JobID: {jobId}???')
-                receiptHandles.append(record['receiptHandle'])
+        genome = None
+        for message in messages:
+            if not all([x in message for x in ['Sequence', 'JobID', 'TargetID']]):
+                print(f'Missing core data to perform off-target scoring: {message}')
                 continue
-        else:
-            genome = jobToGenome[jobId]
-
-        # Map guide sequences to genome and prepare dictionary structure for scoring in next iteration
-        genomeToTargets[genome].append({
-            'JobID'     : jobId,
-            'TargetID'  : message['TargetID'],
-            'Seq'       : message['Sequence'],
-            'Score'     : None
-        })
+                
+            jobId = message['JobID']
+
+            if jobId not in jobToNumTargets:
+                jobToNumTargets[jobId] = 0
+
+            if jobId not in jobToGenome:
+                # Fetch the job information so it is known which genome to use
+                result = dynamodb_client.get_item(
+                    TableName = jobs_table_name,
+                    Key = {
+                        'JobID' : {'S' : jobId}
+                    }
+                )
+
+                # Extract genome from fetched result
+                if 'Item' in result:
+                    genome = result['Item']['Genome']['S']
+                    jobToGenome[jobId] = genome
+                    genomeToTargets.setdefault(genome, [])
+                    receiptMessages.setdefault(genome, [])
+                
+                # Error - Empty fetched result from dynamodb
+                else:
+                    print(f'No matching JobID: {jobId}???')
+                    continue
+            else:
+                genome = jobToGenome[jobId]
+
+            # Map guide sequences to genome and prepare dictionary structure for scoring in next iteration
+            genomeToTargets[genome].append({
+                'JobID'     : jobId,
+                'TargetID'  : message['TargetID'],
+                'Seq'       : message['Sequence'],
+                'Score'     : None
+            })
+
+        if genome is None:
+            unmatchedHandles.append(record['receiptHandle'])
+            continue
         
         #keep track of message sent by target scan function in case of resending required
         receiptMessages[genome].append(body)
@@ -233,11 +439,9 @@ def lambda_handler(event, context):
     # DETERMINING AVAILABLE SPACE
     #------------------------------------
 
-    # get temp folder to download the issl files into
-    tmp_dir = get_tmp_dir()
-
-    # determine if local storage can download required issl files and remove unnecessary details if need be
-    downloaded_genomes, skip_flag = downloadIsslFiles(list(genomeToTargets.keys()), tmp_dir)
+    # determine if local storage can download required issl files and remove unnecessary details if need be.
+    # indexes are kept in the cache after scoring for later invocations of this container.
+    downloaded_genomes, skip_flag = downloadIsslFiles(list(genomeToTargets.keys()))
     if (skip_flag):
 
         genomes_to_remove = [genome for genome in genomeToTargets if genome not in downloaded_genomes]
@@ -248,7 +452,7 @@ def lambda_handler(event, context):
 
             resendGenomeToSQS(receiptMessages.pop(genome))
 
-    receiptHandles = [item for row in list(receiptHandles.values()) for item in row]
+    receiptHandles = [item for row in list(receiptHandles.values()) for item in row] + unmatchedHandles
 
     #-------------------------------
     # SCORING
@@ -258,19 +462,39 @@ def lambda_handler(event, context):
     for genome in genomeToTargets:
         targetsScored = CalcIssl(genomeToTargets[genome], downloaded_genomes[genome])
 
-        for result in targetsScored:
-
-            TARGETS_TABLE.update_item(
-                Key={'JobID': result['JobID'], 'TargetID': result['TargetID']},
-                UpdateExpression='set IsslScore = :score',
-                ExpressionAttributeValues={':score': json.dumps(result['Score'])}
-            )
-
-            #jobToNumTargets[result['JobID']] += 1
-            update_task_counter(dynamodb, task_tracking_table_name, result['JobID'], "NumScoredOfftarget", 1)
+        # write the scores of the whole batch concurrently
+        dynamodb_update_items(dynamodb_client, targets_table_name, [
+            {
+                'Key' : {'JobID': result['JobID'], 'TargetID': result['TargetID']},
+                'UpdateExpression' : 'set IsslScore = :score',
+                'ExpressionAttributeValues' : {':score': json.dumps(result['Score'])}
+            }
+            for result in targetsScored
+        ])
 
-    if os.path.exists(tmp_dir):
-        shutil.rmtree(tmp_dir)  
+        for result in targetsScored:
+            jobToNumTargets[result['JobID']] += 1
+
+        # cache the scores for later jobs, with the version of the index files they were computed with (the ETags
+        # of the cached copies, which may be older than the index in S3). Scoring does not fail if they can't be
+        # cached.
+        if score_cache_table_name:
+            try:
+                version = issl_index_version({name : isslCache[name]['ETag'] for name in isslIndexes[genome]['Names']})
+                dynamodb_update_items(dynamodb_client, score_cache_table_name, [
+                    score_cache_update(genome, result['Seq'], {
+                        'IsslScore' : json.dumps(result['Score']),
+                        'IsslVersion' : version
+                    })
+                    for result in targetsScored if result['Score'] is not None
+                ])
+            except Exception as e:
+                print(f"Error caching the scores of {genome}: {e}")
+
+    # Update task counter for each job, once per batch
+    for jobId in jobToNumTargets:
+        if jobToNumTargets[jobId] > 0:
+            increment_job_counters(dynamodb, task_tracking_table_name, jobId, {"NumScoredOfftarget" : jobToNumTargets[jobId]})
 
     #------------------------------
     # REMOVAL FROM QUEUE
@@ -289,7 +513,3 @@ def lambda_handler(event, context):
                 for delete in toDelete
             ]
         )
-
-    # Update task counter for each job
-    #for jobId in jobToNumTargets:
-    #    update_task_counter(dynamodb, task_tracking_table_name, jobId, "NumScoredOfftarget", jobToNumTargets[jobId])
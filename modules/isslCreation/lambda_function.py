@@ -1,6 +1,7 @@
-import sys, os, shutil, boto3
+import sys, os, shutil, boto3, math, signal
 import zipfile, gzip
 import tempfile
+import multiprocessing
 
 from threading import Thread
 from botocore.exceptions import ClientError, ParamValidationError
@@ -18,14 +19,45 @@ except:
 # Global variables
 s3_bucket = os.environ['BUCKET']
 TARGET_SCAN_QUEUE = os.environ['QUEUE']
+#queue of this function, used to start the tasks of the map/reduce build of large genomes
+ISSL_QUEUE = os.getenv('ISSL_QUEUE')
+#table tracking the progress of map/reduce builds
+ISSL_BUILDS_TABLE = os.getenv('ISSL_BUILDS_TABLE')
+#table of the per-genome build locks, and the jobs waiting for genomes to be indexed
+GENOMES_TABLE = os.getenv('GENOMES_TABLE')
+#jobs are marked as failed if their genome cannot be indexed
+JOBS_TABLE = os.getenv('JOBS_TABLE')
+TASK_TRACKING_TABLE = os.getenv('TASK_TRACKING_TABLE')
+#genomes with at least this much fasta are indexed by many invocations (see lambda_handler)
+ISSL_MAP_REDUCE_FASTA_MB = int(os.getenv('ISSL_MAP_REDUCE_FASTA_MB', 256))
+#size of the pieces of whole chromosomes that the off-targets of a genome are extracted from, one task per piece
+ISSL_MAP_PIECE_MB = int(os.getenv('ISSL_MAP_PIECE_MB', 64))
+#pieces being uploaded at once while splitting a genome
+ISSL_SPLIT_UPLOADS = 4
+#sorted runs are streamed in small chunks, as a reduce task reads one from every piece at once
+REDUCE_STREAM_CHUNK_SIZE = 1048576
+REDUCE_STREAM_PREFETCH = 2
+#time kept back from each stage of a build to stop it and requeue the task before the invocation times out
+ISSL_STAGE_MARGIN_SECONDS = int(os.getenv('ISSL_STAGE_MARGIN_SECONDS', 30))
+#a stage is not started with less time than this left, the task is requeued instead
+ISSL_STAGE_MIN_SECONDS = int(os.getenv('ISSL_STAGE_MIN_SECONDS', 60))
+#a task that keeps running out of time is given up after this many invocations
+ISSL_MAX_ATTEMPTS = int(os.getenv('ISSL_MAX_ATTEMPTS', 4))
 #byte - megabyte magnitude
 BYTE_TO_MB_DIVIDER = 1048576
-#max fasta file size
-CUT_OFF_MB = 650
+#format of the intermediate off-target files, 'binary' packs each 20-mer into 8 bytes (see extractOfftargets.py).
+#it is only faster than 'text' with NumPy (the numpy layer), so that is the default without it.
+OFFTARGET_FORMAT = os.getenv('OFFTARGET_FORMAT', 'binary' if extractOfftargets.numpy is not None else 'text')
+#how sites are found, 'numpy' is vectorised and falls back to 'regex' if NumPy is not in the layers
+OFFTARGET_SCANNER = os.getenv('OFFTARGET_SCANNER', 'numpy' if extractOfftargets.numpy is not None else 'regex')
+#memory used to hold off-targets while sorting, larger chromosomes are sorted in runs and merged
+SORT_MEMORY_MB = int(os.getenv('SORT_MEMORY_MB', 2048))
     
 # Create S3 client
 s3_client = boto3.client('s3')
 s3_resource = boto3.resource('s3')
+sqs_client = boto3.client('sqs')
+dynamodb = boto3.resource('dynamodb')
 
 #determine if fasta file exists and return its size
 def fasta_size_check(accession):
@@ -39,90 +71,414 @@ def fasta_size_check(accession):
         sys.exit("Error - Accession file is missing.")
     filesize_in_MB = filesize/BYTE_TO_MB_DIVIDER
 
-    # notImplemented -  (requires Carl's issl split implemention of CracklingPlusPlus)
-    # Details - the memory bottleneck is reached at CUT_OFF_MB (600-650) due to file being written on memory.
-    # It takes 10 minutes to construct at the CUT_OFF_MB fasta size and lambda has a limit of 15 minutes.
+    # Genomes used to be limited to 650 MB of fasta, as building an index takes about 10 minutes at that size
+    # and lambda has a limit of 15 minutes. Large genomes are now indexed by many invocations instead (see
+    # lambda_handler), and the largest as several shards, each holding the off-targets of a range of prefixes.
     print(filesize_in_MB)
-    if (filesize_in_MB > CUT_OFF_MB):
-        sys.exit("Error - Accession file is larger than function can handle (memory bottleneck) - 24/09/2023")
     return filesize_in_MB
 
+# Number of ISSL shards needed for a genome with this much fasta
+def num_issl_shards(filesize_in_MB):
+    return max(1, math.ceil(filesize_in_MB / ISSL_SHARD_FASTA_MB))
 
 
-# Downloads and unzips multiple fasta files from S3 bucket 
-def s3_multi_file_to_tmp(s3_client, s3_bucket, accession):
+
+# List the fasta files of an accession in the S3 bucket
+def fasta_object_keys(s3_client, s3_bucket, accession):
 
     prefix = f"{accession}/fasta/"
     paginator = s3_client.get_paginator('list_objects_v2')
     response_iterator = paginator.paginate(Bucket=s3_bucket, Prefix=prefix)
 
-    downloaded_files = []
+    fasta_keys = []
 
     # Extract all .fna file names for genome accession 
     for page in response_iterator:
         files = [obj['Key'] for obj in page.get('Contents', [])]
 
         for s3_file_path in files:
-            file_name = os.path.basename(s3_file_path)
-            print(file_name)
-            downloaded_files.append(file_name)
-
-    # Temp folder for zipped files 
-    tmp_dir = get_tmp_dir()
-    # Temp folder for unzipped files 
-    tmp_extract_dir = get_tmp_dir()
-    # unzipped .fna file names 
-    extracted_files = []
-
-    for file in downloaded_files:
-
-        fasta_file_name = file
-        s3_full_filepath = f"{accession}/fasta/{fasta_file_name}"
-        print(f"This is the fasta file name {fasta_file_name}")
+            print(os.path.basename(s3_file_path))
+            fasta_keys.append(s3_file_path)
 
-        # Use temp directory for file writing in local
-        tmp_gz_file = os.path.join(tmp_dir, fasta_file_name)
-         
-        # download each .fna file from S3
-        print(f"Downloading {s3_full_filepath} to {tmp_gz_file}")
-        s3_client.download_file(s3_bucket, s3_full_filepath, tmp_gz_file)
+    return fasta_keys
 
-        # Unzip the downloaded .gz file
-        tmp_extract_file = os.path.join(tmp_extract_dir, os.path.splitext(fasta_file_name)[0])  # Remove .gz extension
-        with gzip.open(tmp_gz_file, 'rb') as f_in:
-            with open(tmp_extract_file, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        extracted_files.append(tmp_extract_file)
+# The fasta files of an accession and their total size in MB. They are read from the genome's manifest, or
+# found in S3 for genomes without one (e.g. uploaded as custom data).
+def genome_fasta(accession):
+    fasta = manifest_fasta(genome_manifest(dynamodb, GENOMES_TABLE, accession))
+    if fasta is None:
+        return fasta_object_keys(s3_client, s3_bucket, accession), fasta_size_check(accession)
 
-        os.remove(tmp_gz_file)
-        print(f"Deleted temporary gz file: {tmp_gz_file}")
-
-    # print extracted files 
-    print(extracted_files)
-    return extracted_files, tmp_extract_dir
-
-
-
-# Build isslIndex
-def isslcreate(accession, tmp_fasta_dir):
+    filesize = sum(fasta.values())
+    if filesize < 1:
+        sys.exit("Error - Accession file is missing.")
+    return sorted(fasta), filesize / BYTE_TO_MB_DIVIDER
+
+# Stream a fasta file from S3, decompressing it on the fly if it is gzipped. Nothing is downloaded until the
+# stream is first read, and nothing is written to disk.
+def fasta_stream(s3_client, s3_bucket, key):
+    chunks = s3_stream_chunks(s3_client, s3_bucket, key)
+    if key.endswith('.gz'):
+        return gunzip_chunks(chunks)
+    return chunks
+
+
+
+#----------------------
+# STAGES
+#----------------------
+# A build is made of stages, each of which saves its results to S3 before the next one starts. A stage runs in its
+# own process so that it can be stopped shortly before the invocation would time out, after which the task is sent
+# back to the queue and resumes from the stage that was stopped. A genome that takes a little longer than one
+# invocation to index is then built over two.
+
+# Seconds left in this invocation, unlimited when not running on lambda
+def remaining_seconds(context):
+    if context is None:
+        return float('inf')
+    return context.get_remaining_time_in_millis() / 1000
+
+# Process of a stage. It leads its own process group, so it can be stopped along with everything it started
+# (scanning processes, isslCreateIndex), and keeps its temporary files in the task's directory.
+def stage_process(tmp_dir, fn, args):
+    global s3_client, sqs_client, dynamodb
+    os.setpgrp()
+    tempfile.tempdir = tmp_dir
+
+    # the parent's clients are not shared, as their pooled connections are not safe to use from two processes
+    s3_client = boto3.client('s3')
+    sqs_client = boto3.client('sqs')
+    dynamodb = boto3.resource('dynamodb')
+
+    fn(tmp_dir, *args)
+
+# Run `fn(tmp_dir, *args)` as a stage. Returns False if there was not enough time left to finish it.
+def run_stage(name, context, tmp_dir, fn, *args):
+    seconds = remaining_seconds(context) - ISSL_STAGE_MARGIN_SECONDS
+    if seconds < ISSL_STAGE_MIN_SECONDS:
+        print(f"Only {seconds:.0f}s left, not starting stage {name}")
+        return False
+
+    print(f"Starting stage {name}")
+    start = time()
+    process = multiprocessing.get_context('fork').Process(target=stage_process, args=(tmp_dir, fn, args))
+    process.start()
+    process.join(None if seconds == float('inf') else seconds)
+
+    if process.is_alive():
+        print(f"Stopping stage {name} after {time() - start:.0f}s, the invocation is about to time out")
+        os.killpg(process.pid, signal.SIGKILL)
+        process.join()
+        return False
+    if process.exitcode != 0:
+        raise RuntimeError(f"Stage {name} failed (exit code {process.exitcode})")
+
+    print(f"Stage {name} done in {time() - start:.1f}s")
+    return True
+
+# Run the stages of a task that are not done yet. Each stage is a tuple of its name, a function that checks S3 (or
+# the builds table) for its results, and the stage function and its arguments. Returns False if the task was
+# requeued to finish in another invocation.
+def run_stages(args, context, tmp_dir, stages):
+    for name, is_done, fn, fn_args in stages:
+        if is_done():
+            print(f"Stage {name} is already done")
+            continue
+        if not run_stage(name, context, tmp_dir, fn, *fn_args):
+            requeue(args)
+            return False
+    return True
+
+# Send a task back to this function's queue to resume it in a new invocation. A new message is sent rather than
+# letting this one be redelivered, as the queue only keeps messages for as long as one invocation can run.
+# A task that is given up fails the genome's lock, and the jobs waiting for it, rather than leaving them to wait
+# for the lease to expire.
+def requeue(args):
+    attempt = args.get('Attempt', 1)
+    if attempt >= ISSL_MAX_ATTEMPTS:
+        jobs = genome_lock_fail(dynamodb, GENOMES_TABLE, args['Genome'], args['JobID'])
+        fail_jobs(dynamodb, JOBS_TABLE, TASK_TRACKING_TABLE, jobs, f"Indexing {args['Genome']} did not finish in {attempt} invocations")
+        sys.exit(f"Error: giving up on {args} after {attempt} invocations")
+    print(f"Requeueing the task (attempt {attempt + 1} of {ISSL_MAX_ATTEMPTS})")
+    sqs_send_message(ISSL_QUEUE, json.dumps({**args, 'Attempt': attempt + 1}))
+
+def issl_key(accession, index_name, extension):
+    return f"{accession}/issl/{index_name}.{extension}"
+
+# Record the index files of a genome in its manifest, along with the ETag and size of each, so that the
+# scoring functions don't have to look for them in S3
+def record_index(accession, index_names):
+    files = {}
+    for index_name in index_names:
+        head = s3_client.head_object(Bucket=s3_bucket, Key=issl_key(accession, index_name, 'issl'))
+        files[index_name] = {'ETag' : head['ETag'].strip('"'), 'Size' : head['ContentLength']}
+    genome_manifest_set_issl(dynamodb, GENOMES_TABLE, accession, index_names, files)
+
+#----------------------
+# SINGLE INVOCATION BUILD
+#----------------------
+
+# Stage: extract the sorted off-targets of a genome and upload them to the build's intermediate files
+def extract_genome(tmp_dir, accession, jobid, fasta_keys):
     
     print("\nExtracting Offtargets...")
 
-    # extract offtarget command
-    tmp_dir = get_tmp_dir()
     offtargetfn = os.path.join(tmp_dir,f"{accession}.offtargets")
     print(f"Creating: {offtargetfn}")
 
-    # Lambda code
-    extractOfftargets.startSequentalprocessing([tmp_fasta_dir], offtargetfn, 1, 100)
+    # Lambda code - one scanning process per vCPU (6 with 10 GB of memory). The fasta files are streamed from S3
+    # and decompressed straight into the scanners, so only the off-targets are written to /tmp.
+    # The number of sorted runs merged at once is chosen from the open file limit and SORT_MEMORY_MB
+    extractOfftargets.startStreamingProcessing(
+        [fasta_stream(s3_client, s3_bucket, key) for key in fasta_keys],
+        offtargetfn, os.cpu_count(), None, OFFTARGET_FORMAT, OFFTARGET_SCANNER, SORT_MEMORY_MB
+    )
+
+    s3_client.upload_file(offtargetfn, s3_bucket, offtargets_key(work_prefix(accession, jobid), accession))
+
+# Stage: index an uploaded off-targets file and upload the index. The off-targets are only downloaded if they
+# were extracted by an earlier invocation. The index is then marked as built by this build, as an .issl file
+# may be left in S3 from an earlier one.
+def create_index(tmp_dir, accession, jobid, index_name):
     isslBin = "/opt/ISSL/isslCreateIndex"
+    work = work_prefix(accession, jobid)
 
-    issl_path = os.path.join(tmp_dir, f"{accession}.issl")
+    offtargetfn = os.path.join(tmp_dir, f"{index_name}.offtargets")
+    if not os.path.exists(offtargetfn):
+        s3_download_file(s3_client, s3_bucket, offtargets_key(work, index_name), offtargetfn)
+
+    issl_path = os.path.join(tmp_dir, f"{index_name}.issl")
 
     os.system(f"{isslBin} {offtargetfn} 20 8 {issl_path}")
 
-    s3_destination_path = f"{accession}/issl"
-    upload_dir_to_s3(s3_client, s3_bucket, tmp_dir, s3_destination_path)
+    s3_client.upload_file(issl_path, s3_bucket, issl_key(accession, index_name, 'issl'))
+    s3_client.put_object(Bucket=s3_bucket, Key=indexed_key(work, index_name), Body=b'')
+
+# Build isslIndex of a genome in this invocation (or the next, if it runs out of time). Its intermediate files
+# are kept under the build's work prefix, like those of a map/reduce build, and removed once it is built.
+def isslcreate(args, context, tmp_dir, accession, jobid, fasta_keys):
+    work = work_prefix(accession, jobid)
+    if not run_stages(args, context, tmp_dir, [
+        ('extract', lambda: s3_object_exists(s3_client, s3_bucket, offtargets_key(work, accession)),
+            extract_genome, (accession, jobid, fasta_keys)),
+        ('index', lambda: s3_object_exists(s3_client, s3_bucket, indexed_key(work, accession)),
+            create_index, (accession, jobid, accession)),
+    ]):
+        return False
+    s3_delete_prefix(s3_client, s3_bucket, f"{work}/")
+    return True
+
+#----------------------
+# MAP/REDUCE BUILD
+#----------------------
+# A large genome is split into pieces of whole chromosomes (split_fasta), the sorted off-targets of each piece
+# are extracted by its own task (extract_piece), and each shard of the index is then merged from the pieces'
+# sorted runs and indexed by its own task (merge_shard, create_index). The tasks are messages on this function's
+# queue, and the build's progress is kept in the builds table: item 0 holds the build, item i + 1 the result of
+# piece i.
+
+# Intermediate files of a build are kept under the accession's issl folder until it is finished
+def work_prefix(accession, jobid):
+    return f"{accession}/issl/_work/{jobid}"
+
+# Off-targets of one index (the genome's, or one shard's), extracted or merged by a build
+def offtargets_key(work, index_name):
+    return f"{work}/{index_name}.offtargets"
+
+# Empty object marking that a build has uploaded one index
+def indexed_key(work, index_name):
+    return f"{work}/{index_name}.indexed"
+
+def piece_key(work, piece):
+    return f"{work}/fasta/{piece:05d}.fa"
+
+# Sorted packed off-targets of one piece that belong to one shard
+def run_key(work, shard, piece):
+    return f"{work}/runs/{shard:03d}/{piece:05d}.offtargets"
+
+def build_id(accession, jobid):
+    return f"{accession}#{jobid}"
+
+def get_build_item(accession, jobid, task):
+    return dynamodb.Table(ISSL_BUILDS_TABLE).get_item(
+        Key={'BuildID' : build_id(accession, jobid), 'Task' : task},
+        ConsistentRead=True
+    ).get('Item')
+
+# Stage: split the fasta files of a genome into pieces in S3, each of at least ISSL_MAP_PIECE_MB of whole
+# records, then record the build. The pieces are uploaded while the next ones are read. Splitting is
+# deterministic, so pieces uploaded by an earlier invocation are not uploaded again.
+def split_fasta(tmp_dir, accession, jobid, fasta_keys, num_shards):
+    work = work_prefix(accession, jobid)
+    start = time()
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    uploaded = set(
+        obj['Key']
+        for page in paginator.paginate(Bucket=s3_bucket, Prefix=f"{work}/fasta/")
+        for obj in page.get('Contents', [])
+    )
+
+    num_pieces = 0
+    pending = []
+    with ThreadPoolExecutor(max_workers=ISSL_SPLIT_UPLOADS) as executor:
+        for key in fasta_keys:
+            for piece in extractOfftargets.iterFastaPieces(fasta_stream(s3_client, s3_bucket, key), ISSL_MAP_PIECE_MB * BYTE_TO_MB_DIVIDER):
+                if piece_key(work, num_pieces) not in uploaded:
+                    # limit the pieces held in memory
+                    if len(pending) >= ISSL_SPLIT_UPLOADS:
+                        pending.pop(0).result()
+                    pending.append(executor.submit(
+                        s3_client.put_object, Bucket=s3_bucket, Key=piece_key(work, num_pieces), Body=piece
+                    ))
+                num_pieces += 1
+
+        for upload in pending:
+            upload.result()
+
+    print(f"Split {accession} into {num_pieces} pieces ({len(uploaded)} already uploaded) in {time() - start:.1f}s")
+
+    dynamodb.Table(ISSL_BUILDS_TABLE).put_item(Item={
+        'BuildID' : build_id(accession, jobid),
+        'Task' : 0,
+        'Accession' : accession,
+        'JobID' : jobid,
+        'NumPieces' : num_pieces,
+        'NumShards' : num_shards,
+        'Status' : 'SPLIT',
+        'Started' : int(start)
+    })
+
+# Split a genome and start the extraction task of each piece
+def start_build(args, context, tmp_dir, accession, jobid, fasta_keys, num_shards, body):
+    if not run_stages(args, context, tmp_dir, [
+        ('split', lambda: get_build_item(accession, jobid, 0) is not None,
+            split_fasta, (accession, jobid, fasta_keys, num_shards)),
+    ]):
+        return
+
+    build = get_build_item(accession, jobid, 0)
+    num_pieces = int(build['NumPieces'])
+    sqs_send_messages(sqs_client, ISSL_QUEUE, [
+        json.dumps({**body, "Task": "extract", "Piece": i, "NumPieces": num_pieces, "NumShards": num_shards})
+        for i in range(num_pieces)
+    ])
+    set_build_status(accession, jobid, 'EXTRACTING')
+
+# Stage: extract the sorted off-targets of one piece, upload them as one run per shard and record the piece
+def extract_piece(tmp_dir, accession, jobid, piece, num_shards):
+    work = work_prefix(accession, jobid)
+    start = time()
+
+    offtargetfn = os.path.join(tmp_dir, f"{piece:05d}.offtargets")
+
+    # runs are kept packed, so they are small and a reduce task can merge them without parsing text
+    stats = extractOfftargets.startStreamingProcessing(
+        [s3_stream_chunks(s3_client, s3_bucket, piece_key(work, piece))],
+        offtargetfn, os.cpu_count(), None, 'binary', OFFTARGET_SCANNER, SORT_MEMORY_MB,
+        outputFormat='binary'
+    )
+
+    # the run is sorted, so each shard's off-targets are a contiguous range of it
+    with open(offtargetfn, 'rb') as f:
+        bounds = [
+            extractOfftargets.searchPackedFile(f, extractOfftargets.shardRange(shard, num_shards)[0])
+            for shard in range(num_shards)
+        ] + [stats['offtargets']]
+        for shard in range(num_shards):
+            f.seek(bounds[shard] * 8)
+            s3_client.put_object(
+                Bucket=s3_bucket,
+                Key=run_key(work, shard, piece),
+                Body=f.read((bounds[shard + 1] - bounds[shard]) * 8)
+            )
+
+    # record the piece, like ddbGenomeParts records each part of a download
+    dynamodb.Table(ISSL_BUILDS_TABLE).put_item(Item={
+        'BuildID' : build_id(accession, jobid),
+        'Task' : piece + 1,
+        'NumOfftargets' : stats['offtargets'],
+        'Seconds' : int(time() - start)
+    })
+
+# Add a piece to the extracted pieces of a build. Returns True if the reduce tasks are to be sent: when this
+# completed the extraction, or when a redelivered message finds it complete but the reduce not started (sending
+# the reduce tasks failed), as reducing is idempotent.
+def piece_extracted(accession, jobid, piece):
+    # adding to a set makes a redelivered message harmless: only the first time a piece is added can complete
+    # the set, so exactly one task finds that it finished the extraction
+    response = dynamodb.Table(ISSL_BUILDS_TABLE).update_item(
+        Key={'BuildID' : build_id(accession, jobid), 'Task' : 0},
+        UpdateExpression="ADD PiecesDone :piece",
+        ExpressionAttributeValues={':piece' : {piece}},
+        ReturnValues="ALL_OLD"
+    )
+    done_before = response['Attributes'].get('PiecesDone', set())
+    if len(done_before | {piece}) != response['Attributes']['NumPieces']:
+        return False
+    return piece not in done_before or response['Attributes']['Status'] in ('SPLIT', 'EXTRACTING')
+
+# Add a shard to the built shards of a build. Returns True if every shard of the build is built. This is
+# recorded for the build rather than found from the .issl files in S3, which may be left from an earlier build,
+# and is True again for a redelivered message, so that finishing the build (see `finish_build`) can be retried.
+def shard_built(accession, jobid, shard, num_shards):
+    response = dynamodb.Table(ISSL_BUILDS_TABLE).update_item(
+        Key={'BuildID' : build_id(accession, jobid), 'Task' : 0},
+        UpdateExpression="ADD ShardsBuilt :shard",
+        ExpressionAttributeValues={':shard' : {shard}},
+        ReturnValues="ALL_NEW"
+    )
+    return len(response['Attributes']['ShardsBuilt']) == num_shards
+
+# Stage: merge the runs of one shard, streamed from S3, into its off-targets file and upload it
+def merge_shard(tmp_dir, accession, jobid, shard, num_shards, num_pieces, index_name):
+    work = work_prefix(accession, jobid)
+    offtargetfn = os.path.join(tmp_dir, f"{index_name}.offtargets")
+
+    extractOfftargets.mergeStreamedRuns([
+        s3_stream_chunks(s3_client, s3_bucket, run_key(work, shard, piece), REDUCE_STREAM_CHUNK_SIZE, REDUCE_STREAM_PREFETCH)
+        for piece in range(num_pieces)
+    ], offtargetfn)
+
+    s3_client.upload_file(offtargetfn, s3_bucket, offtargets_key(work, index_name))
+
+# Merge and index one shard (the whole index, when there is one shard)
+def reduce_shard(args, context, tmp_dir, accession, jobid, shard, num_shards, num_pieces):
+    index_name = accession if num_shards == 1 else issl_shard_name(accession, shard, num_shards)
+    work = work_prefix(accession, jobid)
+
+    return run_stages(args, context, tmp_dir, [
+        ('merge', lambda: s3_object_exists(s3_client, s3_bucket, offtargets_key(work, index_name)),
+            merge_shard, (accession, jobid, shard, num_shards, num_pieces, index_name)),
+        ('index', lambda: s3_object_exists(s3_client, s3_bucket, indexed_key(work, index_name)),
+            create_index, (accession, jobid, index_name)),
+    ])
+
+def set_build_status(accession, jobid, status):
+    dynamodb.Table(ISSL_BUILDS_TABLE).update_item(
+        Key={'BuildID' : build_id(accession, jobid), 'Task' : 0},
+        UpdateExpression="SET #status = :status",
+        ExpressionAttributeNames={'#status' : 'Status'},
+        ExpressionAttributeValues={':status' : status}
+    )
+
+# Record that the index of a build is complete and remove its intermediate files. Returns False if it
+# already was, e.g. when the last task is redelivered.
+def finish_build(accession, jobid):
+    try:
+        dynamodb.Table(ISSL_BUILDS_TABLE).update_item(
+            Key={'BuildID' : build_id(accession, jobid), 'Task' : 0},
+            UpdateExpression="SET #status = :status, Finished = :finished",
+            ConditionExpression="#status <> :status",
+            ExpressionAttributeNames={'#status' : 'Status'},
+            ExpressionAttributeValues={':status' : 'READY', ':finished' : int(time())}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    s3_delete_prefix(s3_client, s3_bucket, f"{work_prefix(accession, jobid)}/")
+    return True
 
 
 def lambda_handler(event, context):
@@ -143,23 +499,70 @@ def lambda_handler(event, context):
         sys.exit('Error: No accession found.')
 
     print(f"accession: {accession}")
-    
-    #check that file size meets current limitations - 600MB file
-    _ = fasta_size_check(accession)
-
-    tmp_dir_fasta, tmp_dir = s3_multi_file_to_tmp(s3_client, s3_bucket, accession)
 
-    # Create issl files
-    isslcreate(accession, tmp_dir)
+    # every task is progress on the build, keep the job's hold on the genome
+    genome_lock_renew(dynamodb, GENOMES_TABLE, accession, jobid, 'INDEXING')
 
-    sqs_send_message(TARGET_SCAN_QUEUE, json_object) 
+    task = args.get('Task')
 
-    print("These are the extracted file names", tmp_dir_fasta)
-    
-    #close temp fasta file directory
-    if os.path.exists(tmp_dir):
-        print("Cleaning Up...")
-        shutil.rmtree(tmp_dir)
+    # each invocation works in its own directory, which is removed however the invocation ends
+    tmp_dir = get_tmp_dir()
+    try:
+        if task == 'extract':
+            piece, num_pieces, num_shards = args['Piece'], args['NumPieces'], args['NumShards']
+            print(f"Extracting piece {piece + 1} of {num_pieces} of {accession}")
+            if not run_stages(args, context, tmp_dir, [
+                ('extract', lambda: get_build_item(accession, jobid, piece + 1) is not None,
+                    extract_piece, (accession, jobid, piece, num_shards)),
+            ]):
+                return
+
+            if piece_extracted(accession, jobid, piece):
+                print(f"All pieces of {accession} are extracted, merging {num_shards} shard(s)")
+                # the status only moves on once the reduce tasks are sent, so a redelivered message sends them
+                # again if sending failed
+                sqs_send_messages(sqs_client, ISSL_QUEUE, [
+                    json.dumps({**body, "Task": "reduce", "Shard": i, "NumPieces": num_pieces, "NumShards": num_shards})
+                    for i in range(num_shards)
+                ])
+                set_build_status(accession, jobid, 'REDUCING')
+
+        elif task == 'reduce':
+            shard, num_pieces, num_shards = args['Shard'], args['NumPieces'], args['NumShards']
+            print(f"Merging shard {shard + 1} of {num_shards} of {accession}")
+            if not reduce_shard(args, context, tmp_dir, accession, jobid, shard, num_shards, num_pieces):
+                return
+
+            if num_shards > 1 and not shard_built(accession, jobid, shard, num_shards):
+                print(f"Built shard {shard + 1} of {num_shards} of {accession}, waiting for the others")
+                return
+
+            # the shard manifest is written before the build is finished, so that a retry writes it again
+            index_names = [accession] if num_shards == 1 else issl_write_shards(s3_client, s3_bucket, accession, num_shards)
+            if finish_build(accession, jobid):
+                print(f"The index of {accession} is built")
+                record_index(accession, index_names)
+                sqs_send_message(TARGET_SCAN_QUEUE, json_object) 
+                genome_lock_ready(dynamodb, GENOMES_TABLE, accession, TARGET_SCAN_QUEUE)
+
+        else:
+            fasta_keys, filesize_in_MB = genome_fasta(accession)
+            print("These are the fasta files used", fasta_keys)
+
+            if filesize_in_MB < ISSL_MAP_REDUCE_FASTA_MB:
+                # Create issl files
+                if isslcreate(args, context, tmp_dir, accession, jobid, fasta_keys):
+                    record_index(accession, [accession])
+                    sqs_send_message(TARGET_SCAN_QUEUE, json_object) 
+                    genome_lock_ready(dynamodb, GENOMES_TABLE, accession, TARGET_SCAN_QUEUE)
+            else:
+                # Large genomes are built by many invocations, so the build takes about as long as the largest
+                # chromosome. The largest are also indexed in shards, so that each index can be built in time.
+                num_shards = num_issl_shards(filesize_in_MB)
+                print(f"Indexing {accession} with a map/reduce build of {num_shards} shard(s)")
+                start_build(args, context, tmp_dir, accession, jobid, fasta_keys, num_shards, body)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
     print("All Done... Terminating Program.")
 
@@ -1,9 +1,10 @@
-import json, os
-import requests 
+import json, os, base64, hashlib, math, tempfile
 import boto3
 from common_funcs import *
+from ncbi_client import *
 from boto3.dynamodb.conditions import Key
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 # define AWS resources
@@ -13,40 +14,30 @@ dynamodb = boto3.resource('dynamodb')
 FILES_TABLE_NAME = os.environ['FILES_TABLE']
 FILES_TABLE = dynamodb.Table(FILES_TABLE_NAME)
 ISSL_QUEUE = os.getenv('ISSL_QUEUE')
-
-
-# Downloads a specific byte range of a fasta file from an NCBI server using HTTP range requests
-def download_part_file(filename, file_url, part, start_byte, end_byte, is_stream):
-
-    max_retries = 3
-    retries = 0
-    
-    while retries < max_retries:
-        print(f"Part {part}_{filename} downloaded commencing....")
-
-        # Construct http range request 
-        headers = {'Range': f'bytes={start_byte}-{end_byte}'}
-        http_response = requests.get(file_url, headers=headers, stream = is_stream)
-        
-        # Ensure partial content is sent through
-        if http_response.status_code == 206:  # Partial Content
-            part_filename = f"Part{part}_{filename}"
-            print(f"Part {part} downloaded and saved as {part_filename}")
-            return http_response
-        elif http_response.status_code == 404: # allow retries incase of 404 errors
-            retries += 1
-            print(f"Part {part} not found (HTTP 404). Retry {retries}/{max_retries} in 5 seconds...")
-            time.sleep(5) 
-            print(f"Failed to download part {part}: HTTP {http_response.status_code}")
-        else:
-            print(f"Failed to download part {part}: HTTP {http_response.status_code}")
-            return None
-    return None
-
-# Streaming the entire file to S3
-def upload_to_s3(response,  object_key):
+GENOMES_TABLE = os.getenv('GENOMES_TABLE')
+JOBS_TABLE = os.getenv('JOBS_TABLE')
+TASK_TRACKING_TABLE = os.getenv('TASK_TRACKING_TABLE')
+# Number of parts of a file downloaded and uploaded at once. Each part is written to /tmp as it is downloaded
+# and uploaded from there, so memory use does not depend on the part size, and an invocation uses about this many
+# times the part size of ephemeral storage, however many parts its message covers.
+FILE_PART_WORKERS = int(os.getenv('FILE_PART_WORKERS', 8))
+# Seconds an invocation has to finalise a file before another one can take over, as long as the function can run
+FILE_FINALISE_LEASE_SECONDS = int(os.getenv('FILE_FINALISE_LEASE_SECONDS', 900))
+
+
+# Downloads a specific byte range of a fasta file from an NCBI server using HTTP range requests, into the file
+# object `out`. Transfers that fail part way are resumed (see `ncbi_download_range`), and the bytes are added to
+# `digest` as they arrive. The file is rewound for reading once the range is downloaded.
+def download_part_file(filename, file_url, part, start_byte, end_byte, out, digest):
+    print(f"Part {part}_{filename} downloaded commencing....")
+    ncbi_download_range(file_url, start_byte, end_byte, out, digest)
+    out.seek(0)
+    print(f"Part {part} of {filename} downloaded")
+
+# Upload an entire file to S3, streamed from the file object `data`
+def upload_to_s3(data, object_key):
     try:
-        response = s3_client.upload_fileobj(response.raw, s3_bucket, object_key)  
+        response = s3_client.upload_fileobj(data, s3_bucket, object_key)  
         print(f"File uploaded to S3: s3://{s3_bucket}/{object_key}")
         print(response)
         return True  
@@ -55,59 +46,122 @@ def upload_to_s3(response,  object_key):
         raise 
 
 
-# Uploading partial file to S3 using multi-part upload
-def part_upload_to_s3(response, upload_id, part_number, object_key):
+# Uploading partial file to S3 using multi-part upload, streamed from the file object `data`. S3 checks the part
+# against the MD5 of the bytes that were downloaded. A part that fails is uploaded again when the message is retried, so the upload is not aborted.
+def part_upload_to_s3(data, digest, upload_id, part_number, object_key):
     try:
         part_response = s3_client.upload_part(
             Bucket=s3_bucket,
             Key=object_key,
             UploadId=upload_id,
             PartNumber=part_number,
-            Body=response.content
+            Body=data,
+            ContentMD5=base64.b64encode(digest.digest()).decode()
         )
         etag = part_response['ETag']
         print(f"File part uploaded to S3: s3://{s3_bucket}/{object_key} (Part Number: {part_number}, ETag: {etag})")
         return etag
     except Exception as e:
         print(f"Error uploading part to S3: {str(e)}")
-        # Abort the multipart upload if part upload fails
-        try:
-            s3.abort_multipart_upload(
-                Bucket=s3_bucket,
-                Key=object_key,
-                UploadId=upload_id
-            )
-            print(f"Aborted multipart upload: {upload_id}")
-        except Exception as abort_error:
-            print(f"Error aborting multipart upload: {str(abort_error)}")
         raise
 
 
-# Check if all the parts of a file have been uploaded 
-def all_parts_uploaded(filename, total_parts):
-    # Query the table to count the number of parts uploaded
-    response = FILES_TABLE.query(
-        KeyConditionExpression=Key('GenomePartFileName').eq(filename)
+# Download one part of a file to /tmp and upload it to the multipart upload from there. Returns the ETag of the
+# part.
+def transfer_part(filename, file_url, upload_id, object_key, part, start_byte, end_byte):
+    digest = hashlib.md5()
+    with tempfile.TemporaryFile() as data:
+        download_part_file(filename, file_url, part, start_byte, end_byte, data, digest)
+        return part_upload_to_s3(data, digest, upload_id, part, object_key)
+
+# Download and upload the run of parts between start_byte and end_byte, several at once so that downloads and
+# uploads overlap. Each part is part_size bytes (the last of the file may be shorter) and the first is
+# first_part. Returns the part numbers and their ETags.
+def transfer_parts(filename, file_url, upload_id, object_key, first_part, start_byte, end_byte, part_size):
+    ranges = [
+        (first_part + i, start, min(start + part_size, end_byte + 1) - 1)
+        for i, start in enumerate(range(start_byte, end_byte + 1, part_size))
+    ]
+    with ThreadPoolExecutor(max_workers=min(FILE_PART_WORKERS, len(ranges))) as executor:
+        etags = executor.map(lambda r: transfer_part(filename, file_url, upload_id, object_key, *r), ranges)
+        return list(zip([r[0] for r in ranges], etags))
+
+
+# Items of a multipart upload in the files table are keyed by the file and the upload, so that the parts of an
+# earlier upload of the same file are never mixed in: one item per part with its ETag, and item 0 with the set of
+# parts uploaded so far (and whether the file was finalised, see `file_finalised`)
+def upload_record_key(filename, upload_id):
+    return f"{filename}#{upload_id}"
+
+
+# Get the set of parts of a file uploaded so far, and whether the file was finalised
+def upload_progress(upload_key):
+    item = FILES_TABLE.get_item(
+        Key={'GenomePartFileName': upload_key, 'FileNamePartNumber': 0},
+        ConsistentRead=True
+    ).get('Item', {})
+    return item.get('PartsDone', set()), item.get('Finalised', False)
+
+# Add parts of a file to the set of parts uploaded. Returns True if every part of the file has been uploaded and
+# the file is not finalised yet. Parts that are uploaded again (e.g. a redelivered message) are not counted twice,
+# and a redelivered last part finalises the file again if it failed the first time. The last parts may finish at
+# the same time, so the file is only finalised by the invocation that claims it (see `claim_finalisation`).
+def parts_uploaded(upload_key, part_numbers, total_parts):
+    response = FILES_TABLE.update_item(
+        Key={'GenomePartFileName': upload_key, 'FileNamePartNumber': 0},
+        UpdateExpression="ADD PartsDone :parts",
+        ExpressionAttributeValues={':parts': set(part_numbers)},
+        ReturnValues="ALL_NEW"
+    )
+    uploaded_parts = len(response['Attributes']['PartsDone'])
+    print("Uploaded parts: ", uploaded_parts)
+    return uploaded_parts == total_parts and not response['Attributes'].get('Finalised', False)
+
+# Claim the finalisation of a file, so that exactly one invocation completes and verifies its upload. Returns
+# False if the file is finalised, or being finalised by another invocation. A claim that is not finished within
+# FILE_FINALISE_LEASE_SECONDS (its invocation stopped) can be taken over.
+def claim_finalisation(upload_key):
+    now = int(time.time())
+    try:
+        FILES_TABLE.update_item(
+            Key={'GenomePartFileName': upload_key, 'FileNamePartNumber': 0},
+            UpdateExpression="SET Finalising = :lease",
+            ConditionExpression="attribute_not_exists(Finalised) AND (attribute_not_exists(Finalising) OR Finalising < :now)",
+            ExpressionAttributeValues={':lease': now + FILE_FINALISE_LEASE_SECONDS, ':now': now}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+# Give up the claim on finalising a file that failed, so that the redelivered message finalises it straight away
+def release_finalisation(upload_key):
+    FILES_TABLE.update_item(
+        Key={'GenomePartFileName': upload_key, 'FileNamePartNumber': 0},
+        UpdateExpression="REMOVE Finalising"
+    )
+
+# Mark a file as finalised, once its upload is completed, verified and recorded in the genome's manifest
+def file_finalised(upload_key):
+    FILES_TABLE.update_item(
+        Key={'GenomePartFileName': upload_key, 'FileNamePartNumber': 0},
+        UpdateExpression="SET Finalised = :true",
+        ExpressionAttributeValues={':true': True}
     )
-    uploaded_parts = response['Count']
-    print("Uploaded part: ", uploaded_parts)
-    for item in response['Items']:
-        print(item)
-    
-    if uploaded_parts == total_parts:
-        return True
-    else:
-        return False
     
 
-def extract_etags_and_parts(filename):
+# Get the ETags and part numbers of every part of a file, following the pages of the query
+def extract_etags_and_parts(upload_key):
     try:
-        # Query DynamoDB to get all parts for the given filename
-        response = FILES_TABLE.query(
-            KeyConditionExpression=Key('GenomePartFileName').eq(filename)
-        ) 
-        items = response['Items']
-        parts = [{'ETag': item['etag'], 'PartNumber': int(item['FileNamePartNumber'])} for item in items]
+        parts = []
+        query = {'KeyConditionExpression': Key('GenomePartFileName').eq(upload_key) & Key('FileNamePartNumber').gt(0)}
+        while True:
+            response = FILES_TABLE.query(**query)
+            parts.extend({'ETag': item['etag'], 'PartNumber': int(item['FileNamePartNumber'])} for item in response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
         
         # Sort the parts by part number
         parts.sort(key=lambda x: x['PartNumber'])
@@ -119,7 +173,8 @@ def extract_etags_and_parts(filename):
     
 
 
-# Combine all the partial files into a single file 
+# Combine all the partial files into a single file. An upload that was already completed (by an invocation that
+# stopped before the file was marked finalised) is no longer found, and is left as it is.
 def complete_file_multipart_upload(object_key, upload_id, parts):
     try:
         response = s3_client.complete_multipart_upload(
@@ -132,16 +187,22 @@ def complete_file_multipart_upload(object_key, upload_id, parts):
         )
         print(f"Multipart upload completed successfully for {object_key}")
         return response
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchUpload' and is_object_in_s3(object_key):
+            print(f"Multipart upload for {object_key} was already completed")
+            return None
+        print(f"Error completing multipart upload: {str(e)}")
+        raise
     except Exception as e:
         print(f"Error completing multipart upload: {str(e)}")
         raise
 
 
 # Record each partial upload to s3 into table, along with Etag and part numbers
-def file_upload_record(filename, part, etag):
+def file_upload_record(upload_key, part, etag):
     response_dynamo = FILES_TABLE.put_item(
                     Item={
-                        'GenomePartFileName': filename,
+                        'GenomePartFileName': upload_key,
                         'FileNamePartNumber': part,
                         'etag': etag, 
                     }
@@ -150,33 +211,65 @@ def file_upload_record(filename, part, etag):
 
 
 
-# Check is all files for a genome accession have been uploaded 
-def are_all_files_uploaded(num_files, accession):
-    s3_multipart_destination_folder =  f"{accession}/fasta"
+# Check a complete fasta file against the MD5 checksum published by NCBI, before it is recorded as uploaded. The
+# checksum of the file is computed from S3 unless it was computed as it was downloaded (`digest`). A file that
+# does not match is deleted, so that a corrupt or partial file is never indexed (see `fail_genome`). Files without
+# a published checksum are not checked.
+def verify_fasta_file(object_key, expected_md5, digest=None):
+    if expected_md5 is None:
+        print(f"No checksum for {object_key}, it is not verified")
+        return True
+
+    if digest is None:
+        digest = hashlib.md5()
+        for chunk in s3_stream_chunks(s3_client, s3_bucket, object_key):
+            digest.update(chunk)
+
+    if digest.hexdigest() == expected_md5:
+        print(f"Checksum of {object_key} verified")
+        return True
+
+    print(f"Checksum mismatch for {object_key}: expected {expected_md5}, got {digest.hexdigest()}. Deleting it")
+    s3_client.delete_object(Bucket=s3_bucket, Key=object_key)
+    return False
+
 
+# Check whether an object exists in the bucket
+def is_object_in_s3(object_key):
     try:
-        # list all the files uploaded to s3 for genome accession
-        response = s3_client.list_objects_v2(Bucket=s3_bucket, Prefix=s3_multipart_destination_folder)
-        
-        if 'Contents' not in response:
-            print(f"No files found in the folder {s3_multipart_destination_folder}")
-            return False
-        file_count = 0
-        for obj in response['Contents']:
-            # Check if the object is a file (not a folder)
-            if not obj['Key'].endswith('/'):
-                file_count += 1
-
-        # check is all files have been uploaded
-        if file_count == num_files:
-            print(f"All {num_files} files are uploaded.")
-            return True
-        else:
-            print(f"Expected {num_files} files, but found {file_count} files.")
+        s3_client.head_object(Bucket=s3_bucket, Key=object_key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
             return False
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return False
+        raise
+
+
+# Record a fasta file whose upload is complete in the genome's manifest. Returns True if all the files for the
+# genome accession have been uploaded.
+def fasta_file_uploaded(accession, object_key):
+    head = s3_client.head_object(Bucket=s3_bucket, Key=object_key)
+    return genome_manifest_add_fasta(dynamodb, GENOMES_TABLE, accession, object_key, head['ContentLength'], head['ETag'].strip('"'))
+
+# Send the genome to the ISSL CREATE SQS QUEUE once all its files are uploaded. Only one invocation claims the
+# indexing, and the claim is given up if the message cannot be sent, so that the retried message sends it.
+def start_indexing(accession, jobid, json_object):
+    if not genome_manifest_claim_index(dynamodb, GENOMES_TABLE, accession):
+        print(f"Indexing of {accession} was already started")
+        return
+    try:
+        genome_lock_renew(dynamodb, GENOMES_TABLE, accession, jobid, 'INDEXING')
+        sqs_send_message(ISSL_QUEUE, json_object)
+    except Exception:
+        genome_manifest_unclaim_index(dynamodb, GENOMES_TABLE, accession)
+        raise
+    print("All files uploaded. Next Step ready")
+
+# Give up on a genome with a corrupt file. Its lock is marked FAILED, so that the next job for the genome downloads
+# it again, and the job and those waiting for the genome are failed rather than left waiting.
+def fail_genome(accession, jobid, object_key):
+    jobs = genome_lock_fail(dynamodb, GENOMES_TABLE, accession, jobid)
+    fail_jobs(dynamodb, JOBS_TABLE, TASK_TRACKING_TABLE, jobs, f"Checksum mismatch for {os.path.basename(object_key)} of {accession}")
 
 
 def lambda_handler(event, context):
@@ -195,7 +288,6 @@ def lambda_handler(event, context):
     json_object = json.dumps(body)
 
     genome_accession = args['genome_accession']
-    num_files = args['num_files']
     filename = args['filename']
     file_url = args['file_url']
     part = args['part']
@@ -205,60 +297,85 @@ def lambda_handler(event, context):
     object_key = args['object_key']
 
 
+    # each part is progress on the download, keep the job's hold on the genome
+    genome_lock_renew(dynamodb, GENOMES_TABLE, genome_accession, jobid)
+
     try:
         if upload_id != None: # Check if this is a multi-part upload
-            is_stream = False 
-            # Download part of the fasta file
-            http_response = download_part_file(filename, file_url, part, start_byte, end_byte, is_stream)
-            #Upload part file to S3 and get ETag 
-            etag = part_upload_to_s3(http_response, upload_id, part, object_key)
-            # Record Upload in DynamoDB
-            response_dynamo = file_upload_record(filename, part, etag)
-            print("Item uploaded to S3 and DynamoDB:", response_dynamo)
-            
+            # Download the run of parts of the fasta file and upload them to S3. Messages from before parts were
+            # grouped cover a single part.
+            part_size = args.get('part_size', end_byte - start_byte + 1)
+            upload_key = upload_record_key(filename, upload_id)
+            part_numbers = list(range(part, part + math.ceil((end_byte - start_byte + 1) / part_size)))
+
+            # A redelivered message may find its parts uploaded already, or the upload completed, in which case
+            # the parts can no longer be uploaded to it
+            done, finalised = upload_progress(upload_key)
+            if finalised:
+                print(f"{filename} was already finalised")
+                return
+            if set(part_numbers) <= done:
+                print(f"Parts {part_numbers[0]}-{part_numbers[-1]} of {filename} were already uploaded")
+            else:
+                for part_number, etag in transfer_parts(filename, file_url, upload_id, object_key, part, start_byte, end_byte, part_size):
+                    # Record Upload in DynamoDB
+                    response_dynamo = file_upload_record(upload_key, part_number, etag)
+                    print("Item uploaded to S3 and DynamoDB:", response_dynamo)
+
             total_parts = args['parts_per_file']
-            # Check if all parts of file have been uploaded 
-            if all_parts_uploaded(filename, total_parts):
-                # Extract EEtags and part numbers 
-                parts = extract_etags_and_parts(filename)
-                #combine part files
-                response_S3_complete = complete_file_multipart_upload(object_key, upload_id, parts)
-                print(response_S3_complete)
-
-                # check if all fasta files for genome accession have been uploaded 
-                if are_all_files_uploaded(num_files, genome_accession):
-                    sqs_send_message(ISSL_QUEUE, json_object)
-                    # send it to the ISSL CREATE SQS QUEUE
-                    print("All files uploaded. Next Step ready")
-                else:
-                    print("All files not uploaded")
+            # Check if all parts of file have been uploaded. Until the file is finalised, every message for its
+            # last parts (including redeliveries) finalises it.
+            if parts_uploaded(upload_key, part_numbers, total_parts):
+                if not claim_finalisation(upload_key):
+                    print(f"{filename} is already being finalised")
+                    return
+                try:
+                    # Extract EEtags and part numbers 
+                    parts = extract_etags_and_parts(upload_key)
+                    #combine part files
+                    response_S3_complete = complete_file_multipart_upload(object_key, upload_id, parts)
+                    print(response_S3_complete)
+
+                    # check the file, then if all fasta files for genome accession have been uploaded 
+                    if not verify_fasta_file(object_key, args.get('md5')):
+                        print("The file is corrupt")
+                        fail_genome(genome_accession, jobid, object_key)
+                    elif fasta_file_uploaded(genome_accession, object_key):
+                        start_indexing(genome_accession, jobid, json_object)
+                    else:
+                        print("All files not uploaded")
+                    file_finalised(upload_key)
+                except Exception:
+                    release_finalisation(upload_key)
+                    raise
             else:
                 print("Not all parts for this file have been uploaded")
             return
         
         else: # this is a normal upload
 
-            is_stream = True 
-            # Download the entire file 
-            http_response = download_part_file(filename, file_url, part, start_byte, end_byte, is_stream)
-            # Stream file to S3
-            if upload_to_s3(http_response, object_key):
-                # Check if all files for genome accession have been uploaded
-                if are_all_files_uploaded(num_files, genome_accession):
-                    print("All files uploaded. Next Step ready")
-                    sqs_send_message(ISSL_QUEUE, json_object)
-                    # send it to the ISSL CREATE SQS QUEUE
+            # Download the entire file to /tmp, computing its checksum on the way, and stream it to S3
+            digest = hashlib.md5()
+            with tempfile.TemporaryFile() as data:
+                download_part_file(filename, file_url, part, start_byte, end_byte, data, digest)
+                uploaded = upload_to_s3(data, object_key)
+            if uploaded:
+                # Check the file, then if all files for genome accession have been uploaded
+                if not verify_fasta_file(object_key, args.get('md5'), digest):
+                    print("The file is corrupt")
+                    fail_genome(genome_accession, jobid, object_key)
+                elif fasta_file_uploaded(genome_accession, object_key):
+                    start_indexing(genome_accession, jobid, json_object)
                 else:
                     print("All files not uploaded")
             else:
                 print("Normal upload into s3 was unsuccessful")
 
     except Exception as e:
+        # fail the invocation so that SQS delivers the message again, which downloads only the parts of this
+        # message (parts that are uploaded again are only counted once) and finalises the file if it is not yet
         print(f"Error processing: {str(e)}")
-        return {
-            'statusCode': 500,
-            'body': 'Failed to download and upload fasta file'
-        }
+        raise
 
     return 
 
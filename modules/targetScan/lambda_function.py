@@ -10,10 +10,17 @@ JOBS_TABLE = os.getenv('JOBS_TABLE')
 TASK_TRACKING_TABLE = os.getenv('TASK_TRACKING_TABLE')
 CONSENSUS_SQS = os.getenv('CONSENSUS_QUEUE')
 ISSL_SQS = os.getenv('ISSL_QUEUE')
+GENOMES_TABLE = os.getenv('GENOMES_TABLE')
+SCORE_CACHE_TABLE = os.getenv('SCORE_CACHE_TABLE')
+BUCKET = os.getenv('BUCKET')
+TARGETS_PER_MESSAGE = int(os.getenv('TARGETS_PER_MESSAGE', TARGET_ENVELOPE_MAX_TARGETS))
+# consensus scoring takes much longer per guide than ISSL, so its envelopes can be made smaller
+CONSENSUS_TARGETS_PER_MESSAGE = int(os.getenv('CONSENSUS_TARGETS_PER_MESSAGE', TARGETS_PER_MESSAGE))
 
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(TARGETS_TABLE)
 sqsClient = boto3.client('sqs')
+s3Client = boto3.client('s3')
 
 # Function that returns the reverse-complement of a given sequence
 complements = str.maketrans('acgtrymkbdhvACGTRYMKBDHV', 'tgcayrkmvhdbTGCAYRKMVHDB')
@@ -69,32 +76,97 @@ def target_iterator(seq):
         yield possibleTargets[possibleTarget]
 
 
-# Find target sites and add to dictionary, 'candidateTargets'.
-def find_targets(params):
-    num_targets = 0
+# The jobs whose sequences are scanned for a message: the job itself, or the child jobs of a batch job, which has
+# no sequence of its own (see createJob)
+def scan_jobs(params):
+    if params['Sequence']:
+        return [params]
+
+    parent = dynamodb.Table(JOBS_TABLE).get_item(Key={'JobID' : params['JobID']}, ConsistentRead=True).get('Item')
+    if parent is None or 'Regions' not in parent:
+        print(f"Job {params['JobID']} has no sequence")
+        return []
+
+    children = dynamodb_batch_get(dynamodb, JOBS_TABLE, [{'JobID' : region['JobID']} for region in parent['Regions']])
+    return [{'JobID' : child['JobID'], 'Genome' : child['Genome'], 'Sequence' : child['Sequence']} for child in children]
+
+
+# Version of the genome's ISSL index that cached ISSL scores must have been computed with (see
+# `issl_index_version`), or None if the score cache is not used. The ETags of the index are read from the genome's
+# manifest, or from S3 for genomes indexed before manifests were kept.
+def issl_version(genome):
+    if not SCORE_CACHE_TABLE:
+        return None
+
+    try:
+        etags = manifest_issl_etags(genome_manifest(dynamodb, GENOMES_TABLE, genome))
+        if etags is None:
+            names = issl_index_names(s3Client, BUCKET, genome) or []
+            etags = {
+                name : s3Client.head_object(Bucket=BUCKET, Key=f"{genome}/issl/{name}.issl")['ETag'].strip('"')
+                for name in names
+            }
+        return issl_index_version(etags) if etags else None
+    except Exception as e:
+        print(f"Error reading the ISSL index of {genome}, scoring every target: {e}")
+        return None
+
+
+# Scores of the targets that are in the score cache: the consensus, and the ISSL score if it was computed with
+# the current index of the genome (`version`). Returns a dict of guide to the scores found.
+def cached_scores(genome, targetEntries, version):
+    if version is None or not targetEntries:
+        return {}
+
+    try:
+        items = score_cache_get(dynamodb, SCORE_CACHE_TABLE, genome, [entry['Sequence'] for entry in targetEntries])
+    except Exception as e:
+        print(f"Error reading the score cache, scoring every target: {e}")
+        return {}
+
+    cached = {}
+    for guide, item in items.items():
+        scores = {}
+        if 'IsslScore' in item and item.get('IsslVersion') == version:
+            scores['IsslScore'] = item['IsslScore']
+        if 'Consensus' in item:
+            scores['Consensus'] = item['Consensus']
+        if scores:
+            cached[guide] = scores
+    return cached
+
+
+# Find target sites and add to dictionary, 'candidateTargets'. Targets whose scores are cached are stored with
+# them, and only need to be scored for the scores that are not. Returns the number of targets, the number that
+# were found in the cache for each score, and the messages to send to each scoring queue.
+def find_targets(params, version):
+    targetEntries = [
+        create_target_entry(params, index, target)
+        for index, target in enumerate(target_iterator(params['Sequence']))
+    ]
+
+    cached = cached_scores(params['Genome'], targetEntries, version)
 
     with table.batch_writer() as batch:
-        for index, target in enumerate(target_iterator(params['Sequence'])):
-            targetEntry = create_target_entry(params, index, target)
-            
-            batch.put_item(Item=targetEntry)
-            
-            for targetQueue in [ISSL_SQS, CONSENSUS_SQS]:
-                msg = json.dumps(
-                    {
-                        'default': json.dumps(targetEntry),
-                        'genome': json.dumps(params['Genome'])
-                    }
-                )
-            
-                response = sqsClient.send_message(
-                    QueueUrl=targetQueue,
-                    MessageBody=msg,
-                )
-
-            num_targets += 1
-
-    return num_targets
+        for targetEntry in targetEntries:
+            batch.put_item(Item={**targetEntry, **cached.get(targetEntry['Sequence'], {})})
+
+    hits = {}
+    msgs = {}
+    for targetQueue, field, maxTargets in [[ISSL_SQS, 'IsslScore', TARGETS_PER_MESSAGE], [CONSENSUS_SQS, 'Consensus', CONSENSUS_TARGETS_PER_MESSAGE]]:
+        misses = [entry for entry in targetEntries if field not in cached.get(entry['Sequence'], {})]
+        hits[field] = len(targetEntries) - len(misses)
+
+        # many guides are packed into each message
+        msgs[targetQueue] = list(pack_target_envelopes(params['JobID'], params['Genome'], misses, max_targets=maxTargets))
+
+    emit_metrics('ScoreCache', {
+        'Targets' : len(targetEntries),
+        'IsslCacheHits' : hits['IsslScore'],
+        'ConsensusCacheHits' : hits['Consensus']
+    })
+
+    return len(targetEntries), hits, msgs
 
 
 def deleteCandidateTargets(jobid):
@@ -116,14 +188,29 @@ def lambda_handler(event, context):
     # See: https://docs.aws.amazon.com/lambda/latest/dg/with-ddb.html
 
     params, body = recv(event)
-    
-    accession = params['Genome']
-    sequence = params['Sequence']
-    jobId = params['JobID']
-    
-    num_targets = find_targets(params) 
 
-    # set the total number of tasks the job needs to complete
-    job = set_task_total(dynamodb, TASK_TRACKING_TABLE, jobId, num_targets)
+    # the regions of a batch job are all scanned in this pass, and their messages sent together
+    version = issl_version(params['Genome'])
+    queueMsgs = {ISSL_SQS : [], CONSENSUS_SQS : []}
+    for job in scan_jobs(params):
+        jobId = job['JobID']
+
+        num_targets, hits, msgs = find_targets(job, version)
+        for targetQueue in queueMsgs:
+            queueMsgs[targetQueue] += msgs[targetQueue]
+
+        # set the total number of tasks the job needs to complete
+        set_task_total(dynamodb, TASK_TRACKING_TABLE, jobId, num_targets)
+
+        # the targets found in the score cache are already scored, and are only counted once if the job is
+        # scanned again
+        credit_cached_scores(dynamodb, TASK_TRACKING_TABLE, jobId, {
+            "NumScoredOfftarget" : hits['IsslScore'],
+            "NumScoredOntarget" : hits['Consensus']
+        })
+
+    # messages are sent in batches of up to 10
+    for targetQueue, msgs in queueMsgs.items():
+        sqs_send_messages(sqsClient, targetQueue, msgs)
 
     return None
\ No newline at end of file
@@ -0,0 +1,74 @@
+'''
+Benchmark of the site scanners of extractOfftargets.
+
+Purpose:    compare the `regex` and `numpy` scanners, writing `text` and `binary` off-targets, on a synthetic
+            multi-MB chromosome, and check that both scanners write identical output
+
+Input:      none, the chromosome is random sequence (seeded) with runs of N and soft-masked stretches
+
+Output:     the sites found and seconds taken by each scanner and format, and the speed-up of `numpy`
+
+To use:     python3 scripts/bench_scanners.py [--sizeMB 16]
+'''
+import argparse, io, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'layers', 'isslCreation', 'python', 'crackling', 'utils'))
+import extractOfftargets
+
+# The chromosome is built from blocks of this many bases, a few of which are N runs or lowercase
+BLOCK_BASES = 1 << 16
+
+
+# A random chromosome of about `sizeMB` million bases
+def syntheticChromosome(sizeMB):
+    rnd = random.Random(11)
+    blocks = []
+    for _ in range(max(1, sizeMB * 1000000 // BLOCK_BASES)):
+        block = ''.join(rnd.choices('ACGT', k = BLOCK_BASES))
+        kind = rnd.random()
+        if kind < 0.05:
+            block = 'N' * BLOCK_BASES
+        elif kind < 0.2:
+            block = block.lower()
+        blocks.append(block)
+    return ''.join(blocks)
+
+# Scan the chromosome in windows, as the pipeline does. Returns the sites found, the seconds taken and the output.
+def scan(seq, offtargetFormat, scanner):
+    outFile = io.StringIO() if offtargetFormat == 'text' else io.BytesIO()
+    numSites = 0
+    start = time.perf_counter()
+    for window in extractOfftargets.iterFastaWindows([seq]):
+        numSites += extractOfftargets.scanWindow(window, outFile, offtargetFormat, scanner)
+    return numSites, time.perf_counter() - start, outFile.getvalue()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the site scanners of extractOfftargets.')
+    parser.add_argument('--sizeMB',
+        help='The size of the synthetic chromosome, in millions of bases. Default is 16.',
+        type=int,
+        default=16,
+        required=False
+    )
+    args = parser.parse_args()
+
+    if extractOfftargets.numpy is None:
+        sys.exit('NumPy is not available, only the regex scanner can be run')
+
+    seq = syntheticChromosome(args.sizeMB)
+    print(f'Scanning {len(seq):,} bases in windows of {extractOfftargets.SCAN_WINDOW_SIZE:,}')
+
+    identical = True
+    for offtargetFormat in extractOfftargets.OFFTARGET_FORMATS:
+        results = {scanner : scan(seq, offtargetFormat, scanner) for scanner in extractOfftargets.OFFTARGET_SCANNERS}
+        for scanner, (numSites, elapsed, _) in results.items():
+            print(f'{scanner:<6} {offtargetFormat:<6} {numSites:>12,} sites {elapsed:>8.2f}s {len(seq) / elapsed / 1e6:>8.1f} Mbases/s')
+        print(f'numpy is {results["regex"][1] / results["numpy"][1]:.1f}x faster writing {offtargetFormat}')
+        identical = identical and results['regex'][2] == results['numpy'][2]
+
+    print(f'Output of the scanners is {"identical" if identical else "DIFFERENT"}')
+    if not identical:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+'''
+Benchmark of the SQS fan-out of candidate guides in targetScan.
+
+Purpose:    compare sending one message per guide with `send_message` (as targetScan used to), batches of ten
+            per-guide messages with `sqs_send_messages`, and the envelopes of many guides that targetScan sends now
+
+Input:      none, the guides are synthetic and SQS is a local stand-in with a fixed round trip and some
+            failed entries, which `sqs_send_messages` retries
+
+Output:     messages and guides per second for each approach and number of guides
+
+To use:     python3 scripts/bench_sqs_fanout.py [--guides 100 1000 10000] [--latencyMs 10] [--failureRate 0.02]
+'''
+import argparse, json, os, random, sys, time
+from threading import Lock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'layers', 'commonFuncs', 'python'))
+import common_funcs
+
+# Serial sends take a long time for many guides, they are only timed up to this many
+MAX_SERIAL_GUIDES = 1000
+
+
+# A local stand-in for the SQS client, with a fixed round trip per call. Entries of a batch fail at random, as
+# SQS reports throttled entries, and every delivered message is counted.
+class LocalSqs:
+    def __init__(self, latency, failureRate):
+        self.latency = latency
+        self.failureRate = failureRate
+        self.received = 0
+        self.lock = Lock()
+
+    def send_message(self, QueueUrl, MessageBody):
+        time.sleep(self.latency)
+        with self.lock:
+            self.received += 1
+
+    def send_message_batch(self, QueueUrl, Entries):
+        time.sleep(self.latency)
+        failed = [{'Id' : entry['Id'], 'SenderFault' : False, 'Code' : 'ThrottlingException'} for entry in Entries if random.random() < self.failureRate]
+        with self.lock:
+            self.received += len(Entries) - len(failed)
+        return {'Successful' : [], 'Failed' : failed}
+
+# Candidate guides as targetScan creates them
+def targetEntries(numGuides):
+    return [
+        {'JobID' : 'x' * 36, 'TargetID' : i, 'Sequence' : ''.join(random.choice('ACGT') for _ in range(23)), 'Start' : i * 7, 'End' : i * 7 + 23, 'Strand' : '+'}
+        for i in range(numGuides)
+    ]
+
+# Send the messages with `send`, returning the messages and seconds taken
+def timeSend(sqs, send, msgs):
+    start = time.perf_counter()
+    send(sqs, msgs)
+    elapsed = time.perf_counter() - start
+    assert sqs.received == len(msgs), f'{sqs.received} of {len(msgs)} messages delivered'
+    return len(msgs), elapsed
+
+def sendSerial(sqs, msgs):
+    for msg in msgs:
+        sqs.send_message(QueueUrl='queue', MessageBody=msg)
+
+def sendBatched(sqs, msgs):
+    common_funcs.sqs_send_messages(sqs, 'queue', msgs)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the SQS fan-out of candidate guides.')
+    parser.add_argument('--guides',
+        help='The numbers of guides to send. Default is 100, 1000 and 10000.',
+        type=int,
+        nargs='+',
+        default=[100, 1000, 10000],
+        required=False
+    )
+    parser.add_argument('--latencyMs',
+        help='The round trip of each call to the stand-in, in milliseconds. Default is 10.',
+        type=float,
+        default=10,
+        required=False
+    )
+    parser.add_argument('--failureRate',
+        help='The fraction of batch entries that fail and are retried. Default is 0.02.',
+        type=float,
+        default=0.02,
+        required=False
+    )
+    args = parser.parse_args()
+    random.seed(1)
+
+    print(f'{"guides":>8} {"approach":<10} {"messages":>9} {"seconds":>8} {"msg/s":>9} {"guides/s":>10}')
+    for numGuides in args.guides:
+        entries = targetEntries(numGuides)
+        perGuide = [json.dumps(entry) for entry in entries]
+        envelopes = list(common_funcs.pack_target_envelopes('x' * 36, 'GCF_000001405.40', entries))
+
+        runs = [['batched', sendBatched, perGuide], ['envelopes', sendBatched, envelopes]]
+        if numGuides <= MAX_SERIAL_GUIDES:
+            runs.insert(0, ['serial', sendSerial, perGuide])
+
+        for name, send, msgs in runs:
+            numMsgs, elapsed = timeSend(LocalSqs(args.latencyMs / 1000, args.failureRate), send, msgs)
+            print(f'{numGuides:>8} {name:<10} {numMsgs:>9} {elapsed:>8.3f} {numMsgs / elapsed:>9.0f} {numGuides / elapsed:>10.0f}')
+
+if __name__ == '__main__':
+    main()
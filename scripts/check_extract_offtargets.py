@@ -0,0 +1,104 @@
+'''
+Golden-output check for extractOfftargets.
+
+Purpose:    run every scanner, intermediate format and process count of the extraction pipeline on a small
+            synthetic multi-FASTA file, and compare the off-targets with the expected output
+
+Input:      fixtures/golden.fa (six records: plain, N runs, repeats, soft-masked, GC rich, shorter than a site)
+
+Output:     one line per combination with its time, and a non-zero exit status if any output differs from
+            fixtures/golden.offtargets (the sorted 20-mers of a plain regex scan of each record)
+
+To use:     python3 scripts/check_extract_offtargets.py [--threads 1 2 4]
+'''
+import argparse, itertools, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'layers', 'isslCreation', 'python', 'crackling', 'utils'))
+import extractOfftargets
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+GOLDEN_FASTA = os.path.join(FIXTURES_DIR, 'golden.fa')
+GOLDEN_OFFTARGETS = os.path.join(FIXTURES_DIR, 'golden.offtargets')
+# Bytes per chunk when streaming the fixture, small so that records and sites span chunks
+STREAM_CHUNK_BYTES = 1000
+NUM_SHARDS = 3
+# The fixture is tiny, there is no need to allocate the default sort buffer for every run
+SORT_MEMORY_MB = 16
+
+
+# Read a file as a stream of chunks, like the FASTA files streamed from S3
+def fileChunks(fpInput, chunkBytes = STREAM_CHUNK_BYTES):
+    with open(fpInput, 'r') as inFile:
+        while chunk := inFile.read(chunkBytes):
+            yield chunk
+
+# Extract the fixture with the command line (file) pipeline
+def runSequential(fpOutput, numThreads, offtargetFormat, scanner, shard = None):
+    extractOfftargets.startSequentalprocessing([GOLDEN_FASTA], fpOutput, numThreads, None, offtargetFormat, scanner, SORT_MEMORY_MB, shard, NUM_SHARDS)
+
+# Extract the fixture with the streaming pipeline used by the isslCreation Lambda
+def runStreaming(fpOutput, numThreads, offtargetFormat, scanner, shard = None):
+    extractOfftargets.startStreamingProcessing([fileChunks(GOLDEN_FASTA)], fpOutput, numThreads, None, offtargetFormat, scanner, SORT_MEMORY_MB, shard, NUM_SHARDS)
+
+# Run one combination, whole and as shards (whose outputs, in order, make up the whole). Returns whether both
+# match the expected off-targets, and the time taken for the whole.
+def checkCombination(pipeline, numThreads, offtargetFormat, scanner, expected):
+    with tempfile.TemporaryDirectory() as tempDir:
+        fpOutput = os.path.join(tempDir, 'offtargets')
+        start = time.perf_counter()
+        pipeline(fpOutput, numThreads, offtargetFormat, scanner)
+        elapsed = time.perf_counter() - start
+        with open(fpOutput, 'r') as inFile:
+            whole = inFile.read()
+
+        shards = []
+        for shard in range(NUM_SHARDS):
+            pipeline(fpOutput, numThreads, offtargetFormat, scanner, shard)
+            with open(fpOutput, 'r') as inFile:
+                shards.append(inFile.read())
+
+    return whole == expected, ''.join(shards) == expected, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Check extractOfftargets against the golden fixture.')
+    parser.add_argument('--threads',
+        help='The process counts to check. Default is 1, 2 and 4.',
+        type=int,
+        nargs='+',
+        default=[1, 2, 4],
+        required=False
+    )
+    args = parser.parse_args()
+
+    with open(GOLDEN_OFFTARGETS, 'r') as inFile:
+        expected = inFile.read()
+
+    scanners = [scanner for scanner in extractOfftargets.OFFTARGET_SCANNERS if scanner != 'numpy' or extractOfftargets.numpy is not None]
+    if len(scanners) < len(extractOfftargets.OFFTARGET_SCANNERS):
+        print('WARNING: NumPy is not available, the numpy scanner is not checked')
+
+    # the pipelines print their progress, which is only shown for combinations that fail
+    results = []
+    realStdout = sys.stdout
+    for (name, pipeline), scanner, offtargetFormat, numThreads in itertools.product(
+        [['sequential', runSequential], ['streaming', runStreaming]], scanners, extractOfftargets.OFFTARGET_FORMATS, args.threads
+    ):
+        with tempfile.TemporaryFile(mode = 'w+') as log:
+            sys.stdout = log
+            try:
+                wholeOk, shardsOk, elapsed = checkCombination(pipeline, numThreads, offtargetFormat, scanner, expected)
+            finally:
+                sys.stdout = realStdout
+            if not (wholeOk and shardsOk):
+                log.seek(0)
+                print(log.read())
+
+        results.append(wholeOk and shardsOk)
+        print(f'{name:<10} {scanner:<6} {offtargetFormat:<6} threads={numThreads}  whole: {"ok" if wholeOk else "DIFFERS"}  shards: {"ok" if shardsOk else "DIFFERS"}  {elapsed:.2f}s')
+
+    print(f'{sum(results)} of {len(results)} combinations match {os.path.basename(GOLDEN_OFFTARGETS)}')
+    if not all(results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()